@@ -8,7 +8,6 @@ import re
 import socket
 import sys
 import uuid
-from time import time, sleep
 from pprint import pformat
 
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, EBSBlockDeviceType
@@ -29,6 +28,8 @@ from fabric.contrib.files import (append as file_append,
 from itertools import chain
 from sys import exit
 
+from bookshelf.api_v2.time_helpers import sleep, time
+
 
 _compute = None
 
@@ -0,0 +1,292 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Record and replay of the remote commands and file transfers of a block of
+code, so that helpers can be tested without a host.
+
+In record mode every run(), sudo(), put() and get() is executed on the host
+and written to a json cassette file along with its output, exit code and
+file contents. In replay mode they are served from the cassette in the same
+order, without connecting anywhere; a call that doesn't match the next one
+recorded raises CassetteMismatch.
+
+usage:
+    with cassette('tests/cassettes/apt_install.json'):
+        pkg.apt_install(packages=['fish'])
+
+The mode is taken from ``BOOKSHELF_CASSETTE_MODE``: 'record', 'replay' or
+'live' (run on the host, record nothing, as in nightly jobs). By default a
+cassette is replayed if its file exists and recorded otherwise.
+
+put() and get() of whole directories are not supported.
+"""
+
+import base64
+import json
+import os
+from contextlib import contextmanager
+from functools import wraps
+
+import fabric.operations
+from fabric.api import env, settings
+from fabric.sftp import SFTP
+
+from bookshelf.api_v2.command_hooks import command_hook, command_result
+
+_MODE_ENV_VAR = 'BOOKSHELF_CASSETTE_MODE'
+
+# used as the host when replaying without one, fabric wants a host string
+_REPLAY_HOST = 'cassette@replay'
+
+
+class CassetteMismatch(Exception):
+    """ A replayed call differs from the next recorded one. """
+
+
+def _encode(content):
+    try:
+        return {'text': content.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(content)}
+
+
+def _decode(encoded):
+    if 'base64' in encoded:
+        return base64.b64decode(encoded['base64'])
+    return encoded['text'].encode('utf-8')
+
+
+class Cassette(object):
+    """
+    The interactions recorded in, or replayed from, a json file.
+
+    :ivar unicode path: the cassette file.
+    :ivar bool replaying: serve the interactions instead of recording them.
+    """
+    def __init__(self, path, replaying):
+        self.path = path
+        self.replaying = replaying
+        self.interactions = []
+        if replaying:
+            with open(path) as f:
+                self.interactions = json.load(f)['interactions']
+        self._position = 0
+
+    def record(self, interaction):
+        self.interactions.append(interaction)
+
+    def next(self, **expected):
+        """
+        returns the next recorded interaction, which has to match the
+        expected values.
+        """
+        if self._position >= len(self.interactions):
+            raise CassetteMismatch('{}: no more interactions, got {}'.format(
+                self.path, expected))
+        interaction = self.interactions[self._position]
+        recorded = dict((key, interaction.get(key)) for key in expected)
+        if recorded != expected:
+            raise CassetteMismatch(
+                '{}: interaction {} was recorded as {}, got {}'.format(
+                    self.path, self._position, recorded, expected))
+        self._position += 1
+        return interaction
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'w') as f:
+            json.dump({'interactions': self.interactions}, f, indent=2,
+                      sort_keys=True)
+
+
+def _command_hook(cassette):
+    def hook(run_command, command, options):
+        key = {'type': 'command', 'command': command,
+               'sudo': options['sudo'], 'user': options['user']}
+        if cassette.replaying:
+            interaction = cassette.next(**key)
+        else:
+            # failures are recorded too, and raised by command_result
+            out = run_command(command, dict(options, warn_only=True))
+            interaction = dict(key, stdout=unicode(out, 'utf-8', 'replace'),
+                               stderr=unicode(out.stderr, 'utf-8', 'replace'),
+                               return_code=out.return_code)
+            cassette.record(interaction)
+        return command_result(command, options,
+                              interaction['stdout'].encode('utf-8'),
+                              interaction['stderr'].encode('utf-8'),
+                              interaction['return_code'])
+    return hook
+
+
+def _read_local(local_path, local_is_path):
+    if local_is_path:
+        with open(local_path, 'rb') as f:
+            return f.read()
+    position = local_path.tell()
+    content = local_path.read()
+    local_path.seek(position)
+    return content
+
+
+def _recording_sftp(cassette):
+    class RecordingSFTP(SFTP):
+        """ an SFTP connection that records what goes through it """
+
+        def _call(self, method, path):
+            result = getattr(SFTP, method)(self, path)
+            cassette.record({'type': 'sftp', 'method': method, 'path': path,
+                             'result': result})
+            return result
+
+        def normalize(self, path):
+            return self._call('normalize', path)
+
+        def exists(self, path):
+            return self._call('exists', path)
+
+        def isdir(self, path):
+            return self._call('isdir', path)
+
+        def glob(self, path):
+            return self._call('glob', path)
+
+        def put(self, local_path, remote_path, use_sudo, mirror_local_mode,
+                mode, local_is_path, temp_dir):
+            content = _read_local(local_path, local_is_path)
+            result = SFTP.put(self, local_path, remote_path, use_sudo,
+                              mirror_local_mode, mode, local_is_path,
+                              temp_dir)
+            cassette.record(dict(_encode(content), type='put',
+                                 remote_path=remote_path,
+                                 use_sudo=use_sudo, result=result))
+            return result
+
+        def get(self, remote_path, local_path, use_sudo, local_is_path,
+                rremote=None, temp_dir=""):
+            result = SFTP.get(self, remote_path, local_path, use_sudo,
+                              local_is_path, rremote, temp_dir)
+            if local_is_path:
+                content = _read_local(result, True)
+            else:
+                local_path.seek(0)
+                content = local_path.read()
+            cassette.record(dict(_encode(content), type='get',
+                                 remote_path=remote_path,
+                                 use_sudo=use_sudo, result=result))
+            return result
+
+    return RecordingSFTP
+
+
+def _replaying_sftp(cassette):
+    class ReplayingSFTP(object):
+        """ serves SFTP calls from the cassette, without a connection """
+
+        def __init__(self, host_string):
+            pass
+
+        def close(self):
+            pass
+
+        def _call(self, method, path):
+            return cassette.next(type='sftp', method=method,
+                                 path=path)['result']
+
+        def normalize(self, path):
+            return self._call('normalize', path)
+
+        def exists(self, path):
+            return self._call('exists', path)
+
+        def isdir(self, path):
+            return self._call('isdir', path)
+
+        def glob(self, path):
+            return self._call('glob', path)
+
+        def put(self, local_path, remote_path, use_sudo, mirror_local_mode,
+                mode, local_is_path, temp_dir):
+            interaction = cassette.next(type='put', remote_path=remote_path,
+                                        use_sudo=use_sudo)
+            if _read_local(local_path, local_is_path) != \
+                    _decode(interaction):
+                raise CassetteMismatch(
+                    '{}: content put to {} differs from the recording'.format(
+                        cassette.path, remote_path))
+            return interaction['result']
+
+        def get(self, remote_path, local_path, use_sudo, local_is_path,
+                rremote=None, temp_dir=""):
+            interaction = cassette.next(type='get', remote_path=remote_path,
+                                        use_sudo=use_sudo)
+            if local_is_path:
+                with open(interaction['result'], 'wb') as f:
+                    f.write(_decode(interaction))
+            else:
+                local_path.write(_decode(interaction))
+            return interaction['result']
+
+        def put_dir(self, *args):
+            raise NotImplementedError('cassettes do not support directories')
+
+        get_dir = put_dir
+
+    return ReplayingSFTP
+
+
+@contextmanager
+def _sftp_class(sftp_class):
+    original = fabric.operations.SFTP
+    fabric.operations.SFTP = sftp_class
+    try:
+        yield
+    finally:
+        fabric.operations.SFTP = original
+
+
+@contextmanager
+def cassette(path, mode=None):
+    """
+    context manager that records or replays the remote commands and file
+    transfers of the block.
+
+    params:
+        string path: the json cassette file
+        string mode: 'record', 'replay' or 'live', defaults to
+            BOOKSHELF_CASSETTE_MODE, or to replaying an existing cassette
+    """
+    mode = mode or os.environ.get(_MODE_ENV_VAR)
+    if mode is None:
+        mode = 'replay' if os.path.exists(path) else 'record'
+    if mode == 'live':
+        yield None
+        return
+
+    recording = Cassette(path, replaying=mode == 'replay')
+    if recording.replaying:
+        sftp_class = _replaying_sftp(recording)
+        host = settings(host_string=env.host_string or _REPLAY_HOST)
+    else:
+        sftp_class = _recording_sftp(recording)
+        host = settings()
+    try:
+        with host, _sftp_class(sftp_class), \
+                command_hook(_command_hook(recording)):
+            yield recording
+    finally:
+        # blocks checking that helpers abort get recorded too
+        if not recording.replaying:
+            recording.save()
+
+
+def with_cassette(path, mode=None):
+    """ decorator running the wrapped function within cassette(path) """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with cassette(path, mode):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,9 +1,9 @@
 # vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
 
 import socket
-from time import sleep
 
 from bookshelf.api_v2.logging_helpers import log_yellow
+from bookshelf.api_v2.time_helpers import sleep
 
 
 def is_ssh_available(host, port=22):
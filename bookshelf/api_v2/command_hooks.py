@@ -0,0 +1,124 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Hooks around every remote command executed through fabric.
+
+fabric's run() and sudo(), and therefore every helper in fabric.contrib.files
+and in bookshelf, end up calling fabric.operations._run_command. That
+function is replaced (once, on import) by one that passes each command
+through the registered hooks before running it.
+
+A hook is a callable:
+
+    def hook(run_command, command, options):
+        # inspect or change command/options here
+        return run_command(command, options)
+
+where options is a dict with the remaining _run_command arguments
+(sudo, user, timeout, stdout, warn_only, ...). Hooks are called in the
+order they were added, the first one added being the outermost, except for
+those added as innermost, which come after all the others.
+"""
+
+import inspect
+import threading
+from contextlib import contextmanager
+
+import fabric.operations
+from fabric.api import env, hide, settings
+from fabric.operations import _AttributeString
+from fabric.utils import error
+
+_lock = threading.Lock()
+_hooks = []
+_innermost_hooks = []
+
+_original_run_command = getattr(fabric.operations._run_command,
+                                '_bookshelf_original',
+                                fabric.operations._run_command)
+
+
+def _call_original(command, options):
+    return _original_run_command(command, **options)
+
+
+def _run_command_with_hooks(command, *args, **kwargs):
+    options = inspect.getcallargs(_original_run_command,
+                                  command, *args, **kwargs)
+    del options['command']
+
+    call = _call_original
+    for hook in reversed(_hooks + _innermost_hooks):
+        call = _chain(hook, call)
+    return call(command, options)
+
+
+def _chain(hook, run_command):
+    def call(command, options):
+        return hook(run_command, command, options)
+    return call
+
+
+def add_command_hook(hook, innermost=False):
+    """
+    adds a hook that wraps every remote command.
+
+    params:
+        bool innermost: run the hook after all the others, closest to the
+            command, e.g. to change the command without the other hooks
+            seeing it
+    """
+    with _lock:
+        hooks = _innermost_hooks if innermost else _hooks
+        if hook not in hooks:
+            hooks.append(hook)
+
+
+def remove_command_hook(hook):
+    """ removes a previously added hook """
+    with _lock:
+        for hooks in (_hooks, _innermost_hooks):
+            if hook in hooks:
+                hooks.remove(hook)
+
+
+@contextmanager
+def command_hook(hook, innermost=False):
+    """ context manager that adds hook for the duration of the block """
+    add_command_hook(hook, innermost)
+    try:
+        yield
+    finally:
+        remove_command_hook(hook)
+
+
+def command_result(command, options, stdout, stderr, return_code):
+    """
+    returns what _run_command returns for a command that gave this output,
+    aborting or warning the way it does on failure. For hooks that answer
+    commands themselves instead of calling run_command.
+    """
+    manager = settings()
+    if options['warn_only']:
+        manager = settings(warn_only=True)
+    if options['quiet']:
+        manager = settings(hide('everything'), warn_only=True)
+    with manager:
+        out = _AttributeString(stdout)
+        err = _AttributeString(stderr)
+        which = 'sudo' if options['sudo'] else 'run'
+        out.failed = False
+        out.command = command
+        out.real_command = command
+        if return_code not in env.ok_ret_codes:
+            out.failed = True
+            error(message="%s() received nonzero return code %s while "
+                          "executing '%s'!" % (which, return_code, command),
+                  stdout=out, stderr=err)
+        out.return_code = return_code
+        out.succeeded = not out.failed
+        out.stderr = err
+        return out
+
+
+_run_command_with_hooks._bookshelf_original = _original_run_command
+fabric.operations._run_command = _run_command_with_hooks
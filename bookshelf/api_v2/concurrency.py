@@ -0,0 +1,317 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Adaptive concurrency for fan-outs, whether that is running a helper on many
+hosts or having many ``api_v3`` lifecycle operations in flight.
+
+A fixed pool size is either too timid or overwhelms something along the
+way: sshd's MaxStartups, the cloud API quotas, the package mirrors.
+AdaptiveConcurrency is an AIMD controller, like TCP congestion control. The
+limit grows by one each time a full window of operations completes
+cleanly, and is cut by ``backoff`` on a congestion signal:
+
+    * 'latency': operations take ``latency_tolerance`` times longer than
+      the fastest they were seen to take
+    * 'ssh': an ssh connection failed
+    * 'throttle': a cloud throttled our API calls during the operation
+
+Every change of the limit is recorded in ``metrics`` as a 'concurrency'
+event, along with ``concurrency.<name>.limit`` and
+``concurrency.<name>.in_flight`` gauges.
+
+usage:
+    results = run_on_hosts(['10.0.0.1', '10.0.0.2'], apt_install,
+                           packages=['git'])
+"""
+
+import multiprocessing
+import socket
+import threading
+import traceback
+from Queue import Empty
+from contextlib import contextmanager
+from multiprocessing.util import register_after_fork
+from time import time
+
+from fabric.api import settings
+from fabric.exceptions import NetworkError
+
+from bookshelf.api_v2.metrics import is_throttling_error, metrics
+
+
+def congestion_signal(error):
+    """
+    returns 'throttle' or 'ssh' if the exception means we are putting too
+    much load on a cloud API or on sshd, or None.
+    """
+    if is_throttling_error(error):
+        return 'throttle'
+    if isinstance(error, (NetworkError, socket.error, EOFError)):
+        return 'ssh'
+    return None
+
+
+class AdaptiveConcurrency(object):
+    """
+    Thread safe AIMD limit on the number of operations in flight.
+
+    params:
+        string name: names the gauges and events in metrics
+        int initial, minimum, maximum: bounds of the limit
+        float backoff: the limit is multiplied by this on congestion
+        float latency_tolerance: how many times slower than the baseline
+            operations can get before it counts as congestion, or None to
+            ignore latency when operations vary too much for it to mean
+            anything
+        float smoothing: weight of the newest latency in its moving average
+    """
+    def __init__(self, name, initial=4, minimum=1, maximum=64, backoff=0.5,
+                 latency_tolerance=2.0, smoothing=0.3, registry=None):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self._registry = registry
+        self._condition = threading.Condition()
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._latency = None
+        self._baseline = None
+        # operations started before the last decrease saw the same
+        # congestion, they don't get to decrease the limit again
+        self._decreased_at = 0
+        register_after_fork(self, AdaptiveConcurrency._after_fork)
+
+    def _after_fork(self):
+        # a process started by multiprocessing has none of the operations
+        # of its parent in flight, and none of its threads to notify
+        self._condition = threading.Condition()
+        self._in_flight = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _record(self, reason=None):
+        # must be called with self._condition held
+        registry = self._registry or metrics
+        prefix = 'concurrency.%s' % self.name
+        registry.set_gauge(prefix + '.limit', self.limit)
+        registry.set_gauge(prefix + '.in_flight', self._in_flight)
+        if reason is not None:
+            registry.record_event('concurrency', self.name,
+                                  limit=self.limit, reason=reason)
+
+    def try_acquire(self):
+        """
+        starts an operation if the limit allows it.
+
+        returns:
+            the start time to give to release(), or None
+        """
+        with self._condition:
+            if self._in_flight >= self.limit:
+                return None
+            self._in_flight += 1
+            self._record()
+        return time()
+
+    def acquire(self):
+        """ waits until an operation can start, returns its start time """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            self._record()
+        return time()
+
+    def release(self, started, congested=None, failed=False):
+        """
+        records the end of an operation and adjusts the limit.
+
+        params:
+            float started: the time returned by acquire()
+            string congested: the congestion signal the operation ran into
+            bool failed: the operation failed for reasons unrelated to load,
+                which leaves the limit alone
+        """
+        latency = time() - started
+        with self._condition:
+            self._in_flight -= 1
+            if congested is None and not failed:
+                congested = self._observe_latency(latency)
+            old_limit = self.limit
+            if congested is not None:
+                if started >= self._decreased_at:
+                    self._limit = max(self.minimum,
+                                      self._limit * self.backoff)
+                    self._decreased_at = time()
+            elif not failed:
+                # grows by one once every operation of a window succeeded
+                self._limit = min(self.maximum,
+                                  self._limit + 1.0 / self.limit)
+            if self.limit != old_limit:
+                self._record(congested or 'increase')
+            else:
+                self._record()
+            self._condition.notify_all()
+
+    def _observe_latency(self, latency):
+        # must be called with self._condition held
+        if self.latency_tolerance is None:
+            return None
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += self.smoothing * (latency - self._latency)
+        if self._baseline is None or self._latency < self._baseline:
+            self._baseline = self._latency
+        if self._latency > self._baseline * self.latency_tolerance:
+            return 'latency'
+        return None
+
+    @contextmanager
+    def slot(self):
+        """
+        runs the block as one operation, waiting for the limit to allow it.
+        Its exceptions and the throttles it recorded in metrics are the
+        congestion signals, those of other threads are left to their own
+        operations.
+        """
+        started = self.acquire()
+        with self.operation(started):
+            yield
+
+    @contextmanager
+    def operation(self, started):
+        """
+        runs the block as the operation started by acquire() or
+        try_acquire(), releasing it afterwards with the congestion signals
+        slot() uses.
+
+        params:
+            float started: the time returned by acquire() or try_acquire()
+        """
+        registry = self._registry or metrics
+        throttles = registry.thread_throttle_count()
+        try:
+            yield
+        except Exception as e:
+            signal = congestion_signal(e)
+            self.release(started, signal, failed=signal is None)
+            raise
+        if registry.thread_throttle_count() > throttles:
+            self.release(started, 'throttle')
+        else:
+            self.release(started)
+
+
+#: The controller of ``run_on_hosts``.
+host_concurrency = AdaptiveConcurrency('hosts', initial=8, maximum=64)
+
+
+class FanOutError(Exception):
+    """
+    Raised by ``run_on_hosts`` when the task failed on some of the hosts.
+
+    params:
+        dict results: host to the result of the task, where it succeeded
+        dict errors: host to the formatted traceback, where it failed
+    """
+    def __init__(self, results, errors):
+        Exception.__init__(self, results, errors)
+        self.results = results
+        self.errors = errors
+
+    def __str__(self):
+        return 'failed on {} hosts:\n{}'.format(
+            len(self.errors),
+            '\n'.join('{}: {}'.format(host, error)
+                      for host, error in sorted(self.errors.items())))
+
+
+def _run_on_host(host, task, args, kwargs, results):
+    # network errors raise instead of aborting, so they can be told apart
+    with settings(host_string=host, use_exceptions_for={'network': True}):
+        try:
+            results.put((host, True, task(*args, **kwargs), None))
+        except BaseException as e:
+            results.put((host, False, traceback.format_exc(),
+                         congestion_signal(e)))
+
+
+def run_on_hosts(hosts, task, *args, **kwargs):
+    """
+    runs task on every host, each in a process of its own as fabric's
+    ``env`` can't be shared between threads, with as many hosts at once as
+    the controller allows.
+
+    params:
+        list hosts: fabric host strings
+        AdaptiveConcurrency controller: keyword only, defaults to
+            ``host_concurrency``
+    returns:
+        dict of host to the result of task
+    raises:
+        FanOutError: once all hosts are done, if task failed on any
+    """
+    controller = kwargs.pop('controller', host_concurrency)
+    pending = list(hosts)
+    running = {}
+    queue = multiprocessing.Queue()
+    results = {}
+    errors = {}
+
+    while pending or running:
+        while pending:
+            if running:
+                started = controller.try_acquire()
+                if started is None:
+                    break
+            else:
+                started = controller.acquire()
+            host = pending.pop(0)
+            child = multiprocessing.Process(
+                target=_run_on_host, args=(host, task, args, kwargs, queue))
+            child.start()
+            running[host] = (child, started)
+
+        try:
+            reported = [queue.get(timeout=5)]
+        except Empty:
+            exited = [exited_host
+                      for exited_host, (exited_child, _) in running.items()
+                      if not exited_child.is_alive()]
+            # what they put in the queue before exiting is there by now,
+            # the others died without reporting or with a result that
+            # couldn't be pickled, whatever their exit code
+            reported = []
+            try:
+                while True:
+                    reported.append(queue.get_nowait())
+            except Empty:
+                pass
+            reported.extend(
+                (host, False, 'exited with {} without a result'.format(
+                    running[host][0].exitcode), None)
+                for host in exited
+                if host not in [report[0] for report in reported])
+
+        for host, succeeded, result, congested in reported:
+            child, started = running.pop(host)
+            child.join()
+            controller.release(started, congested,
+                               failed=not succeeded and congested is None)
+            if succeeded:
+                results[host] = result
+            else:
+                errors[host] = result
+
+    if errors:
+        raise FanOutError(results, errors)
+    return results
@@ -7,20 +7,24 @@ from fabric.contrib.files import (
 from bookshelf.api_v2.logging_helpers import (log_green,
                                               log_red)
 from bookshelf.api_v2.os_helpers import systemd
+from bookshelf.api_v2.tracing import traced
 
 
+@traced
 def cache_docker_image_locally(docker_image, log=False):
     if log:
         log_green('pulling docker image %s locally' % docker_image)
     sudo("docker pull %s" % docker_image)
 
 
+@traced
 def create_docker_group():
     """ creates the docker group """
     if not contains('/etc/group', 'docker', use_sudo=True):
         sudo("groupadd docker")
 
 
+@traced
 def does_container_exist(container):
     with settings(warn_only=True):
         result = sudo('docker inspect %s' % container)
@@ -32,6 +36,7 @@ def does_container_exist(container):
         return False
 
 
+@traced
 def does_image_exist(image):
     with settings(warn_only=True):
         if image in sudo('docker images'):
@@ -40,6 +45,7 @@ def does_image_exist(image):
             return False
 
 
+@traced
 def get_container_id(container):
         with hide('running', 'stdout'):
             result = sudo(
@@ -47,11 +53,13 @@ def get_container_id(container):
             return result
 
 
+@traced
 def get_image_id(image):
         result = sudo("docker images | grep %s | awk '{print $3}'" % image)
         return result
 
 
+@traced
 def install_docker():
     """ installs docker """
     with settings(hide('running', 'stdout')):
@@ -60,9 +68,11 @@ def install_docker():
         systemd('docker.service')
 
 
+@traced
 def remove_image(image):
     sudo('docker rmi -f %s' % get_image_id(image))
 
 
+@traced
 def remove_container(container):
     sudo('docker rm -f %s' % get_container_id(container))
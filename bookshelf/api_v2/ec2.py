@@ -2,12 +2,14 @@
 
 import boto.ec2
 
+from boto.exception import EC2ResponseError
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, EBSBlockDeviceType
 from fabric.api import env
-from time import sleep
-from bookshelf.api_v2.time_helpers import sleep_for_one_minute
+from bookshelf.api_v2.time_helpers import sleep, sleep_for_one_minute
 from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
 from bookshelf.api_v2.cloud import wait_for_ssh
+from bookshelf.api_v2.metrics import instrument_ec2_connection, record_retry
+from bookshelf.api_v2.ratelimit import rate_limit_ec2_connection
 
 
 def connect_to_ec2(region, access_key_id, secret_access_key):
@@ -16,7 +18,7 @@ def connect_to_ec2(region, access_key_id, secret_access_key):
                                       aws_access_key_id=access_key_id,
                                       aws_secret_access_key=secret_access_key)
     if conn:
-        return conn
+        return rate_limit_ec2_connection(instrument_ec2_connection(conn))
     else:
         return False
 
@@ -123,14 +125,14 @@ def destroy_ebs_volume(connection, region, volume_id, log=False):
             log_yellow('destroying EBS volume ...')
         try:
             connection.delete_volume(volume_id)
-        except:
+        except EC2ResponseError as e:
             # our EBS volume may be gone, but AWS info tables are stale
-            # wait a bit and ask again
+            # wait a bit and ask again. throttling is retried by the
+            # connection itself.
+            record_retry('ec2.DeleteVolume', volume_id=volume_id)
             sleep(5)
-            if not ebs_volume_exists(connection, region, volume_id):
-                pass
-            else:
-                raise("Couldn't delete EBS volume")
+            if ebs_volume_exists(connection, region, volume_id):
+                raise e
 
 
 def destroy_ec2(connection, region, instance_id, log=False):
@@ -0,0 +1,325 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+A fake host, for testing helpers without a container or a VM.
+
+Within fake_host() the run() and sudo() calls of a block are run locally, in
+a sandbox directory standing in for the root of the host, and put() and
+get() copy files in and out of it. Absolute paths under /etc, /var, /tmp,
+/opt, /home, /root, /srv, /mnt and /usr/local are rewritten into the
+sandbox; other paths such as /bin/bash are those of the machine running the
+tests.
+
+Shims stand in for the commands that need root or a real distribution:
+    * sudo runs its command as the current user
+    * rpm, yum, dpkg, dpkg-query and apt-get keep the installed packages in
+      /var/lib/fake-packages of the sandbox
+    * systemctl keeps the state of units in /var/lib/fake-systemd
+    * chown and chgrp succeed without changing anything, as that would
+      take root
+
+usage:
+    with fake_host() as host:
+        dir_ensure('/opt/app', mode='750', use_sudo=True)
+        assert os.path.isdir(host.path('/opt/app'))
+
+Every fake host is a directory of its own, so tests using them can run in
+parallel.
+"""
+
+import os
+import posixpath
+import re
+import shutil
+import stat
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+from fabric.api import env, settings
+from fabric.operations import _prefix_commands, _prefix_env_vars
+from fabric.sftp import SFTP
+
+from bookshelf.api_v2.cassette import _sftp_class
+from bookshelf.api_v2.command_hooks import command_hook, command_result
+
+# fabric wants a host string, even though nothing connects to it
+_HOST = 'root@fake-host'
+
+_SANDBOXED = ('etc', 'var', 'tmp', 'opt', 'home', 'root', 'srv', 'mnt',
+              'usr/local')
+
+_SANDBOXED_PATH = re.compile(
+    r'(?<![\w./~-])/(?:%s)(?=[/\s\'";|&)]|$)' % '|'.join(_SANDBOXED))
+
+_SHIMS = {
+    'sudo': r'''
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -u|-g|-p|-C) shift 2 ;;
+        --) shift; break ;;
+        -*) shift ;;
+        *) break ;;
+    esac
+done
+exec "$@"
+''',
+    'rpm': r'''
+packages=$FAKE_ROOT/var/lib/fake-packages
+case "$1" in
+    -q)
+        shift
+        status=0
+        for package in "$@"; do
+            if [ -e "$packages/$package" ]; then
+                echo "$package-1.0-1.noarch"
+            else
+                echo "package $package is not installed"
+                status=1
+            fi
+        done
+        exit $status ;;
+    -e)
+        shift
+        for package in "$@"; do rm -f "$packages/$package"; done ;;
+esac
+''',
+    'yum': r'''
+packages=$FAKE_ROOT/var/lib/fake-packages
+command=
+for argument in "$@"; do
+    case "$argument" in
+        -*) ;;
+        *)
+            if [ -z "$command" ]; then
+                command=$argument
+            elif [ "$command" = install ]; then
+                touch "$packages/$argument"
+            elif [ "$command" = remove ]; then
+                rm -f "$packages/$argument"
+            fi ;;
+    esac
+done
+''',
+    'dpkg-query': r'''
+packages=$FAKE_ROOT/var/lib/fake-packages
+status=0
+for package in "$@"; do
+    case "$package" in
+        -*) continue ;;
+    esac
+    if [ -e "$packages/$package" ]; then
+        echo "ii  $package  1.0  all  $package"
+    else
+        echo "dpkg-query: no packages found matching $package" >&2
+        status=1
+    fi
+done
+exit $status
+''',
+    'dpkg': r'''
+exit 0
+''',
+    'systemctl': r'''
+units=$FAKE_ROOT/var/lib/fake-systemd
+command=$1
+shift
+status=0
+for unit in "$@"; do
+    case "$unit" in
+        -*) continue ;;
+    esac
+    case "$command" in
+        start|restart|reload) touch "$units/$unit.active" ;;
+        stop) rm -f "$units/$unit.active" ;;
+        enable) touch "$units/$unit.enabled" ;;
+        disable) rm -f "$units/$unit.enabled" ;;
+        is-active|status)
+            if [ -e "$units/$unit.active" ]; then
+                echo active
+            else
+                echo inactive
+                status=3
+            fi ;;
+        is-enabled)
+            if [ -e "$units/$unit.enabled" ]; then
+                echo enabled
+            else
+                echo disabled
+                status=1
+            fi ;;
+    esac
+done
+exit $status
+''',
+    'chown': r'''
+exit 0
+''',
+}
+_SHIMS['apt-get'] = _SHIMS['yum']
+_SHIMS['chgrp'] = _SHIMS['chown']
+
+# '/usr/bin/apt-get install' has to run the shim too
+_SHIMMED_COMMAND = re.compile(
+    r'(?<![\w./~-])/(?:usr/)?s?bin/(%s)(?=[\s\'";|&)]|$)' %
+    '|'.join(re.escape(name) for name in _SHIMS))
+
+
+class _LocalSFTPClient(object):
+    """ the parts of a paramiko SFTPClient fabric uses, on the sandbox """
+
+    def __init__(self, host):
+        self._host = host
+
+    def _path(self, path):
+        return self._host.path(posixpath.join('/root', path))
+
+    def _call(self, function, *args):
+        # paramiko raises IOError where os raises OSError
+        try:
+            return function(*args)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror)
+
+    def close(self):
+        pass
+
+    def getcwd(self):
+        return None
+
+    def normalize(self, path):
+        return os.path.normpath(posixpath.join('/root', path))
+
+    def stat(self, path):
+        return self._call(os.stat, self._path(path))
+
+    def lstat(self, path):
+        return self._call(os.lstat, self._path(path))
+
+    def listdir(self, path):
+        return self._call(os.listdir, self._path(path))
+
+    def mkdir(self, path, mode=0777):
+        return self._call(os.mkdir, self._path(path), mode)
+
+    def chmod(self, path, mode):
+        return self._call(os.chmod, self._path(path), mode)
+
+    def put(self, local_path, remote_path):
+        self._call(shutil.copyfile, local_path, self._path(remote_path))
+        return self.stat(remote_path)
+
+    def putfo(self, fl, remote_path):
+        with open(self._path(remote_path), 'wb') as f:
+            shutil.copyfileobj(fl, f)
+        return self.stat(remote_path)
+
+    def get(self, remote_path, local_path):
+        self._call(shutil.copyfile, self._path(remote_path), local_path)
+
+    def getfo(self, remote_path, fl):
+        with open(self._path(remote_path), 'rb') as f:
+            shutil.copyfileobj(f, fl)
+
+
+def _local_sftp(host):
+    class LocalSFTP(SFTP):
+        """ fabric's SFTP, on the sandbox of a fake host """
+
+        def __init__(self, host_string):
+            self.ftp = _LocalSFTPClient(host)
+
+    return LocalSFTP
+
+
+class FakeHost(object):
+    """
+    A sandbox directory standing in for a host.
+
+    :ivar unicode root: the directory standing in for /.
+    """
+    def __init__(self, root=None):
+        self.root = root or tempfile.mkdtemp(prefix='bookshelf-fake-host-')
+        for directory in ('etc', 'var/lib/fake-packages',
+                          'var/lib/fake-systemd', 'tmp', 'opt', 'home',
+                          'root', 'srv', 'mnt', 'usr/local', '.shims'):
+            path = os.path.join(self.root, directory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        for name, script in _SHIMS.items():
+            path = os.path.join(self.root, '.shims', name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/bash' + script)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    def path(self, remote_path):
+        """ returns the local path of an absolute path on the host """
+        return os.path.join(self.root, remote_path.lstrip('/'))
+
+    def rewrite(self, command):
+        """ returns command, with the paths of the host in the sandbox """
+        command = _SHIMMED_COMMAND.sub(r'\1', command)
+        return _SANDBOXED_PATH.sub(
+            lambda match: self.path(match.group(0)), command)
+
+    def install(self, *packages):
+        """ marks packages as installed, for rpm and dpkg-query """
+        for package in packages:
+            open(self.path('/var/lib/fake-packages/' + package), 'w').close()
+
+    def installed(self, package):
+        return os.path.exists(self.path('/var/lib/fake-packages/' + package))
+
+    def unit_state(self, unit):
+        """ returns whether the systemd unit is (active, enabled) """
+        return (os.path.exists(self.path('/var/lib/fake-systemd/%s.active' %
+                                         unit)),
+                os.path.exists(self.path('/var/lib/fake-systemd/%s.enabled' %
+                                         unit)))
+
+    def hook(self, run_command, command, options):
+        """ the command hook running commands in the sandbox """
+        # what _run_command does with cd() and path() before wrapping
+        command = self.rewrite(_prefix_env_vars(_prefix_commands(command,
+                                                                 'remote')))
+        environment = dict(os.environ,
+                           FAKE_ROOT=self.root,
+                           HOME=self.path('/root'),
+                           PATH=os.path.join(self.root, '.shims') + ':' +
+                           os.environ.get('PATH', '/usr/bin:/bin'))
+        # in a session of its own, as sshd runs commands, so that killing
+        # the process group of a command leaves the tests alone
+        process = subprocess.Popen(
+            ['/bin/bash', '-c', command], cwd=self.path('/root'),
+            env=environment, stdin=open(os.devnull), preexec_fn=os.setsid,
+            stdout=subprocess.PIPE,
+            stderr=(subprocess.STDOUT if options['combine_stderr']
+                    else subprocess.PIPE))
+        stdout, stderr = process.communicate()
+        return command_result(command, options, stdout.rstrip('\n'),
+                              (stderr or '').rstrip('\n'),
+                              process.returncode)
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+@contextmanager
+def fake_host(root=None):
+    """
+    context manager running the remote commands and file transfers of the
+    block on a FakeHost.
+
+    params:
+        string root: the sandbox directory, by default a temporary one
+            removed afterwards
+    """
+    host = FakeHost(root)
+    try:
+        # innermost, as it runs the commands that other hooks see through
+        with settings(host_string=env.host_string or _HOST), \
+                _sftp_class(_local_sftp(host)), \
+                command_hook(host.hook, innermost=True):
+            yield host
+    finally:
+        if root is None:
+            host.close()
@@ -5,8 +5,10 @@ import re
 
 from fabric.operations import (get as get_file,
                                put as upload_file)
+from bookshelf.api_v2.tracing import traced
 
 
+@traced
 def insert_line_in_file_after_regex(path, line, after_regex, use_sudo=False):
     """ inserts a line in the middle of a file """
 
@@ -3,8 +3,10 @@
 from fabric.api import sudo, run
 from fabric.context_managers import cd
 from fabric.contrib.files import exists
+from bookshelf.api_v2.tracing import traced
 
 
+@traced
 def install_recent_git_from_source(version='2.4.6',
                                    prefix='/usr/local',
                                    log=False):
@@ -18,6 +20,7 @@ def install_recent_git_from_source(version='2.4.6',
         sudo('test -e %s/bin/git || make install' % prefix)
 
 
+@traced
 def git_clone(repo_url, repo_name):
     """ clones a git repository """
     if not exists(repo_name):
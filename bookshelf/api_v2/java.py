@@ -4,8 +4,10 @@ from fabric.api import sudo, settings
 from fabric.context_managers import hide
 from bookshelf.api_v2.os_helpers import install_os_updates
 from bookshelf.api_v2.pkg import apt_install
+from bookshelf.api_v2.tracing import traced
 
 
+@traced
 def install_oracle_java(distribution, java_version):
     """ installs oracle java """
     if 'ubuntu' in distribution:
@@ -0,0 +1,359 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Counters and latency histograms for the cloud API calls made by bookshelf.
+
+Every boto, pyrax and googleapiclient call made through the connections
+returned by ``api_v2`` and ``api_v3`` is recorded in the module level
+``metrics`` registry, keyed by operation name:
+
+    * ``ec2.<Action>``, e.g. ``ec2.DescribeVolumes``
+    * ``gce.<methodId>``, e.g. ``gce.compute.instances.get``
+    * ``rackspace.<VERB> <path>``, e.g. ``rackspace.GET /servers/detail``
+
+usage:
+    from bookshelf.api_v2.metrics import metrics
+    metrics.call_count('ec2.DescribeVolumes')
+    metrics.dump('/tmp/metrics.json')
+
+Setting ``BOOKSHELF_METRICS_FILE`` in the environment dumps the registry as
+json to that path when the process exits.
+"""
+
+import atexit
+import json
+import os
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import time
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+# error codes returned by the different clouds when we are being throttled
+_EC2_THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling',
+                         'ThrottlingException')
+_GCE_THROTTLING_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+# Rackspace also answers 413 when an absolute quota, such as the number of
+# servers, is reached. Only rate limits come with a Retry-After or say so
+_RACKSPACE_RATE_LIMITED = re.compile(r'rate[ -]?limit', re.IGNORECASE)
+
+_METRICS_FILE_ENV_VAR = 'BOOKSHELF_METRICS_FILE'
+
+
+class Histogram(object):
+    """
+    A fixed bucket histogram of observed values.
+
+    :ivar buckets: upper bounds of each bucket, the last one is +inf.
+    :ivar counts: number of observations that fell in each bucket.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': dict(
+                ('+Inf' if bound == float('inf') else str(bound), count)
+                for bound, count in zip(self.buckets, self.counts)
+            ),
+        }
+
+
+class OperationStats(object):
+    """
+    Everything we know about one operation name.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'throttles': self.throttles,
+            'retries': self.retries,
+            'latency': self.latency.to_dict(),
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe registry of per operation counters, latency histograms,
+    gauges and a bounded log of notable events (throttles, retries).
+    """
+    def __init__(self, max_events=1000):
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._gauges = {}
+        self._events = deque(maxlen=max_events)
+        self._thread = threading.local()
+
+    def _stats(self, operation):
+        # must be called with self._lock held
+        if operation not in self._operations:
+            self._operations[operation] = OperationStats()
+        return self._operations[operation]
+
+    def record_call(self, operation, duration, failed=False):
+        """ records one call of operation that took duration seconds """
+        with self._lock:
+            stats = self._stats(operation)
+            stats.calls += 1
+            if failed:
+                stats.errors += 1
+            stats.latency.observe(duration)
+
+    def record_event(self, kind, operation, **details):
+        """
+        records a notable event for an operation.
+
+        params:
+            string kind: 'throttle', 'retry' or any other event name
+            string operation: the operation the event relates to
+            dict details: extra json serializable information
+        """
+        event = dict(details, kind=kind, operation=operation, time=time())
+        with self._lock:
+            stats = self._stats(operation)
+            if kind == 'throttle':
+                stats.throttles += 1
+                self._thread.throttles = self.thread_throttle_count() + 1
+            elif kind == 'retry':
+                stats.retries += 1
+            self._events.append(event)
+
+    def set_gauge(self, name, value):
+        """ records the current value of something, e.g. a pool size """
+        with self._lock:
+            self._gauges[name] = value
+
+    def gauge(self, name):
+        with self._lock:
+            return self._gauges.get(name)
+
+    def throttle_count(self):
+        """ returns the number of throttled calls of all operations """
+        with self._lock:
+            return sum(stats.throttles
+                       for stats in self._operations.itervalues())
+
+    def thread_throttle_count(self):
+        """ returns the number of throttled calls the current thread made """
+        return getattr(self._thread, 'throttles', 0)
+
+    @contextmanager
+    def timed(self, operation):
+        """ context manager that records a call of operation """
+        start = time()
+        try:
+            yield
+        except Exception as e:
+            self.record_call(operation, time() - start, failed=True)
+            if is_throttling_error(e):
+                self.record_event('throttle', operation, error=str(e))
+            raise
+        self.record_call(operation, time() - start)
+
+    def call_count(self, operation):
+        with self._lock:
+            if operation in self._operations:
+                return self._operations[operation].calls
+            return 0
+
+    def operations(self):
+        """ returns the names of all the operations seen so far """
+        with self._lock:
+            return sorted(self._operations)
+
+    def events(self, kind=None):
+        with self._lock:
+            return [e for e in self._events
+                    if kind is None or e['kind'] == kind]
+
+    def snapshot(self):
+        """ returns all the metrics as a json serializable dictionary """
+        with self._lock:
+            return {
+                'operations': dict(
+                    (name, stats.to_dict())
+                    for name, stats in self._operations.iteritems()
+                ),
+                'gauges': dict(self._gauges),
+                'events': list(self._events),
+            }
+
+    def dump(self, path):
+        """ writes a snapshot of the metrics as json to path """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+            self._gauges.clear()
+            self._events.clear()
+
+
+metrics = MetricsRegistry()
+
+
+def record_retry(operation, registry=None, **details):
+    """ records that operation is being retried """
+    (registry or metrics).record_event('retry', operation, **details)
+
+
+def is_throttling_error(error):
+    """
+    returns True if the exception was raised because a cloud API is
+    throttling our requests.
+    """
+    # boto.exception.EC2ResponseError
+    if getattr(error, 'error_code', None) in _EC2_THROTTLING_CODES:
+        return True
+    if isinstance(error, HttpError):
+        if error.resp.status == 429:
+            return True
+        return any(reason in error.content
+                   for reason in _GCE_THROTTLING_REASONS)
+    # novaclient.exceptions.RateLimit and OverLimit
+    status = getattr(error, 'http_status', None)
+    if status == 429:
+        return True
+    if status == 413:
+        texts = [getattr(error, name, None) for name in ('message',
+                                                         'details')]
+        return bool(getattr(error, 'retry_after', 0) or
+                    any(_RACKSPACE_RATE_LIMITED.search(text)
+                        for text in texts if isinstance(text, basestring)))
+    return False
+
+
+def is_throttling_response(response):
+    """
+    returns True if a boto ec2 response says our requests are being
+    throttled. boto only raises EC2ResponseError later on when parsing, the
+    body read here is cached by the response.
+    """
+    if response.status < 400:
+        return False
+    body = response.read()
+    return any(code in body for code in _EC2_THROTTLING_CODES)
+
+
+def instrument_ec2_connection(connection, registry=None):
+    """
+    records every request made through a boto ec2 connection.
+
+    boto routes every EC2 API call through ``make_request``, so that is
+    wrapped on the connection object itself, which keeps the connection's
+    type unchanged.
+
+    returns:
+        the same connection object
+    """
+    if not connection or hasattr(connection, '_bookshelf_instrumented'):
+        return connection
+    registry = registry or metrics
+    make_request = connection.make_request
+    region = getattr(getattr(connection, 'region', None), 'name', None)
+
+    def instrumented_make_request(action, *args, **kwargs):
+        operation = 'ec2.%s' % action
+        with registry.timed(operation):
+            response = make_request(action, *args, **kwargs)
+        if is_throttling_response(response):
+            registry.record_event('throttle', operation,
+                                  region=region, status=response.status)
+        return response
+
+    connection.make_request = instrumented_make_request
+    connection._bookshelf_instrumented = True
+    return connection
+
+
+def _rackspace_operation(url, method):
+    """
+    turns a nova url into a stable operation name by dropping the api
+    version, tenant id and resource ids from the path.
+    """
+    path = url.split('?')[0]
+    path = re.sub('^https?://[^/]*', '', path)
+    segments = [s for s in path.split('/')
+                if s and re.match('^[a-zA-Z_-]+$', s) and
+                not re.match('^v\d', s)]
+    return 'rackspace.%s /%s' % (method, '/'.join(segments))
+
+
+def instrument_nova_client(nova, registry=None):
+    """
+    records every request made through a pyrax/novaclient connection.
+
+    returns:
+        the same nova client object
+    """
+    if hasattr(nova, '_bookshelf_instrumented'):
+        return nova
+    registry = registry or metrics
+    client = nova.client
+    request = client.request
+
+    def instrumented_request(url, method, **kwargs):
+        with registry.timed(_rackspace_operation(url, method)):
+            return request(url, method, **kwargs)
+
+    client.request = instrumented_request
+    nova._bookshelf_instrumented = True
+    return nova
+
+
+class InstrumentedHttpRequest(HttpRequest):
+    """
+    googleapiclient request that records each execute() in ``metrics``.
+
+    usage:
+        discovery.build('compute', 'v1', credentials=credentials,
+                        requestBuilder=InstrumentedHttpRequest)
+    """
+    def execute(self, *args, **kwargs):
+        with metrics.timed('gce.%s' % self.methodId):
+            return super(InstrumentedHttpRequest, self).execute(
+                *args, **kwargs)
+
+
+def dump_metrics_at_exit(path, registry=None):
+    """ writes the metrics as json to path when the process exits """
+    atexit.register((registry or metrics).dump, path)
+
+
+if os.environ.get(_METRICS_FILE_ENV_VAR):
+    dump_metrics_at_exit(os.environ[_METRICS_FILE_ENV_VAR])
@@ -7,8 +7,11 @@ from fabric.contrib.files import comment as comment_line
 from fabric.contrib.files import sed, contains
 
 import bookshelf.api_v2 as bookshelf2
+from bookshelf.api_v2.tracing import traced
+from bookshelf.api_v2.watchdog import with_timeout
 
 
+@traced
 def add_usr_local_bin_to_path(log=False):
     """ adds /usr/local/bin to $PATH """
     if log:
@@ -24,6 +27,7 @@ def add_usr_local_bin_to_path(log=False):
             raise SystemExit(1)
 
 
+@traced
 def arch():
     """ returns the current cpu archictecture """
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
@@ -32,6 +36,7 @@ def arch():
     return result
 
 
+@traced
 def dir_attribs(location, mode=None, owner=None,
                 group=None, recursive=False, use_sudo=False):
     """ cuisine dir_attribs doesn't do sudo, so we implement our own
@@ -58,6 +63,7 @@ def dir_attribs(location, mode=None, owner=None,
     return True
 
 
+@traced
 def dir_ensure(location, recursive=False, mode=None,
                owner=None, group=None, use_sudo=False):
     """ cuisine dir_ensure doesn't do sudo, so we implement our own
@@ -93,6 +99,7 @@ def dir_ensure(location, recursive=False, mode=None,
     return True
 
 
+@traced
 def dir_exists(location, use_sudo=False):
     """Tells if there is a remote directory at the given location."""
     with settings(hide('running', 'stdout', 'stderr'), warn_only=True):
@@ -103,6 +110,7 @@ def dir_exists(location, use_sudo=False):
             return not bool(run('test -d %s' % (location)).return_code)
 
 
+@traced
 def disable_env_reset_on_sudo(log=False):
     """ updates /etc/sudoers so that users from %wheel keep their
         environment when executing a sudo call
@@ -117,6 +125,7 @@ def disable_env_reset_on_sudo(log=False):
     return True
 
 
+@traced
 def disable_requiretty_on_sudoers(log=False):
     """ allow sudo calls through ssh without a tty """
     if log:
@@ -128,6 +137,7 @@ def disable_requiretty_on_sudoers(log=False):
     return True
 
 
+@traced
 def disable_requiretty_on_sshd_config(log=False):
     """ allow sudo calls through ssh without a tty """
     if log:
@@ -139,6 +149,7 @@ def disable_requiretty_on_sshd_config(log=False):
     return True
 
 
+@traced
 def disable_selinux():
     """ disables selinux """
 
@@ -158,6 +169,7 @@ def disable_selinux():
         bookshelf2.time_helpers.sleep_for_one_minute()
 
 
+@traced
 def enable_selinux():
     """ disables selinux """
 
@@ -179,6 +191,7 @@ def enable_selinux():
         bookshelf2.time_helpers.sleep_for_one_minute()
 
 
+@traced
 def file_attribs(location,
                  mode=None,
                  owner=None,
@@ -195,6 +208,7 @@ def file_attribs(location,
                        use_sudo=False)
 
 
+@traced
 def os_release():
     """ returns /etc/os-release in a dictionary """
     with settings(hide('warnings', 'running', 'stderr'),
@@ -212,6 +226,7 @@ def os_release():
         return release
 
 
+@traced
 def linux_distribution():
     """ returns the linux distribution in lower case """
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
@@ -220,6 +235,7 @@ def linux_distribution():
         return(data['ID'])
 
 
+@traced
 def lsb_release():
     """ returns /etc/lsb-release in a dictionary """
     with settings(hide('warnings', 'running'), capture=True):
@@ -236,6 +252,7 @@ def lsb_release():
         return _lsb_release
 
 
+@traced
 def reboot():
 
     with settings(warn_only=True, capture=True):
@@ -243,6 +260,7 @@ def reboot():
         bookshelf2.time_helpers.sleep_for_one_minute()
 
 
+@traced
 def restart_service(service, log=False):
     """ restarts a service  """
     with settings():
@@ -257,6 +275,7 @@ def restart_service(service, log=False):
     return True
 
 
+@traced
 def systemd(service, start=True, enabled=True, unmask=False, restart=False):
     """ manipulates systemd services """
 
@@ -280,6 +299,7 @@ def systemd(service, start=True, enabled=True, unmask=False, restart=False):
             sudo('systemctl unmask %s' % service)
 
 
+@traced
 def add_firewalld_service(service, permanent=True):
     """ adds a firewall rule """
 
@@ -294,6 +314,7 @@ def add_firewalld_service(service, permanent=True):
         sudo('systemctl reload firewalld')
 
 
+@traced
 def add_firewalld_port(port, permanent=True):
     """ adds a firewall rule """
 
@@ -309,6 +330,7 @@ def add_firewalld_port(port, permanent=True):
         sudo('systemctl restart firewalld')
 
 
+@traced
 def enable_firewalld_service():
     """ install and enables the firewalld service """
 
@@ -316,6 +338,8 @@ def enable_firewalld_service():
     systemd(service='firewalld', unmask=True)
 
 
+@traced
+@with_timeout(seconds=3600)
 def install_os_updates(distribution, force=False):
     """ installs OS updates """
     if ('centos' in distribution or
@@ -337,12 +361,14 @@ def install_os_updates(distribution, force=False):
                 sudo("apt-get -y upgrade")
 
 
+@traced
 def install_ubuntu_development_tools():
     """ installs development tools """
 
     bookshelf2.pkg.apt_install(packages=['build-essential'])
 
 
+@traced
 def install_centos_development_tools():
     """ installs development tools """
 
@@ -8,8 +8,11 @@ from fabric.contrib.files import (append as file_append,
 from bookshelf.api_v2.os_helpers import install_ubuntu_development_tools
 
 from bookshelf.api_v2.logging_helpers import log_green
+from bookshelf.api_v2.tracing import traced
+from bookshelf.api_v2.watchdog import with_timeout
 
 
+@traced
 def add_epel_yum_repository():
     """
     Install a repository that provides epel packages/updates
@@ -21,6 +24,8 @@ def add_epel_yum_repository():
     yum_install(packages=["epel-release"])
 
 
+@traced
+@with_timeout(seconds=1800)
 def add_zfs_apt_repository():
     """ adds the ZFS repository """
     with settings(hide('warnings', 'running', 'stdout'),
@@ -36,6 +41,7 @@ def add_zfs_apt_repository():
         return True
 
 
+@traced
 def add_zfs_yum_repository():
     """ adds the yum repository for ZFSonLinux """
     ZFS_REPO_PKG = (
@@ -45,6 +51,8 @@ def add_zfs_yum_repository():
     yum_install_from_url('zfs-release', ZFS_REPO_PKG)
 
 
+@traced
+@with_timeout(seconds=1800)
 def apt_install(**kwargs):
     """
         installs a apt package
@@ -56,6 +64,7 @@ def apt_install(**kwargs):
         return True
 
 
+@traced
 def apt_install_from_url(pkg_name, url, log=False):
     """ installs a pkg from a url
         p pkg_name: the name of the package to install
@@ -76,6 +85,7 @@ def apt_install_from_url(pkg_name, url, log=False):
             return True
 
 
+@traced
 def apt_add_repository_from_apt_string(apt_string, apt_file):
     """ adds a new repository file for apt """
 
@@ -93,6 +103,7 @@ def apt_add_repository_from_apt_string(apt_string, apt_file):
             return True
 
 
+@traced
 def apt_add_key(keyid, keyserver='keyserver.ubuntu.com', log=False):
     """ trust a new PGP key related to a apt-repository """
     if log:
@@ -104,6 +115,7 @@ def apt_add_key(keyid, keyserver='keyserver.ubuntu.com', log=False):
     return True
 
 
+@traced
 def enable_apt_repositories(prefix, url, version, repositories):
     """ adds an apt repository """
     with settings(hide('warnings', 'running', 'stdout'),
@@ -121,6 +133,7 @@ def enable_apt_repositories(prefix, url, version, repositories):
             return True
 
 
+@traced
 def install_gem(gem):
     """ install a particular gem """
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
@@ -130,6 +143,7 @@ def install_gem(gem):
             run("gem install %s --no-rdoc --no-ri" % gem).return_code)
 
 
+@traced
 def install_python_module(name):
     """ instals a python module using pip """
 
@@ -140,6 +154,7 @@ def install_python_module(name):
             run('pip --quiet install %s' % name).return_code)
 
 
+@traced
 def install_python_module_locally(name):
     """ instals a python module using pip """
     with settings(hide('everything'),
@@ -150,6 +165,7 @@ def install_python_module_locally(name):
             local('pip --quiet install %s' % name).return_code)
 
 
+@traced
 def install_system_gem(gem):
     """ install a particular gem """
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
@@ -159,6 +175,8 @@ def install_system_gem(gem):
             sudo("gem install %s --no-rdoc --no-ri" % gem).return_code)
 
 
+@traced
+@with_timeout(seconds=3600)
 def install_zfs_from_testing_repository():
     # Enable debugging for ZFS modules
     sudo("echo SPL_DKMS_DISABLE_STRIP=y >> /etc/sysconfig/spl")
@@ -168,6 +186,7 @@ def install_zfs_from_testing_repository():
     sudo("modprobe zfs")
 
 
+@traced
 def is_deb_package_installed(pkg):
     """ checks if a particular deb package is installed """
 
@@ -178,6 +197,7 @@ def is_deb_package_installed(pkg):
         return not bool(result.return_code)
 
 
+@traced
 def is_package_installed(distribution, pkg):
     """ checks if a particular package is installed """
     if ('centos' in distribution or
@@ -190,6 +210,7 @@ def is_package_installed(distribution, pkg):
         return(is_deb_package_installed(pkg))
 
 
+@traced
 def is_rpm_package_installed(pkg):
     """ checks if a particular rpm package is installed """
 
@@ -206,6 +227,8 @@ def is_rpm_package_installed(pkg):
             raise SystemExit()
 
 
+@traced
+@with_timeout(seconds=1800)
 def yum_install(**kwargs):
     """
         installs a yum package
@@ -224,6 +247,7 @@ def yum_install(**kwargs):
                 sudo("yum install -y --quiet %s" % pkg)
 
 
+@traced
 def yum_group_install(**kwargs):
     """ instals a yum group """
     for grp in list(kwargs['groups']):
@@ -238,6 +262,7 @@ def yum_group_install(**kwargs):
             sudo("yum groupinstall -y --quiet '%s'" % grp)
 
 
+@traced
 def yum_install_from_url(pkg_name, url):
     """ installs a pkg from a url
         p pkg_name: the name of the package to install
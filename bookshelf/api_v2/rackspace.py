@@ -5,10 +5,11 @@ import re
 import sys
 from fabric.api import env
 from sys import exit
-from time import sleep
 from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
-from bookshelf.api_v2.time_helpers import sleep_for_one_minute
+from bookshelf.api_v2.time_helpers import sleep, sleep_for_one_minute
 from bookshelf.api_v2.cloud import wait_for_ssh
+from bookshelf.api_v2.metrics import instrument_nova_client
+from bookshelf.api_v2.ratelimit import rate_limit_nova_client
 
 
 def connect_to_rackspace(region,
@@ -19,7 +20,7 @@ def connect_to_rackspace(region,
     pyrax.set_default_region(region)
     pyrax.set_credentials(access_key_id, secret_access_key)
     nova = pyrax.connect_to_cloudservers(region=region)
-    return nova
+    return rate_limit_nova_client(instrument_nova_client(nova))
 
 
 def create_rackspace_image(connection,
@@ -0,0 +1,299 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Client side rate limiting of the cloud API calls made by bookshelf.
+
+Every call made through the connections returned by ``api_v2`` and
+``api_v3`` first takes a token from a bucket shared by all the threads of
+the process for that cloud and region, so that provisioning many instances
+at once doesn't run into the cloud's request quotas. A call that is
+throttled anyway (EC2 ``RequestLimitExceeded``, GCE rate limits, Rackspace
+rate limit 413s and 429s) is retried after a randomly growing delay
+("decorrelated jitter"), and empties its bucket so the other threads back
+off with it.
+
+usage:
+    from bookshelf.api_v2.ratelimit import rate_limiter
+    rate_limiter.configure('ec2', rate=5, burst=20)
+
+Connections are rate limited on top of their ``metrics`` instrumentation,
+so every attempt is counted as a call and every retry as a retry event.
+GCE batch requests go through execute_batch(), as googleapiclient sends
+them without calling the execute() of the requests they hold.
+"""
+
+import random
+import threading
+
+from bookshelf.api_v2.metrics import (
+    InstrumentedHttpRequest,
+    is_throttling_error,
+    is_throttling_response,
+    metrics,
+    record_retry
+)
+from bookshelf.api_v2.time_helpers import sleep, time
+
+# requests per second and burst size of the token buckets of each cloud,
+# below the documented quotas as those are shared with other clients
+DEFAULT_RATES = {
+    'ec2': (10, 50),
+    'gce': (15, 20),
+    'rackspace': (5, 10),
+}
+
+# rounding can leave a refill a hair short of a whole token, a wait too
+# short to move the clock
+_ROUNDING = 1e-9
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, refilled with rate tokens per second up to
+    burst tokens.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        # must be called with self._lock held
+        now = time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """ takes a token, sleeping until one is available """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1 - _ROUNDING:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def drain(self):
+        """ empties the bucket, so everyone sharing it slows down """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+
+def decorrelated_jitter(base, cap):
+    """
+    yields retry delays growing randomly from base up to cap, as in
+    https://www.awsarchitectureblog.com/2015/03/backoff.html
+    """
+    delay = base
+    while True:
+        delay = min(cap, random.uniform(base, delay * 3))
+        yield delay
+
+
+class RateLimiter(object):
+    """
+    The token buckets of each cloud and region, and the retry policy for
+    throttled calls.
+
+    params:
+        dict rates: cloud name to (requests per second, burst size)
+        int max_attempts: attempts of a throttled call before giving up
+        float base_delay, max_delay: bounds of the retry delays, in seconds
+    """
+    def __init__(self, rates=None, max_attempts=8, base_delay=0.5,
+                 max_delay=30):
+        self._rates = dict(DEFAULT_RATES, **(rates or {}))
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def configure(self, cloud, rate, burst):
+        """ sets the rate of the buckets of cloud """
+        with self._lock:
+            self._rates[cloud] = (rate, burst)
+            for key in [k for k in self._buckets if k[0] == cloud]:
+                del self._buckets[key]
+
+    def bucket(self, cloud, region=None):
+        """ returns the TokenBucket shared by the calls to a cloud region """
+        with self._lock:
+            key = (cloud, region)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(*self._rates[cloud])
+            return self._buckets[key]
+
+    def call(self, cloud, region, operation, function,
+             throttled=is_throttling_error):
+        """
+        calls function once a token is available, retrying it while the
+        exceptions it raises are throttling errors.
+
+        params:
+            string operation: the metrics operation name, for retry events
+            function throttled: predicate on the exceptions of function
+        returns:
+            the result of function
+        """
+        bucket = self.bucket(cloud, region)
+        delays = decorrelated_jitter(self.base_delay, self.max_delay)
+        attempt = 1
+        while True:
+            bucket.acquire()
+            try:
+                return function()
+            except Exception as e:
+                if attempt >= self.max_attempts or not throttled(e):
+                    raise
+            bucket.drain()
+            delay = next(delays)
+            record_retry(operation, region=region, attempt=attempt,
+                         delay=delay)
+            sleep(delay)
+            attempt += 1
+
+
+rate_limiter = RateLimiter()
+
+
+def rate_limit_ec2_connection(connection, limiter=None):
+    """
+    rate limits every request made through a boto ec2 connection.
+
+    boto retries the 5xx responses itself before raising an error, throttled
+    503s included, without the other threads backing off. Throttled
+    responses are raised at once instead, as the connection's ResponseError,
+    so that the limiter retries them; boto still retries the others.
+
+    returns:
+        the same connection object
+    """
+    if not connection or hasattr(connection, '_bookshelf_rate_limited'):
+        return connection
+    make_request = connection.make_request
+    mexe = connection._mexe
+    region = getattr(getattr(connection, 'region', None), 'name', None)
+
+    def mexe_raising_throttled(request, sender=None,
+                               override_num_retries=None,
+                               retry_handler=None):
+        def handle(response, attempt, delay):
+            if is_throttling_response(response):
+                raise connection.ResponseError(
+                    response.status, response.reason, response.read())
+            if retry_handler is not None:
+                return retry_handler(response, attempt, delay)
+
+        return mexe(request, sender, override_num_retries,
+                    retry_handler=handle)
+
+    def rate_limited_make_request(action, *args, **kwargs):
+        return (limiter or rate_limiter).call(
+            'ec2', region, 'ec2.%s' % action,
+            lambda: make_request(action, *args, **kwargs))
+
+    connection._mexe = mexe_raising_throttled
+    connection.make_request = rate_limited_make_request
+    connection._bookshelf_rate_limited = True
+    return connection
+
+
+def rate_limit_nova_client(nova, limiter=None):
+    """
+    rate limits every request made through a pyrax/novaclient connection.
+
+    returns:
+        the same nova client object
+    """
+    if hasattr(nova, '_bookshelf_rate_limited'):
+        return nova
+    client = nova.client
+    request = client.request
+    region = getattr(client, 'region_name', None)
+
+    def rate_limited_request(url, method, **kwargs):
+        return (limiter or rate_limiter).call(
+            'rackspace', region, 'rackspace.%s' % method,
+            lambda: request(url, method, **kwargs))
+
+    client.request = rate_limited_request
+    nova._bookshelf_rate_limited = True
+    return nova
+
+
+class RateLimitedHttpRequest(InstrumentedHttpRequest):
+    """
+    googleapiclient request that is rate limited and recorded in
+    ``metrics``. GCE quotas are per project, so all the requests share one
+    bucket.
+
+    usage:
+        discovery.build('compute', 'v1', credentials=credentials,
+                        requestBuilder=RateLimitedHttpRequest)
+    """
+    def execute(self, *args, **kwargs):
+        execute = super(RateLimitedHttpRequest, self).execute
+        return rate_limiter.call('gce', None, 'gce.%s' % self.methodId,
+                                 lambda: execute(*args, **kwargs))
+
+
+class _ThrottledBatch(Exception):
+    """ the requests of a batch that were throttled, by request id """
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+
+def execute_batch(new_batch, requests, callback, limiter=None):
+    """
+    runs (request id, request) pairs in a googleapiclient batch request,
+    taking a token for each of them. Those that are throttled are retried
+    in a batch of their own.
+
+    params:
+        function new_batch: returns a BatchHttpRequest calling the callback
+            it is given
+        function callback: called with (request id, response, exception)
+            for each request, once it succeeded or failed for good
+    """
+    limiter = limiter or rate_limiter
+    pending = list(requests)
+
+    def attempt():
+        throttled = {}
+
+        def collect(request_id, response, exception):
+            if exception is not None and is_throttling_error(exception):
+                metrics.record_event('throttle', 'gce.batch',
+                                     error=str(exception))
+                throttled[request_id] = exception
+            else:
+                callback(request_id, response, exception)
+
+        # call() took the token of the first request
+        bucket = limiter.bucket('gce')
+        for _ in pending[1:]:
+            bucket.acquire()
+        batch = new_batch(collect)
+        for request_id, request in pending:
+            batch.add(request, request_id=request_id)
+        with metrics.timed('gce.batch'):
+            batch.execute()
+        if throttled:
+            pending[:] = [(request_id, request)
+                          for request_id, request in pending
+                          if request_id in throttled]
+            raise _ThrottledBatch(throttled)
+
+    try:
+        limiter.call('gce', None, 'gce.batch', attempt,
+                     throttled=lambda e: (isinstance(e, _ThrottledBatch) or
+                                          is_throttling_error(e)))
+    except _ThrottledBatch as e:
+        for request_id, error in e.errors.items():
+            callback(request_id, None, error)
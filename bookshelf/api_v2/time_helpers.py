@@ -1,6 +1,105 @@
 # vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
-from time import sleep
+"""
+The clock that every wait in bookshelf goes through.
+
+Polling loops, retries and timeouts call sleep() and time() from here
+rather than from the time module, so tests can swap in a VirtualClock on
+which sleeping returns at once and only moves the clock forward:
+
+    with use_clock(VirtualClock()) as clock:
+        wait_for(probe, ready, 'image', timeout=600)
+    assert sum(clock.sleeps) <= 600
+"""
+import threading
+import time as _time
+from contextlib import contextmanager
+
+
+class Clock(object):
+    """ the wall clock """
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        return event.wait(seconds)
+
+
+class VirtualClock(object):
+    """
+    A clock on which sleeping returns immediately, advancing the time by
+    the seconds slept instead. Thread safe.
+
+    params:
+        float start: the time it starts at
+    """
+    def __init__(self, start=0.0):
+        self._lock = threading.Lock()
+        self._now = float(start)
+        self.sleeps = []
+
+    def time(self):
+        with self._lock:
+            return self._now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self._now += seconds
+
+    def wait(self, event, seconds):
+        """ sleeps unless event is set, returning whether it is """
+        if not event.is_set():
+            self.sleep(seconds)
+        return event.is_set()
+
+    def advance(self, seconds):
+        """ moves the time forward, as things happening elsewhere would """
+        with self._lock:
+            self._now += seconds
+
+
+_clock = Clock()
+
+
+def clock():
+    """ returns the clock in use """
+    return _clock
+
+
+@contextmanager
+def use_clock(new_clock):
+    """ context manager making every wait of the block use new_clock """
+    global _clock
+    previous, _clock = _clock, new_clock
+    try:
+        yield new_clock
+    finally:
+        _clock = previous
+
+
+def time():
+    """ returns the current time of the clock in use, in seconds """
+    return _clock.time()
+
+
+def sleep(seconds):
+    """ sleeps on the clock in use """
+    _clock.sleep(seconds)
+
+
+def wait(event, seconds):
+    """
+    waits on the clock in use for a threading.Event, for at most seconds.
+
+    returns:
+        bool: whether the event is set
+    """
+    return _clock.wait(event, seconds)
+
 
 def sleep_for_one_minute():
     sleep(60)
-
@@ -0,0 +1,195 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Tracing spans for bookshelf helpers and the remote commands they run.
+
+Every helper decorated with ``@traced`` records a span, and every fabric
+run()/sudo() records a child span of the helper that issued it, with the
+host, command, exit code, bytes of output and duration.
+
+usage:
+    from bookshelf.api_v2.tracing import tracer
+    ...
+    tracer.export_chrome_trace('/tmp/bake.json')
+
+The exported file can be loaded in chrome://tracing (or any trace-event
+viewer) to get a flame chart per host.
+
+Setting ``BOOKSHELF_TRACE_FILE`` in the environment exports the chrome trace
+to that path when the process exits.
+"""
+
+import atexit
+import functools
+import itertools
+import json
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import time
+
+from fabric.api import env
+
+from bookshelf.api_v2.command_hooks import add_command_hook
+
+_TRACE_FILE_ENV_VAR = 'BOOKSHELF_TRACE_FILE'
+
+
+class Span(object):
+    """
+    A timed, named section of work.
+
+    :ivar name: name of the helper or the command that was run.
+    :ivar category: 'helper' or 'command'.
+    :ivar attributes: dict of extra information (host, exit_code, ...).
+    :ivar parent_id: span_id of the enclosing span, or None.
+    """
+    def __init__(self, span_id, name, category, parent_id, attributes):
+        self.span_id = span_id
+        self.name = name
+        self.category = category
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread_id = threading.current_thread().ident
+        self.start = time()
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def to_dict(self):
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'category': self.category,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+class Tracer(object):
+    """
+    Collects spans, keeping a per thread stack of open spans so that
+    nested spans know their parent. Only the newest max_spans finished
+    spans are kept, so long fleet runs don't grow without bound.
+    """
+    def __init__(self, max_spans=10000):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._spans = deque(maxlen=max_spans)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current_span(self):
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        return None
+
+    @contextmanager
+    def span(self, name, category='helper', **attributes):
+        """ context manager that records a span around the block """
+        stack = self._stack()
+        parent = stack[-1].span_id if stack else None
+        with self._lock:
+            span = Span(next(self._ids), name, category, parent, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes.setdefault('error', repr(e))
+            raise
+        finally:
+            span.end = time()
+            stack.pop()
+            with self._lock:
+                self._spans.append(span)
+
+    def spans(self):
+        """ returns the finished spans in the order they started """
+        with self._lock:
+            return sorted(self._spans, key=lambda s: (s.start, s.span_id))
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+
+    def to_chrome_trace(self):
+        """
+        returns the spans as a chrome trace-event dictionary, with one
+        process row per host.
+        """
+        hosts = {}
+        events = []
+        for span in self.spans():
+            host = span.attributes.get('host') or 'local'
+            if host not in hosts:
+                hosts[host] = len(hosts) + 1
+                events.append({'name': 'process_name', 'ph': 'M',
+                               'pid': hosts[host],
+                               'args': {'name': host}})
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.start * 1000000),
+                'dur': int(span.duration * 1000000),
+                'pid': hosts[host],
+                'tid': span.thread_id,
+                'args': span.attributes,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        """ writes the spans as chrome trace-event json to path """
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def export_json(self, path):
+        """ writes the spans as a flat json list to path """
+        with open(path, 'w') as f:
+            json.dump([span.to_dict() for span in self.spans()], f,
+                      indent=2, sort_keys=True)
+
+
+tracer = Tracer()
+
+
+def traced(func):
+    """ decorator that records a span for every call of a helper """
+    name = '%s.%s' % (func.__module__.split('.')[-1], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracer.span(name, host=env.host_string):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _trace_remote_command(run_command, command, options):
+    """ command hook that records a span for a run() or sudo() """
+    with tracer.span(command, category='command',
+                     host=env.host_string,
+                     command=command,
+                     sudo=options['sudo']) as span:
+        result = run_command(command, options)
+        span.attributes['exit_code'] = result.return_code
+        span.attributes['output_bytes'] = (
+            len(result) + len(getattr(result, 'stderr', '') or ''))
+        return result
+
+
+add_command_hook(_trace_remote_command)
+
+if os.environ.get(_TRACE_FILE_ENV_VAR):
+    atexit.register(tracer.export_chrome_trace,
+                    os.environ[_TRACE_FILE_ENV_VAR])
@@ -8,8 +8,10 @@ from bookshelf.api_v2.os_helpers import (install_ubuntu_development_tools,
 from bookshelf.api_v2.pkg import (apt_add_repository_from_apt_string,
                                   apt_install_from_url,
                                   apt_install)
+from bookshelf.api_v2.tracing import traced
 
 
+@traced
 def install_virtualbox(distribution, force_setup=False):
     """ install virtualbox """
 
@@ -52,6 +54,7 @@ def install_virtualbox(distribution, force_setup=False):
                  'Oracle_VM_VirtualBox_Extension_Pack-5.0.4-102546.vbox-extpack') # noqa
 
 
+@traced
 def install_vagrant(distribution, version):
     """ install vagrant """
 
@@ -61,6 +64,7 @@ def install_vagrant(distribution, version):
                              'vagrant_%s_x86_64.deb' % version)
 
 
+@traced
 def install_vagrant_plugin(plugin, use_sudo=False):
     """ install vagrant plugin """
 
@@ -75,6 +79,7 @@ def install_vagrant_plugin(plugin, use_sudo=False):
                 run(cmd)
 
 
+@traced
 def is_vagrant_plugin_installed(plugin, use_sudo=False):
     """ checks if vagrant plugin is installed """
 
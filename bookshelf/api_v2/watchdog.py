@@ -0,0 +1,248 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Timeouts for remote commands, so that a hung ``yum -y update``, an apt-get
+waiting on a lock or a prompt nobody answers doesn't stall a whole fleet run.
+
+Within command_timeout(), or in a helper decorated with with_timeout(),
+every run() and sudo() is watched:
+
+    * seconds: the command is run under coreutils' ``timeout``, and its
+      whole process group is killed once it runs for longer than that
+    * inactivity: the command is killed once it printed nothing for that
+      long. Quiet commands, such as ``yum --quiet``, shouldn't use this
+
+A command killed by the watchdog raises RemoteCommandTimeout, whatever
+warn_only says, and is recorded in ``metrics`` as a 'timeout' event.
+
+usage:
+    with command_timeout(seconds=3600, inactivity=600):
+        sudo('yum -y update')
+
+Commands are run with ``timeout --foreground``, so that with a pty they
+stay in the foreground process group and can still read from the terminal.
+They are run by a non-login ``bash -c`` of their own, with the cd(),
+prefix(), path() and shell_env() of the block applied within it: shell
+functions and variables set by prefix() are seen, but those that the login
+profile sets without exporting are not.
+
+The timeouts are kept in fabric's env as ``bookshelf_command_timeout`` and
+``bookshelf_inactivity_timeout``, so they can also be given with settings().
+"""
+
+import sys
+import threading
+from functools import wraps
+from pipes import quote
+from uuid import uuid4
+
+from fabric.api import env, hide, settings, show
+from fabric.exceptions import CommandTimeout
+from fabric.operations import _prefix_commands, _prefix_env_vars
+from fabric.state import connections, output
+
+from bookshelf.api_v2.command_hooks import add_command_hook, command_result
+from bookshelf.api_v2.logging_helpers import log_red
+from bookshelf.api_v2.metrics import metrics
+from bookshelf.api_v2.time_helpers import time, wait
+
+# seconds timeout waits after SIGTERM before sending SIGKILL
+_KILL_AFTER = 10
+
+# exit codes of timeout when the command timed out, after SIGTERM or SIGKILL
+_TIMED_OUT = (124, 137)
+
+# seconds on top of the remote timeout after which we give up on the
+# connection too, in case the host itself hung
+_GRACE = 60
+
+# seconds between checks of the output inactivity
+_POLL_INTERVAL = 1
+
+_MARKER = 'bookshelf-watchdog-'
+
+
+class RemoteCommandTimeout(Exception):
+    """
+    Raised when the watchdog killed a remote command.
+
+    params:
+        string host: the fabric host string
+        string command: the command as given to run() or sudo()
+        string reason: 'timeout' or 'inactivity'
+        float seconds: the timeout that was exceeded
+        string output: what the command printed before it was killed
+    """
+    def __init__(self, host, command, reason, seconds, output):
+        Exception.__init__(self, host, command, reason, seconds, output)
+        self.host = host
+        self.command = command
+        self.reason = reason
+        self.seconds = seconds
+        self.output = output
+
+    def __str__(self):
+        if self.reason == 'inactivity':
+            what = 'printed nothing for {}s'.format(self.seconds)
+        else:
+            what = 'ran for more than {}s'.format(self.seconds)
+        return '[{}] killed {!r}, which {}'.format(self.host, self.command,
+                                                  what)
+
+
+class _ActivityStream(object):
+    """ a stream noting the time of the last write, and maybe hiding it """
+
+    def __init__(self, stream, printing):
+        self._stream = stream
+        self._printing = printing
+        self.last_write = time()
+
+    def write(self, data):
+        self.last_write = time()
+        if self._printing:
+            self._stream.write(data)
+
+    def flush(self):
+        if self._printing:
+            self._stream.flush()
+
+
+def _remote_command(command, seconds, marker):
+    # what _run_command does with cd(), prefix() and path(), within the
+    # shell running the command. The marker, as bash's $0, lets _kill find
+    # its process group.
+    command = _prefix_env_vars(_prefix_commands(command, 'remote'))
+    remote = 'timeout --foreground --kill-after={} {} bash -c {} {}'.format(
+        _KILL_AFTER, int(seconds or 0), quote(command), marker)
+    if not seconds:
+        return remote
+    # --foreground only times out the command itself, the rest of its
+    # process group goes afterwards, but for the shell reporting the status
+    return (remote + '; status=$?; '
+            'if [ $status -eq 124 ] || [ $status -eq 137 ]; then '
+            "trap '' TERM; kill -TERM 0; fi; exit $status")
+
+
+def _kill(host_string, marker, use_sudo):
+    """
+    kills the process group of the command with marker on the host, over a
+    new channel
+    """
+    if host_string not in connections:
+        return
+    # the brackets keep pgrep from matching the shell running it. The
+    # newest match is the bash running the command, whose group is that of
+    # the command even where sudo gave it a session of its own.
+    command = ("pgid=$(ps -o pgid= -p \"$(pgrep -n -f '[{}]{}')\") && "
+               "pkill -TERM -g $pgid").format(marker[0], marker[1:])
+    if use_sudo:
+        command = 'sudo -n sh -c ' + quote(command)
+    try:
+        _, stdout, _ = connections[host_string].exec_command(command,
+                                                             timeout=30)
+        stdout.channel.recv_exit_status()
+    except Exception as e:
+        log_red('[{}] could not kill {}: {}'.format(host_string, marker, e))
+
+
+def _watch(streams, inactivity, finished, hung, kill):
+    while not wait(finished, _POLL_INTERVAL):
+        if time() - max(s.last_write for s in streams) > inactivity:
+            hung.set()
+            kill()
+            return
+
+
+def _watchdog(run_command, command, options):
+    seconds = env.get('bookshelf_command_timeout')
+    inactivity = env.get('bookshelf_inactivity_timeout')
+    if not seconds and not inactivity:
+        return run_command(command, options)
+
+    host = env.host_string
+    marker = _MARKER + uuid4().hex
+    streams = (_ActivityStream(options['stdout'] or sys.stdout,
+                               output.stdout),
+               _ActivityStream(options['stderr'] or sys.stderr,
+                               output.stderr))
+    # failures are raised below, once we know whether we caused them
+    watched = dict(options, warn_only=True, stdout=streams[0],
+                   stderr=streams[1])
+    if seconds:
+        watched['timeout'] = seconds + _KILL_AFTER + _GRACE
+
+    def kill():
+        _kill(host, marker, options['sudo'])
+
+    finished = threading.Event()
+    hung = threading.Event()
+    watcher = None
+    if inactivity:
+        watcher = threading.Thread(
+            target=_watch, args=(streams, inactivity, finished, hung, kill))
+        watcher.daemon = True
+        watcher.start()
+
+    started = time()
+    out = None
+    try:
+        # fabric only writes the output it shows, the streams hide it again
+        # where it was hidden, so inactivity is seen either way. Failures
+        # are reported below, for the command as given, whose prefixes
+        # _remote_command applied already.
+        remote = _remote_command(command, seconds, marker)
+        with settings(show('stdout', 'stderr'), hide('warnings'),
+                      command_prefixes=[], cwd='', path='', shell_env={}):
+            out = run_command(remote, watched)
+    except CommandTimeout:
+        kill()
+    finally:
+        finished.set()
+        if watcher is not None:
+            watcher.join()
+
+    reason = limit = None
+    if hung.is_set():
+        reason, limit = 'inactivity', inactivity
+    elif out is None or (seconds and out.return_code in _TIMED_OUT and
+                         time() - started >= seconds):
+        reason, limit = 'timeout', seconds
+    if reason is not None:
+        metrics.record_event('timeout', command, host=host, reason=reason,
+                             seconds=limit)
+        raise RemoteCommandTimeout(host, command, reason, limit,
+                                   out or '')
+    return command_result(command, options, out, out.stderr,
+                          out.return_code)
+
+
+def command_timeout(seconds=None, inactivity=None):
+    """
+    context manager applying timeouts to the remote commands of the block,
+    each given timeout replacing the one set by an outer block.
+
+    params:
+        int seconds: kill commands running for longer than this
+        int inactivity: kill commands that print nothing for this long
+    """
+    timeouts = {}
+    if seconds is not None:
+        timeouts['bookshelf_command_timeout'] = seconds
+    if inactivity is not None:
+        timeouts['bookshelf_inactivity_timeout'] = inactivity
+    return settings(**timeouts)
+
+
+def with_timeout(seconds=None, inactivity=None):
+    """ decorator running the wrapped helper within command_timeout() """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with command_timeout(seconds, inactivity):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# innermost, so that other hooks such as cassettes see the commands as given
+add_command_hook(_watchdog, innermost=True)
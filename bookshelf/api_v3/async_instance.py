@@ -0,0 +1,375 @@
+"""
+Non-blocking wrappers for the ``ICloudInstanceFactory`` and
+``ICloudInstance`` providers.
+
+The providers spend most of their time sleeping in polling loops, so the
+blocking calls are run on a thread pool and a ``concurrent.futures.Future``
+is returned instead. That lets a single controller drive several clouds at
+the same time, e.g.:
+
+    ec2 = AsyncEC2Instance.create_from_config(ec2_config, distro, region)
+    gce = AsyncGCEInstance.create_from_config(gce_config, distro, zone)
+    old.destroy()
+    images = [f.result().create_image(name) for f in (ec2, gce)]
+"""
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.util import register_after_fork
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from zope.interface import implementer
+
+from bookshelf.api_v2.concurrency import AdaptiveConcurrency
+from bookshelf.api_v2.logging_helpers import log_red
+from bookshelf.api_v3.cloud_instance import (
+    IAsyncCloudInstance, IAsyncCloudInstanceFactory
+)
+
+# the workers are mostly asleep waiting on the clouds, so this can be
+# generous
+_DEFAULT_MAX_WORKERS = 32
+
+_executor_lock = threading.Lock()
+_default_executor = None
+
+#: Limits the lifecycle operations in flight, backing off when the clouds
+#: throttle us. Creating an instance and stopping one take very different
+#: times, so latency isn't a signal here.
+lifecycle_concurrency = AdaptiveConcurrency(
+    'api_v3.lifecycle', initial=8, maximum=_DEFAULT_MAX_WORKERS,
+    latency_tolerance=None)
+
+
+def get_default_executor():
+    """ returns the thread pool shared by the async wrappers """
+    global _default_executor
+    with _executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(
+                max_workers=_DEFAULT_MAX_WORKERS)
+        return _default_executor
+
+
+def submit(function, *args, **kwargs):
+    """ runs function in the background on the shared thread pool """
+    return get_default_executor().submit(function, *args, **kwargs)
+
+
+@contextmanager
+def private_executor(max_workers):
+    """
+    context manager giving a thread pool of its own, for fanning out the
+    work of an operation that may itself run on the shared pool: waiting
+    there for work queued on the same pool can starve it.
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, _DEFAULT_MAX_WORKERS)))
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+
+
+def completed_results(futures):
+    """
+    Waits for futures and returns their results, logging and dropping the
+    ones that failed.
+    """
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            log_red("{}".format(e))
+    return results
+
+
+class _LifecycleQueue(object):
+    """
+    Runs functions on a thread pool as operations of lifecycle_concurrency.
+
+    Operations over the limit wait in this queue rather than on a pool
+    worker, and each operation that ends starts the next ones, so waiting
+    operations never take the workers the running ones need.
+    """
+    def __init__(self, controller):
+        self._controller = controller
+        self._lock = threading.Lock()
+        self._pending = deque()
+
+    def run(self, executor, future, function, *args):
+        """ runs function(*args) as soon as the limit allows, into future """
+        with self._lock:
+            self._pending.append((executor, future, function, args))
+        self._start_pending()
+
+    def _start_pending(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                started = self._controller.try_acquire()
+                if started is None:
+                    return
+                executor, future, function, args = self._pending.popleft()
+            executor.submit(self._run, started, future, function, args)
+
+    def _run(self, started, future, function, args):
+        try:
+            if not future.set_running_or_notify_cancel():
+                self._controller.release(started, failed=True)
+                return
+            try:
+                with self._controller.operation(started):
+                    result = function(*args)
+            except BaseException:
+                future.set_exception_info(*sys.exc_info()[1:])
+            else:
+                future.set_result(result)
+        finally:
+            self._start_pending()
+
+
+_lifecycle_queue = _LifecycleQueue(lifecycle_concurrency)
+
+
+def _after_fork(queue):
+    """
+    The threads of the pool aren't copied into a process started by
+    multiprocessing, so it starts a pool and a queue of its own.
+    """
+    global _executor_lock, _default_executor
+    _executor_lock = threading.Lock()
+    _default_executor = None
+    queue.__init__(queue._controller)
+
+
+register_after_fork(_lifecycle_queue, _after_fork)
+
+
+def _when_done(futures, callback):
+    """
+    calls callback once all futures are done, from the thread finishing the
+    last one, or right away if they all are.
+    """
+    futures = [future for future in futures if future is not None]
+    if not futures:
+        callback()
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def _run_after(futures, executor, function, *args):
+    """
+    returns a future for function(*args), run as a lifecycle operation once
+    all futures are done, whether they failed or not.
+    """
+    future = Future()
+    _when_done(futures, lambda: _lifecycle_queue.run(executor, future,
+                                                     function, *args))
+    return future
+
+
+class LazyReadinessMixin(object):
+    """
+    Mixin for ``ICloudInstance`` providers that can hand out an instance
+    object before the underlying instance is booted and reachable.
+
+    ``_start_in_background`` runs the slow start up on the shared thread
+    pool. The first call to ``wait_until_ready`` blocks until it is done and
+    passes its result to ``_became_ready``; later calls return at once.
+    Errors raised by the start up are re-raised by every call.
+
+    The start up function is given an ``on_started`` keyword argument, to call
+    once the cloud accepted to start the instance. That is all
+    ``wait_until_started`` waits for, before stopping or destroying it.
+    """
+    _ready = None
+    _started = None
+
+    def _start_in_background(self, function, *args):
+        self._ready_lock = threading.Lock()
+        self._started = Future()
+        self._started.set_running_or_notify_cancel()
+
+        def start():
+            try:
+                return function(*args, on_started=self._set_started)
+            finally:
+                self._set_started()
+        self._ready = submit(start)
+
+    def _set_started(self):
+        with self._ready_lock:
+            if not self._started.done():
+                self._started.set_result(None)
+
+    def _became_ready(self, result):
+        pass
+
+    def wait_until_ready(self):
+        ready = self._ready
+        if ready is None:
+            return
+        result = ready.result()
+        with self._ready_lock:
+            if self._ready is ready:
+                self._ready = None
+                self._became_ready(result)
+
+    def wait_until_started(self):
+        """
+        Waits until the cloud started the instance, or failed to, but not
+        for it to be reachable. Doesn't raise the errors of the start up, so
+        that an instance that failed to start can still be destroyed.
+        """
+        if self._started is not None:
+            self._started.result()
+
+
+@implementer(IAsyncCloudInstance)
+class AsyncCloudInstance(object):
+    """
+    Wraps an ``ICloudInstance`` provider so that its lifecycle methods
+    return futures.
+
+    Operations on the same instance are run in the order they were
+    requested, a ``destroy()`` issued right after a ``create_image()`` only
+    starts once the image is done. Successive live images are the exception,
+    they run at the same time.
+
+    :ivar instance: the wrapped ``ICloudInstance`` provider.
+    """
+    def __init__(self, instance, executor=None):
+        self.instance = instance
+        self._executor = executor or get_default_executor()
+        self._lock = threading.Lock()
+        # the futures the next operation has to wait for, and those the
+        # current run of concurrent operations started after
+        self._previous = []
+        self._before_concurrent = None
+
+    def _submit(self, function, *args):
+        return self._submit_after(False, function, *args)
+
+    def _start_up(self, until_ready=True):
+        # the background start up of a lazily restored instance, which the
+        # operations are chained on rather than waiting for it on a worker
+        if until_ready:
+            return getattr(self.instance, '_ready', None)
+        return getattr(self.instance, '_started', None)
+
+    def _submit_after(self, concurrent, function, *args, **kwargs):
+        until_ready = kwargs.pop('until_ready', True)
+        with self._lock:
+            joining = concurrent and self._before_concurrent is not None
+            if joining:
+                previous = self._before_concurrent
+            else:
+                previous = self._previous
+
+            future = _run_after(
+                previous + [self._start_up(until_ready)], self._executor,
+                function, *args)
+            if joining:
+                self._previous.append(future)
+            else:
+                self._previous = [future]
+            self._before_concurrent = previous if concurrent else None
+            return future
+
+    @property
+    def cloud_type(self):
+        return self.instance.cloud_type
+
+    @property
+    def username(self):
+        return self.instance.username
+
+    @property
+    def key_filename(self):
+        return self.instance.key_filename
+
+    @property
+    def ip_address(self):
+        return self.instance.ip_address
+
+    @property
+    def distro(self):
+        return self.instance.distro
+
+    @property
+    def region(self):
+        return self.instance.region
+
+    @property
+    def image_basename(self):
+        return self.instance.image_basename
+
+    def create_image(self, image_name, labels=None, live=False):
+        return self._submit_after(live, self.instance.create_image,
+                                  image_name, labels, live)
+
+    def delete_image(self, image_name):
+        return self._submit(self.instance.delete_image, image_name)
+
+    def destroy(self):
+        return self._submit_after(False, self.instance.destroy,
+                                  until_ready=False)
+
+    def down(self):
+        return self._submit_after(False, self.instance.down,
+                                  until_ready=False)
+
+    def wait_until_ready(self):
+        return self._submit(self.instance.wait_until_ready)
+
+    def get_state(self):
+        return self.instance.get_state()
+
+
+@implementer(IAsyncCloudInstanceFactory)
+class AsyncCloudInstanceFactory(object):
+    """
+    Wraps an ``ICloudInstanceFactory`` provider so that creating or
+    restoring instances returns a future for an ``AsyncCloudInstance``.
+
+    :ivar factory: the wrapped ``ICloudInstanceFactory`` provider.
+    """
+    def __init__(self, factory, executor=None):
+        self.factory = factory
+        self._executor = executor
+
+    @property
+    def executor(self):
+        return self._executor or get_default_executor()
+
+    def _wrap(self, function, *args):
+        def run():
+            return AsyncCloudInstance(function(*args),
+                                      executor=self._executor)
+        return _run_after([], self.executor, run)
+
+    def create_from_config(self, config, distro, region):
+        return self._wrap(self.factory.create_from_config,
+                          config, distro, region)
+
+    def create_from_saved_state(self, config, saved_state):
+        return self._wrap(self.factory.create_from_saved_state,
+                          config, saved_state)
+
+    def destroy_all(self, config, saved_states):
+        return _run_after([], self.executor, self.factory.destroy_all,
+                          config, saved_states)
@@ -1,5 +1,9 @@
+import re
+from datetime import datetime, timedelta
+
 from zope.interface import Interface, Attribute
 from flufl.enum import Enum
+from pyrsistent import PClass, field, pmap, pvector
 
 
 class Distribution(Enum):
@@ -15,6 +19,56 @@ class Distribution(Enum):
     UBUNTU1604 = u"ubuntu1604"
 
 
+_TIMESTAMP_OFFSET = re.compile(r'([+-])(\d\d):?(\d\d)$')
+
+
+def parse_timestamp(timestamp):
+    """
+    Parses the ISO 8601 timestamps returned by the cloud apis, e.g.
+    2016-05-01T12:00:00.000Z or 2016-05-01T05:00:00.000-07:00.
+
+    :return datetime: the naive UTC time.
+    """
+    parsed = datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+    offset = _TIMESTAMP_OFFSET.search(timestamp[19:])
+    if offset:
+        sign, hours, minutes = offset.groups()
+        delta = timedelta(hours=int(hours), minutes=int(minutes))
+        parsed = parsed - delta if sign == '+' else parsed + delta
+    return parsed
+
+
+class ImageRecord(PClass):
+    """
+    An image as listed by ``ICloudInstanceFactory.iter_images``.
+
+    :ivar image_id: the identifier to pass to the other image methods.
+    :ivar datetime created: the creation time, in UTC.
+    :ivar int size_bytes: the storage used by the image, 0 when unknown.
+    :ivar snapshot_ids: the snapshots backing the image, deleted with it.
+    :ivar labels: the labels set by ``ICloudInstance.create_image``.
+    """
+    image_id = field(type=unicode, mandatory=True, factory=unicode)
+    name = field(type=unicode, mandatory=True, factory=unicode)
+    region = field(type=unicode, mandatory=True, factory=unicode)
+    created = field(type=datetime, mandatory=True)
+    size_bytes = field(type=(int, long), initial=0)
+    snapshot_ids = field(initial=pvector(), factory=pvector)
+    labels = field(initial=pmap(), factory=pmap)
+
+    def matches(self, name_prefix=None, created_after=None,
+                created_before=None):
+        """ checks the filters of ``ICloudInstanceFactory.iter_images`` """
+        return ((name_prefix is None or self.name.startswith(name_prefix)) and
+                (created_after is None or self.created > created_after) and
+                (created_before is None or self.created < created_before))
+
+
+#: Label set by image builds on their images, holding the fingerprint of the
+#: recipe the image was built from.
+RECIPE_LABEL = u"bookshelf-recipe"
+
+
 class ICloudInstanceFactory(Interface):
     """
     Interface for an object that can create cloud instances either
@@ -52,10 +106,98 @@ class ICloudInstanceFactory(Interface):
             instance.
 
         :return: An :class:`ICloudInstance` provider loaded from the
-            saved_state.
+            saved_state. The provider is returned as soon as possible, the
+            instance may still be booting; see
+            ``ICloudInstance.wait_until_ready``.
         """
         pass
 
+    def config_for_image(config, image_id, image_name):
+        """
+        Returns a copy of config that creates instances from an image made
+        by ``ICloudInstance.create_image`` rather than from the usual base
+        image.
+
+        :param dict config: the configuration to copy.
+        :param unicode image_id: the identifier returned by ``create_image``.
+        :param unicode image_name: the name passed to ``create_image``.
+
+        :return dict: the new configuration.
+        """
+
+    def find_image(config, region, labels):
+        """
+        Looks up the images created with ``ICloudInstance.create_image``
+        carrying all the given labels.
+
+        :param dict config: the configuration, for the credentials.
+        :param unicode region: the region to look in.
+        :param dict labels: label names to the values they must have.
+
+        :return: the identifier of the newest matching image that is ready
+            for use, or None if there isn't any.
+        """
+
+    def destroy_all(config, saved_states):
+        """
+        Destroys many instances at once, as ``ICloudInstance.destroy`` would,
+        and returns once they are all gone. Instances are terminated with as
+        few calls as the cloud allows, without stopping them first, and
+        their disks are deleted concurrently.
+
+        :param dict config: the configuration, for the credentials.
+        :param list saved_states: the states of the instances, as returned
+            by ``ICloudInstance.get_state``.
+        """
+
+    def iter_images(config, region, name_prefix=None, created_after=None,
+                    created_before=None):
+        """
+        Lists the images owned by the account, as opposed to the public
+        base images. Pages are fetched as the records are consumed, and the
+        filters are applied by the cloud where its api allows it.
+
+        :param dict config: the configuration, for the credentials.
+        :param unicode region: the region to list.
+        :param unicode name_prefix: only list images whose name starts with
+            this.
+        :param datetime created_after: only list images created after this
+            UTC time.
+        :param datetime created_before: only list images created before this
+            UTC time.
+
+        :return: an iterator of :class:`ImageRecord` objects, in no
+            particular order.
+        """
+
+    def delete_images(config, region, images):
+        """
+        Deletes images and the snapshots behind them, concurrently or in
+        batched requests where the cloud supports it.
+
+        :param dict config: the configuration, for the credentials.
+        :param unicode region: the region the images are in.
+        :param list images: :class:`ImageRecord` objects from
+            ``iter_images``.
+
+        :return list: the :class:`ImageRecord` objects of the images that
+            were deleted; failures are logged and skipped.
+        """
+
+    def copy_image(config, region, image_id, regions):
+        """
+        Makes an image available in other regions, copying it where the
+        cloud needs a copy per region. Copies are made concurrently and the
+        call returns once they are all ready.
+
+        :param dict config: the configuration, for the credentials.
+        :param unicode region: the region the image was created in.
+        :param unicode image_id: the identifier of the image.
+        :param list regions: the regions to make the image available in.
+
+        :return dict: each of regions to the identifier of the image there.
+        """
+
 
 class ICloudInstance(Interface):
     """
@@ -83,12 +225,22 @@ class ICloudInstance(Interface):
         "The basename for the image. The final name will look like"
         "image_basename-YYYYMMDDHHMMSS")
 
-    def create_image(image_name):
+    def create_image(image_name, labels=None, live=False):
         """
         Creates an image from the boot disk of the instance, and leaves the
         instance in an up (booted) state.
 
         :param unicode image_name: The name of the image to create.
+        :param dict labels: Names and values of labels to attach to the
+            image (EC2 tags, GCE labels, Rackspace metadata), so it can be
+            found again with ``ICloudInstanceFactory.find_image``. Names and
+            values should be lowercase letters, digits and dashes to suit
+            every cloud.
+        :param bool live: Image a snapshot of the disk taken while the
+            instance keeps running (no reboot on EC2, no shutdown on GCE).
+            Several live images of one instance can be made at the same
+            time. Writes that aren't flushed to disk yet may be missing from
+            the image, so sync first.
 
         :returns: The unique identifier of the image.
         """
@@ -117,6 +269,15 @@ class ICloudInstance(Interface):
         started again.
         """
 
+    def wait_until_ready():
+        """
+        Blocks until the instance is running and reachable over ssh.
+
+        Accessing ``ip_address`` and the lifecycle methods that need a
+        running instance call this implicitly, so it only needs to be called
+        directly to surface start up errors early.
+        """
+
     def get_state():
         """
         Serializes this instance to a dictionary that can be passed to
@@ -127,3 +288,98 @@ class ICloudInstance(Interface):
         :returns dict: A simple dictionary of plain old data that can be
             serialized using the JSON library.
         """
+
+
+class IAsyncCloudInstanceFactory(Interface):
+    """
+    Non-blocking variant of :class:`ICloudInstanceFactory`. Every method
+    returns immediately with a ``concurrent.futures.Future`` while the
+    (slow) cloud operations run in the background.
+    """
+
+    def create_from_config(config, distro, region):
+        """
+        Same as ``ICloudInstanceFactory.create_from_config``.
+
+        :return: A ``Future`` that resolves to an
+            :class:`IAsyncCloudInstance` provider.
+        """
+
+    def create_from_saved_state(config, saved_state):
+        """
+        Same as ``ICloudInstanceFactory.create_from_saved_state``.
+
+        :return: A ``Future`` that resolves to an
+            :class:`IAsyncCloudInstance` provider.
+        """
+
+    def destroy_all(config, saved_states):
+        """
+        Same as ``ICloudInstanceFactory.destroy_all``.
+
+        :return: A ``Future`` that resolves once all the instances are gone.
+        """
+
+
+class IAsyncCloudInstance(Interface):
+    """
+    Non-blocking variant of :class:`ICloudInstance`. The lifecycle methods
+    return a ``concurrent.futures.Future`` for their result, operations on
+    one instance are run in the order they were requested.
+    """
+    instance = Attribute(
+        """The wrapped, blocking :class:`ICloudInstance` provider.""")
+
+    cloud_type = Attribute(
+        """The name of the cloud this instance comes from.""")
+
+    username = Attribute(
+        """The username to use to log into the instance.""")
+
+    key_filename = Attribute(
+        """The filename of the private key to use to log into the instance.""")
+
+    ip_address = Attribute(
+        """Externally accessable IP address for the instance""")
+
+    distro = Attribute(
+        """The distribution on the instance.""")
+
+    region = Attribute("""The region the instance is in.""")
+
+    image_basename = Attribute(
+        "The basename for the image.")
+
+    def create_image(image_name, labels=None, live=False):
+        """
+        Live images of the instance are made concurrently with each other,
+        but still after the operations requested before them and before the
+        ones requested after them.
+
+        :returns: A ``Future`` for the unique identifier of the image.
+        """
+
+    def delete_image(image_name):
+        """
+        :returns: A ``Future`` that resolves once the image is deleted.
+        """
+
+    def destroy():
+        """
+        :returns: A ``Future`` that resolves once the instance is destroyed.
+        """
+
+    def down():
+        """
+        :returns: A ``Future`` that resolves once the instance is stopped.
+        """
+
+    def wait_until_ready():
+        """
+        :returns: A ``Future`` that resolves once the instance is reachable.
+        """
+
+    def get_state():
+        """
+        Same as ``ICloudInstance.get_state``, this does not block.
+        """
@@ -1,17 +1,28 @@
 
-from time import sleep
+import threading
+from contextlib import contextmanager
 
 import boto.ec2
+from boto.exception import EC2ResponseError
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, EBSBlockDeviceType
 from pyrsistent import PClass, field, pmap, PMap, pvector, PVector
 from zope.interface import implementer, provider
 
 from bookshelf.api_v3.cloud_instance import (
-    ICloudInstance, ICloudInstanceFactory, Distribution
+    ICloudInstance, ICloudInstanceFactory, Distribution, ImageRecord,
+    parse_timestamp
 )
 
 from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
 from bookshelf.api_v2.cloud import wait_for_ssh
+from bookshelf.api_v3.async_instance import (
+    AsyncCloudInstanceFactory, LazyReadinessMixin, completed_results,
+    private_executor
+)
+from bookshelf.api_v2.metrics import instrument_ec2_connection, record_retry
+from bookshelf.api_v2.ratelimit import rate_limit_ec2_connection
+from bookshelf.api_v2.time_helpers import sleep, time
+from bookshelf.api_v3.waiter import WaitTimeout, wait_for, wait_for_all
 
 
 class EC2State(PClass):
@@ -23,6 +34,12 @@ class EC2State(PClass):
     region = field(type=unicode, mandatory=True, factory=unicode)
     distro = field(mandatory=True, factory=Distribution,
                    serializer=lambda _, x: x.value)
+    # how the instance was last stopped (u'hibernate' or u'stop') and
+    # started (u'resume' or u'boot'), and how long it took
+    stop_mode = field(type=unicode, initial=u'', factory=unicode)
+    stop_seconds = field(type=(float, type(None)), initial=None)
+    start_mode = field(type=unicode, initial=u'', factory=unicode)
+    start_seconds = field(type=(float, type(None)), initial=None)
 
 
 class EC2Credentials(PClass):
@@ -60,6 +77,178 @@ class EC2Configuration(PClass):
     disk_size = field(type=int, mandatory=True, factory=int)
     security_groups = field(type=PVector, mandatory=True,
                             factory=_parse_unicode_pvector)
+    # hibernate instead of stopping on down(), where the instance supports
+    # it; its root volume must be encrypted and large enough for its RAM
+    hibernate = field(type=bool, initial=False)
+
+
+def _image_record(image, region):
+    """ returns the ImageRecord for a boto image """
+    devices = image.block_device_mapping.values()
+    return ImageRecord(
+        image_id=image.id,
+        name=image.name or u'',
+        region=region,
+        created=parse_timestamp(image.creationDate),
+        size_bytes=sum(device.size or 0 for device in devices) * 1024 ** 3,
+        snapshot_ids=[device.snapshot_id for device in devices
+                      if device.snapshot_id],
+        labels=image.tags,
+    )
+
+
+def _iter_images(connection, region, name_prefix=None, created_after=None,
+                 created_before=None):
+    """
+    The name prefix is matched by ec2, which has no filter on creation
+    dates. DescribeImages isn't paged, so there is a single request.
+    """
+    filters = {}
+    if name_prefix:
+        filters['name'] = name_prefix + '*'
+    for image in connection.get_all_images(owners=['self'], filters=filters):
+        record = _image_record(image, region)
+        if record.matches(created_after=created_after,
+                          created_before=created_before):
+            yield record
+
+
+def _delete_volumes(connection, volume_ids):
+    """
+    Deletes EBS volumes, retrying the ones still being detached every
+    round. Failures are logged, as for the other volumes.
+    """
+    def attempt(pending):
+        deleted = {}
+        for volume_id in pending:
+            try:
+                connection.delete_volume(volume_id)
+            except EC2ResponseError as e:
+                if e.error_code == 'VolumeInUse':
+                    record_retry('ec2.DeleteVolume', volume_id=volume_id)
+                    deleted[volume_id] = False
+                    continue
+                # InvalidVolume.NotFound: deleted along with its instance
+                if e.error_code != 'InvalidVolume.NotFound':
+                    log_red('could not delete EBS volume {}: {}'.format(
+                        volume_id, e))
+            deleted[volume_id] = True
+        return deleted
+
+    try:
+        wait_for_all(attempt, volume_ids, bool,
+                     'detaching of {} EBS volumes'.format(len(volume_ids)),
+                     timeout=300, interval=5, max_interval=15)
+    except WaitTimeout as e:
+        log_red('{}'.format(e))
+
+
+def _destroy_instances(connection, instance_ids):
+    """
+    Terminates instances of a region with a single call, waits for them all
+    with one describe call per round, then deletes their volumes, all of
+    them every round.
+    """
+    volumes = connection.get_all_volumes(
+        filters={'attachment.instance-id': instance_ids}
+    )
+    log_yellow('destroying {} instances ...'.format(len(instance_ids)))
+    connection.terminate_instances(instance_ids=instance_ids)
+
+    def probe(pending):
+        return dict((instance.id, instance.state)
+                    for instance in connection.get_only_instances(
+                        instance_ids=pending))
+
+    wait_for_all(probe, instance_ids, lambda state: state == 'terminated',
+                 'termination of {} instances'.format(len(instance_ids)),
+                 timeout=900, interval=5, max_interval=15)
+    _delete_volumes(connection, [volume.id for volume in volumes])
+
+
+# the EC2 API version to ask for when using options boto doesn't know
+# about, such as hibernation; boto asks for an older one
+_EC2_API_VERSION = '2016-11-15'
+
+# error codes meaning an instance can't hibernate
+_HIBERNATION_UNSUPPORTED = frozenset([
+    'UnsupportedHibernationConfiguration',
+    'UnsupportedOperation',
+    'InvalidParameterCombination',
+])
+
+
+# the params _extra_params() adds to the requests of the current thread,
+# by action; connections are shared between threads
+_extra_request_params = threading.local()
+
+
+def _accept_extra_params(connection):
+    """
+    Lets _extra_params() add params to the requests made through
+    connection. Requests given extra params ask for a newer API version
+    than boto's.
+
+    :return: the same connection object
+    """
+    make_request = connection.make_request
+
+    def make_request_with_params(action, params=None, path='/', verb='GET'):
+        extra = getattr(_extra_request_params, 'by_action', {}).get(action)
+        if extra is None:
+            return make_request(action, params, path, verb)
+        # boto's make_request, which takes the version from the connection
+        request = connection.build_base_http_request(
+            verb, path, None, dict(params or {}, **extra), {}, '',
+            connection.host)
+        request.params['Action'] = action
+        request.params['Version'] = _EC2_API_VERSION
+        return connection._mexe(request)
+
+    connection.make_request = make_request_with_params
+    return connection
+
+
+@contextmanager
+def _extra_params(action, params):
+    """
+    Adds params to the action requests made by the current thread in the
+    block, for EC2 options newer than boto.
+    """
+    previous = getattr(_extra_request_params, 'by_action', {})
+    _extra_request_params.by_action = dict(previous, **{action: params})
+    try:
+        yield
+    finally:
+        _extra_request_params.by_action = previous
+
+
+def _stop_instance(connection, instance_id, hibernate=False):
+    """
+    Stops an instance, hibernating it when asked to and the instance
+    supports it, and waits until it is stopped.
+
+    :return unicode: u'hibernate' or u'stop', how the instance was stopped.
+    """
+    mode = u'stop'
+    if hibernate:
+        try:
+            with _extra_params('StopInstances', {'Hibernate': 'true'}):
+                connection.stop_instances(instance_ids=[instance_id])
+            mode = u'hibernate'
+        except EC2ResponseError as e:
+            if e.error_code not in _HIBERNATION_UNSUPPORTED:
+                raise
+            log_yellow('{} cannot hibernate ({}), stopping it'.format(
+                instance_id, e.error_code))
+    if mode == u'stop':
+        connection.stop_instances(instance_ids=[instance_id])
+    wait_for(lambda: connection.get_only_instances(
+                 instance_ids=[instance_id])[0].state,
+             lambda state: state == 'stopped',
+             'instance {} to {}'.format(instance_id, mode),
+             timeout=900, interval=5, max_interval=15)
+    return mode
 
 
 def _connect_to_ec2(region, credentials):
@@ -76,7 +265,8 @@ def _connect_to_ec2(region, credentials):
         aws_secret_access_key=credentials.secret_access_key
     )
     if conn:
-        return conn
+        return rate_limit_ec2_connection(
+            instrument_ec2_connection(_accept_extra_params(conn)))
     else:
         log_red('Failure to authenticate to EC2.')
         return False
@@ -93,9 +283,13 @@ def _create_server_ec2(connection,
                        security_groups=None,
                        delete_on_termination=True,
                        log=False,
-                       wait_for_ssh_available=True):
+                       wait_for_ssh_available=True,
+                       hibernate=False):
     """
     Creates EC2 Instance
+
+    With hibernate, the instance is launched with hibernation enabled,
+    unless its type doesn't support it.
     """
 
     if log:
@@ -110,11 +304,26 @@ def _create_server_ec2(connection,
     # get an ec2 ami image object with our choosen ami
     image = connection.get_all_images(ami)[0]
     # start a new instance
-    reservation = image.run(1, 1,
-                            key_name=key_pair,
-                            security_groups=security_groups,
-                            block_device_map=bdm,
-                            instance_type=instance_type)
+    def run():
+        return image.run(1, 1,
+                         key_name=key_pair,
+                         security_groups=security_groups,
+                         block_device_map=bdm,
+                         instance_type=instance_type)
+
+    reservation = None
+    if hibernate:
+        try:
+            with _extra_params('RunInstances',
+                               {'HibernationOptions.Configured': 'true'}):
+                reservation = run()
+        except EC2ResponseError as e:
+            if e.error_code not in _HIBERNATION_UNSUPPORTED:
+                raise
+            log_yellow('{} instances cannot hibernate ({})'.format(
+                instance_type, e.error_code))
+    if reservation is None:
+        reservation = run()
 
     # and get our instance_id
     instance = reservation.instances[0]
@@ -147,15 +356,47 @@ def _create_server_ec2(connection,
     return instance
 
 
+def _start_instance(config, state, timeout, on_started=lambda: None):
+    """
+    Starts a stopped instance and waits until it is reachable over ssh.
+
+    Uses a connection of its own, as it runs in the background while the
+    instance's connection may be in use.
+
+    :param on_started: called once ec2 accepted to start the instance.
+
+    :return: the boto instance object and the seconds it took to start.
+    """
+    started = time()
+    connection = _connect_to_ec2(
+        region=state.region,
+        credentials=config.credentials
+    )
+    instance = connection.start_instances(
+        instance_ids=state.instance_id)[0]
+    on_started()
+    instance.update()
+    while instance.state != "running" and timeout > 1:
+        log_yellow("Instance state: %s" % instance.state)
+        sleep(10)
+        timeout = timeout - 10
+        instance.update()
+
+    # and make sure we don't return until the instance is fully up
+    wait_for_ssh(instance.ip_address)
+    return instance, time() - started
+
+
 @implementer(ICloudInstance)
 @provider(ICloudInstanceFactory)
-class EC2Instance():
+class EC2Instance(LazyReadinessMixin):
     """
     Class representing an EC2 instance, that provides methods for interacting
     with the instance.
 
     :ivar connection: A boto connection object to interact with ec2.
-    :ivar instance: A boto instance object.
+    :ivar instance: A boto instance object, None until the instance is
+        ready when restored from saved state.
     :ivar config: An EC2Configuration describing the configuration for this EC2
         instance.
     :ivar state: An EC2State describing this EC2 instance.
@@ -170,6 +411,7 @@ class EC2Instance():
 
     @property
     def ip_address(self):
+        self.wait_until_ready()
         return self.instance.ip_address
 
     @property
@@ -211,7 +453,8 @@ class EC2Instance():
             security_groups=parsed_config.security_groups,
             delete_on_termination=True,
             log=False,
-            wait_for_ssh_available=True
+            wait_for_ssh_available=True,
+            hibernate=parsed_config.hibernate
         )
         state = EC2State(
             instance_id=instance.id,
@@ -227,45 +470,186 @@ class EC2Instance():
         )
 
     @classmethod
-    def create_from_saved_state(cls, config, saved_state, timeout=600):
+    def create_from_saved_state(cls, config, saved_state, timeout=600,
+                                lazy=True):
+        """
+        Starts the saved instance. Unless lazy is False this returns at once
+        and the instance is started in the background.
+
+        An instance that was hibernated resumes where it left off instead of
+        booting; either way the time it took is recorded in its state.
+        """
         parsed_config = EC2Configuration.create(config)
         state = EC2State.create(saved_state)
         connection = _connect_to_ec2(
             region=state.region,
             credentials=parsed_config.credentials
         )
-
-        instance = connection.start_instances(
-            instance_ids=state.instance_id)[0]
-        instance.update()
-        while instance.state != "running" and timeout > 1:
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            timeout = timeout - 10
-            instance.update()
-
-        # and make sure we don't return until the instance is fully up
-        wait_for_ssh(instance.ip_address)
-        return cls(
+        ec2_instance = cls(
             connection=connection,
-            instance=instance,
+            instance=None,
             config=parsed_config,
             state=state
         )
+        ec2_instance._start_in_background(
+            _start_instance, parsed_config, state, timeout)
+        if not lazy:
+            ec2_instance.wait_until_ready()
+        return ec2_instance
+
+    def _became_ready(self, result):
+        self.instance, seconds = result
+        self.state = self.state.set(
+            start_mode=(u'resume' if self.state.stop_mode == u'hibernate'
+                        else u'boot'),
+            start_seconds=seconds)
+        log_green('{} started ({}) in {:.0f}s'.format(
+            self.state.instance_id, self.state.start_mode, seconds))
+
+    @classmethod
+    def config_for_image(cls, config, image_id, image_name):
+        return dict(config, ami=image_id)
+
+    @classmethod
+    def find_image(cls, config, region, labels):
+        parsed_config = EC2Configuration.create(config)
+        connection = _connect_to_ec2(
+            region=region,
+            credentials=parsed_config.credentials
+        )
+        filters = dict(('tag:{}'.format(name), value)
+                       for name, value in labels.items())
+        filters['state'] = 'available'
+        images = connection.get_all_images(owners=['self'], filters=filters)
+        if not images:
+            return None
+        return max(images, key=lambda image: image.creationDate).id
+
+    @classmethod
+    def iter_images(cls, config, region, name_prefix=None,
+                    created_after=None, created_before=None):
+        parsed_config = EC2Configuration.create(config)
+        connection = _connect_to_ec2(
+            region=region,
+            credentials=parsed_config.credentials
+        )
+        return _iter_images(connection, region, name_prefix,
+                            created_after, created_before)
+
+    @classmethod
+    def delete_images(cls, config, region, images):
+        parsed_config = EC2Configuration.create(config)
+        connection = _connect_to_ec2(
+            region=region,
+            credentials=parsed_config.credentials
+        )
+
+        def delete(record):
+            log_yellow("Deleting image {}".format(record.image_id))
+            connection.deregister_image(record.image_id)
+            for snapshot_id in record.snapshot_ids:
+                connection.delete_snapshot(snapshot_id)
+            return record
+
+        images = list(images)
+        with private_executor(len(images)) as executor:
+            return completed_results([executor.submit(delete, record)
+                                      for record in images])
+
+    @classmethod
+    def destroy_all(cls, config, saved_states):
+        """
+        Instances are terminated without stopping them first, a region at a
+        time but all the regions at once.
+        """
+        parsed_config = EC2Configuration.create(config)
+        regions = {}
+        for saved_state in saved_states:
+            state = EC2State.create(saved_state)
+            regions.setdefault(state.region, []).append(state.instance_id)
+
+        def destroy_region(region, instance_ids):
+            connection = _connect_to_ec2(
+                region=region,
+                credentials=parsed_config.credentials
+            )
+            _destroy_instances(connection, instance_ids)
+
+        with private_executor(len(regions)) as executor:
+            for future in [executor.submit(destroy_region, region,
+                                           instance_ids)
+                           for region, instance_ids in regions.items()]:
+                future.result()
 
-    def create_image(self, image_name):
-        ami = self.connection.create_image(
+    @classmethod
+    def copy_image(cls, config, region, image_id, regions):
+        parsed_config = EC2Configuration.create(config)
+        source = _connect_to_ec2(
+            region=region,
+            credentials=parsed_config.credentials
+        ).get_image(image_id)
+        connections = {}
+        copies = {}
+        for target in regions:
+            if target == region:
+                continue
+            connections[target] = _connect_to_ec2(
+                region=target,
+                credentials=parsed_config.credentials
+            )
+            log_yellow('copying ami {} to {}'.format(image_id, target))
+            copies[target] = connections[target].copy_image(
+                region, image_id, name=source.name,
+                description=source.description).image_id
+            if source.tags:
+                connections[target].create_tags([copies[target]],
+                                                source.tags)
+
+        def probe(pending):
+            # one call per region per round, however many copies are pending
+            return dict(
+                (target,
+                 connections[target].get_all_images(
+                     image_ids=[copies[target]])[0].state)
+                for target in pending)
+
+        wait_for_all(probe, copies.keys(),
+                     lambda state: state == 'available',
+                     'copies of ami {}'.format(image_id),
+                     interval=30, failed=lambda state: state == 'failed')
+        if region in regions:
+            copies[region] = image_id
+        return copies
+
+    def create_image(self, image_name, labels=None, live=False):
+        """
+        Live images are made without rebooting the instance, on a
+        connection of their own so that several can be made at once. The
+        EBS snapshots behind the amis are incremental, so images made one
+        after the other from the same instance only copy the blocks that
+        changed in between.
+        """
+        self.wait_until_ready()
+        connection = self.connection
+        if live:
+            connection = _connect_to_ec2(
+                region=self.state.region,
+                credentials=self.config.credentials
+            )
+        ami = connection.create_image(
             self.state.instance_id,
             image_name,
             description=self.config.image_description,
+            no_reboot=live,
         )
+        if labels:
+            connection.create_tags([ami], labels)
 
-        image_status = self.connection.get_image(ami)
-        while (image_status.state != "available" and
-               image_status.state != "failed"):
-            log_yellow('creating ami...')
-            sleep(60)
-            image_status = self.connection.get_image(ami)
+        image_status = wait_for(
+            lambda: connection.get_image(ami),
+            lambda image: image.state in ("available", "failed"),
+            'ami {}'.format(ami),
+            interval=15)
 
         if image_status.state == "available":
             log_green("ami %s %s" % (ami, image_status))
@@ -275,75 +659,44 @@ class EC2Instance():
             return False
 
     def list_images(self):
-        images = self.connection.get_all_images(owners='self')
         log_yellow("creation time\timage_name\timage_id")
-        for image in sorted(images, key=lambda x: x.creationDate):
+        for image in _iter_images(self.connection, self.state.region):
             log_green("{}\t{:50}\t{}".format(
-                image.creationDate, image.name, image.id)
+                image.created, image.name, image.image_id)
             )
 
     def delete_image(self, image_id):
-        images = self.connection.get_all_images(owners='self')
-        found = False
-        for image in images:
-            if image.id == image_id:
-                log_yellow("Deleting image {}".format(image_id))
-                image.deregister(delete_snapshot=True)
-                found = True
-                break
-        if not found:
+        try:
+            image = self.connection.get_image(image_id)
+        except EC2ResponseError:
+            image = None
+        if image is None:
             log_red("Could not find image {}".format(image_id))
-
-    def _ebs_volume_exists(self, volume_id):
-        """ finds out if a ebs volume exists """
-        for vol in self.connection.get_all_volumes():
-            if vol.id == volume_id:
-                return True
-        return False
-
-    def _destroy_ebs_volume(self, volume_id):
-        """ destroys an ebs volume """
-        if self._ebs_volume_exists(volume_id):
-            log_yellow('destroying EBS volume ...')
-            try:
-                self.connection.delete_volume(volume_id)
-            except Exception as e:
-                # our EBS volume may be gone, but AWS info tables are stale
-                # wait a bit and ask again
-                log_yellow("exception raised when deleting volume")
-                log_yellow("{} -- {}".format(type(e), str(e)))
-                worked = False
-                for i in range(6):
-                    sleep(5)
-                    if not self._ebs_volume_exists(volume_id):
-                        log_green("It worked that time")
-                        worked = True
-                if not worked:
-                    raise Exception("Couldn't delete EBS volume")
+            return
+        log_yellow("Deleting image {}".format(image_id))
+        image.deregister(delete_snapshot=True)
 
     def destroy(self):
-        self.down()
-        volumes = self.connection.get_all_volumes(
-            filters={'attachment.instance-id': self.state.instance_id}
-        )
-        instance = self.connection.terminate_instances(
-            instance_ids=[self.state.instance_id])[0]
-        log_yellow('destroying instance ...')
-        while instance.state != "terminated":
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            instance.update()
-        for volume in volumes:
-            self._destroy_ebs_volume(volume.id)
+        self.wait_until_started()
+        _destroy_instances(self.connection, [self.state.instance_id])
 
     def down(self):
-        instance = self.connection.stop_instances(
-            instance_ids=self.state.instance_id)[0]
-        while instance.state != "stopped":
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            instance.update()
-        log_green('Instance state: %s' % instance.state)
+        """
+        Stops the instance, or hibernates it if the configuration asks for
+        it, recording how it was stopped and how long it took.
+        """
+        self.wait_until_started()
+        started = time()
+        mode = _stop_instance(self.connection, self.state.instance_id,
+                              hibernate=self.config.hibernate)
+        self.state = self.state.set(stop_mode=mode,
+                                    stop_seconds=time() - started)
+        log_green('{} stopped ({}) in {:.0f}s'.format(
+            self.state.instance_id, mode, self.state.stop_seconds))
 
     def get_state(self):
         return self.state.serialize()
+
+
+#: ``IAsyncCloudInstanceFactory`` provider for EC2 instances.
+AsyncEC2Instance = AsyncCloudInstanceFactory(EC2Instance)
@@ -2,7 +2,6 @@
 Helpful docs for the GCE Python API
 https://google-api-client-libraries.appspot.com/documentation/compute/v1/python/latest/
 """
-from time import time, sleep
 import uuid
 
 from zope.interface import implementer, provider
@@ -14,8 +13,17 @@ from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
 from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
+from bookshelf.api_v2.ratelimit import RateLimitedHttpRequest, execute_batch
 from bookshelf.api_v1 import wait_for_ssh
-from cloud_instance import ICloudInstance, ICloudInstanceFactory, Distribution
+from cloud_instance import (
+    ICloudInstance, ICloudInstanceFactory, Distribution, ImageRecord,
+    parse_timestamp
+)
+from async_instance import AsyncCloudInstanceFactory, LazyReadinessMixin
+from waiter import WaitTimeout, wait_for, wait_for_all
+
+# the most requests the api accepts in one batch
+_MAX_BATCH_SIZE = 1000
 
 
 class GCEConfiguration(PClass):
@@ -38,6 +46,134 @@ class GCEConfiguration(PClass):
     base_image_project = field(factory=unicode, mandatory=True)
 
 
+def _connect_to_gce(config):
+    """ returns a compute api object for a GCEConfiguration """
+    if config.credentials_email and config.credentials_private_key:
+        credentials = SignedJwtAssertionCredentials(
+            config.credentials_email,
+            config.credentials_private_key,
+            scope=[
+                u"https://www.googleapis.com/auth/compute",
+            ]
+        )
+    else:
+        credentials = GoogleCredentials.get_application_default()
+    compute = discovery.build('compute', 'v1', credentials=credentials,
+                              requestBuilder=RateLimitedHttpRequest)
+    return compute
+
+
+def _execute_batch(compute, requests):
+    """
+    Runs (key, request) pairs in as few batch requests as possible, rate
+    limited as the requests they hold.
+
+    :return: a dict of key to response, and one of key to HttpError for the
+        requests that failed.
+    """
+    responses = {}
+    errors = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            responses[request_id] = response
+
+    def new_batch(callback):
+        return compute.new_batch_http_request(callback=callback)
+
+    for start in range(0, len(requests), _MAX_BATCH_SIZE):
+        execute_batch(new_batch, requests[start:start + _MAX_BATCH_SIZE],
+                      collect)
+    return responses, errors
+
+
+def _run_operations(compute, project, requests, description):
+    """
+    Sends (key, request) pairs in batch requests, then polls the operations
+    they started with a batch of requests per round until they're all done.
+
+    :return: the keys whose operation succeeded, and a dict of key to the
+        error of the others.
+    """
+    operations, errors = _execute_batch(compute, requests)
+
+    def get_operation(operation):
+        if 'zone' in operation:
+            return compute.zoneOperations().get(
+                project=project,
+                zone=operation['zone'].split('/')[-1],
+                operation=operation['name'])
+        return compute.globalOperations().get(
+            project=project, operation=operation['name'])
+
+    def probe(pending):
+        responses, _ = _execute_batch(compute, [
+            (key, get_operation(operations[key])) for key in pending])
+        return responses
+
+    done = wait_for_all(probe, operations.keys(),
+                        lambda operation: operation['status'] == 'DONE',
+                        description, interval=2, max_interval=10)
+    succeeded = []
+    for key, operation in done.items():
+        if 'error' in operation:
+            errors[key] = operation['error']
+        else:
+            succeeded.append(key)
+    return succeeded, errors
+
+
+def _raise_unless_gone(errors, kind):
+    """ raises for the errors of deletes, except for 404s """
+    failed = {}
+    for name, error in errors.items():
+        if isinstance(error, HttpError) and error.resp.status == 404:
+            log_yellow("the {} {} was already destroyed".format(kind, name))
+        else:
+            failed[name] = error
+    if failed:
+        raise RuntimeError(
+            "could not delete {}s: {}".format(kind, failed))
+
+
+def _image_record(image, region):
+    """ returns the ImageRecord for an image resource """
+    return ImageRecord(
+        image_id=image['name'],
+        name=image['name'],
+        region=region,
+        created=parse_timestamp(image['creationTimestamp']),
+        size_bytes=int(image.get('archiveSizeBytes', 0)),
+        labels=image.get('labels', {}),
+    )
+
+
+def _iter_images(compute, project, region, name_prefix=None,
+                 created_after=None, created_before=None):
+    """
+    The name prefix is matched by GCE, the dates are checked here as the
+    filter syntax can't combine them with it.
+    """
+    page_token = None
+    while True:
+        response = compute.images().list(
+            project=project,
+            maxResults=500,
+            pageToken=page_token,
+            filter='name eq {}.*'.format(name_prefix) if name_prefix else None
+        ).execute()
+        for image in response.get('items', []):
+            record = _image_record(image, region)
+            if record.matches(created_after=created_after,
+                              created_before=created_before):
+                yield record
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
 class GCEState(PClass):
     """
     The necessary information to easily reconnect to an existing GCE
@@ -51,7 +187,7 @@ class GCEState(PClass):
 
 @implementer(ICloudInstance)
 @provider(ICloudInstanceFactory)
-class GCEInstance(object):
+class GCEInstance(LazyReadinessMixin):
     """
     Class that represents a GCE instance. Provides a simple
     set of methods for interacting with that instance.
@@ -98,6 +234,7 @@ class GCEInstance(object):
 
     @property
     def ip_address(self):
+        self.wait_until_ready()
         return self.state.ip_address
 
     @property
@@ -122,15 +259,46 @@ class GCEInstance(object):
         return gce_instance
 
     @classmethod
-    def create_from_saved_state(cls, config, saved_state):
+    def create_from_saved_state(cls, config, saved_state, lazy=True):
+        """
+        Starts the saved instance. Unless lazy is False this returns at once
+        and the instance is started in the background; until then
+        ``get_state`` reports the ip address from the saved state.
+        """
         state = GCEState.create(saved_state)
         instance = cls(config, state)
-        instance._ensure_instance_running(saved_state['instance_name'])
+        instance._start_in_background(cls._start_saved_instance, config, state)
+        if not lazy:
+            instance.wait_until_ready()
+        return instance
+
+    @classmethod
+    def _start_saved_instance(cls, config, state, on_started=lambda: None):
+        """
+        Runs in the background with its own GCE connection, as httplib2
+        connections can't be shared between threads.
+
+        :param on_started: called once the instance is running.
+        :return GCEState: the state, with the current ip address.
+        """
+        instance = cls(config, state)
+        instance._ensure_instance_running(state.instance_name)
+        on_started()
         # if we've restarted a terminated server, the ip address
         # might have changed from our saved state, get the
         # networking info and resave the state
         instance._set_instance_networking()
-        return instance
+        return instance.state
+
+    def _became_ready(self, state):
+        self.state = state
+
+    @classmethod
+    def config_for_image(cls, config, image_id, image_name):
+        # create_image names the image after image_name and returns it
+        return dict(config,
+                    base_image_project=config['project'],
+                    base_image_prefix=image_id)
 
     def _ensure_instance_running(self, instance_name):
         """
@@ -200,17 +368,122 @@ class GCEInstance(object):
                               disk_name=None)
         self._set_instance_networking()
 
-    def create_image(self, image_name):
+    @classmethod
+    def find_image(cls, config, region, labels):
+        """
+        Images are global on GCE, so region is ignored.
+        """
+        parsed_config = GCEConfiguration.create(config)
+        images = _connect_to_gce(parsed_config).images()
+        matches = []
+        page_token = None
+        while True:
+            response = images.list(
+                project=parsed_config.project,
+                maxResults=500,
+                pageToken=page_token
+            ).execute()
+            matches.extend(
+                image for image in response.get('items', [])
+                if image['status'] == 'READY' and
+                'deprecated' not in image and
+                all(image.get('labels', {}).get(name) == value
+                    for name, value in labels.items()))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        if not matches:
+            return None
+        return max(matches, key=lambda image: image['creationTimestamp'])[
+            'name']
+
+    @classmethod
+    def iter_images(cls, config, region, name_prefix=None,
+                    created_after=None, created_before=None):
+        """
+        Images are global on GCE, region is only copied to the records.
+        """
+        parsed_config = GCEConfiguration.create(config)
+        return _iter_images(_connect_to_gce(parsed_config),
+                            parsed_config.project, region, name_prefix,
+                            created_after, created_before)
+
+    @classmethod
+    def delete_images(cls, config, region, images):
+        """
+        Sends the deletes in batch requests, and polls all the resulting
+        operations in a batch per round.
+        """
+        parsed_config = GCEConfiguration.create(config)
+        project = parsed_config.project
+        compute = _connect_to_gce(parsed_config)
+        records = dict((record.image_id, record) for record in images)
+        deleted, errors = _run_operations(compute, project, [
+            (image_id, compute.images().delete(project=project,
+                                               image=image_id))
+            for image_id in records], 'image deletes')
+        for image_id, error in errors.items():
+            log_red('could not delete image {}: {}'.format(image_id, error))
+        return [records[image_id] for image_id in deleted]
+
+    @classmethod
+    def destroy_all(cls, config, saved_states):
+        """
+        Deletes all the instances in batch requests, then all their disks.
+        """
+        parsed_config = GCEConfiguration.create(config)
+        project = parsed_config.project
+        compute = _connect_to_gce(parsed_config)
+        states = [GCEState.create(saved_state) for saved_state in saved_states]
+        _, errors = _run_operations(compute, project, [
+            (state.instance_name, compute.instances().delete(
+                project=project, zone=state.zone,
+                instance=state.instance_name))
+            for state in states], 'deletion of {} instances'.format(
+                len(states)))
+        _raise_unless_gone(errors, 'instance')
+        _, errors = _run_operations(compute, project, [
+            (state.instance_name, compute.disks().delete(
+                project=project, zone=state.zone,
+                disk=state.instance_name))
+            for state in states], 'deletion of {} disks'.format(len(states)))
+        _raise_unless_gone(errors, 'disk')
+
+    @classmethod
+    def copy_image(cls, config, region, image_id, regions):
+        """
+        Images are global on GCE, the same image can be used in every zone
+        as soon as it is ready.
+        """
+        parsed_config = GCEConfiguration.create(config)
+        images = _connect_to_gce(parsed_config).images()
+        wait_for(lambda: images.get(project=parsed_config.project,
+                                    image=image_id).execute()['status'],
+                 lambda status: status == 'READY',
+                 'image {}'.format(image_id),
+                 failed=lambda status: status == 'FAILED')
+        return dict((zone, image_id) for zone in regions)
+
+    def create_image(self, image_name, labels=None, live=False):
         """
         Shuts down the instance (necessary for creating a GCE image) and
         creates and image from the disk.  Assumes that the disk name
         is the same as the instance_name (this is the default behavior
         for boot disks on GCE).
+
+        Live images are made from a snapshot of the disk instead, and the
+        instance keeps running.
         """
 
+        self.wait_until_ready()
         disk_name = self.state.instance_name
+        if live:
+            return self._create_image_from_snapshot(image_name, labels)
         self._destroy_instance()
+        self._insert_image(self._compute, image_name, disk_name, labels)
+        return image_name
 
+    def _insert_image(self, compute, image_name, disk_name, labels):
         body = {
             "rawDisk": {},
             "name": image_name,
@@ -219,18 +492,56 @@ class GCEInstance(object):
             ),
             "description": self.description
         }
+        if labels:
+            body["labels"] = labels
         self._wait_until_done(
-            self._compute.images().insert(
-                project=self.project, body=body).execute()
+            compute.images().insert(
+                project=self.project, body=body).execute(),
+            compute
         )
+
+    def _create_image_from_snapshot(self, image_name, labels):
+        """
+        Snapshots the boot disk, restores the snapshot to a temporary disk
+        and images that. Uses a connection of its own, so several images can
+        be made from the instance at once.
+        """
+        compute = self._get_gce_compute()
+        scratch_name = u'bookshelf-{}'.format(uuid.uuid4().hex)
+        log_yellow('snapshotting disk {}'.format(self.state.instance_name))
+        self._wait_until_done(compute.disks().createSnapshot(
+            project=self.project,
+            zone=self.zone,
+            disk=self.state.instance_name,
+            body={"name": scratch_name}
+        ).execute(), compute)
+        try:
+            self._wait_until_done(compute.disks().insert(
+                project=self.project,
+                zone=self.zone,
+                body={"name": scratch_name,
+                      "sourceSnapshot": "global/snapshots/{}".format(
+                          scratch_name)}
+            ).execute(), compute)
+            try:
+                self._insert_image(compute, image_name, scratch_name, labels)
+            finally:
+                self._wait_until_done(compute.disks().delete(
+                    project=self.project,
+                    zone=self.zone,
+                    disk=scratch_name
+                ).execute(), compute)
+        finally:
+            self._wait_until_done(compute.snapshots().delete(
+                project=self.project,
+                snapshot=scratch_name
+            ).execute(), compute)
         return image_name
 
     def list_images(self):
-        results = self._compute.images().list(project=self.project).execute()
         log_yellow("creation time\timage_name")
-        for item in results['items']:
-            log_green("{}\t{}".format(item['creationTimestamp'],
-                                      item['name']))
+        for image in _iter_images(self._compute, self.project, self.zone):
+            log_green("{}\t{}".format(image.created, image.name))
 
     def delete_image(self, image_name):
         log_green("Deleting image {}".format(image_name))
@@ -243,6 +554,7 @@ class GCEInstance(object):
         )
 
     def down(self):
+        self.wait_until_started()
         log_yellow("downing server: {}".format(self.state.instance_name))
         self._wait_until_done(self._compute.instances().stop(
             project=self.project,
@@ -268,6 +580,7 @@ class GCEInstance(object):
                 raise e
 
     def destroy(self):
+        self.wait_until_started()
         disk_name = self.state.instance_name
         self._destroy_instance()
         try:
@@ -385,22 +698,9 @@ class GCEInstance(object):
         log_green("Instance has booted")
 
     def _get_gce_compute(self):
-        if (self.config.credentials_email and
-            self.config.credentials_private_key):
-
-            credentials = SignedJwtAssertionCredentials(
-                self.config.credentials_email,
-                self.config.credentials_private_key,
-                scope=[
-                    u"https://www.googleapis.com/auth/compute",
-                ]
-            )
-        else:
-            credentials = GoogleCredentials.get_application_default()
-        compute = discovery.build('compute', 'v1', credentials=credentials)
-        return compute
+        return _connect_to_gce(self.config)
 
-    def _wait_until_done(self, operation):
+    def _wait_until_done(self, operation, compute=None):
         """
         Perform a GCE operation, blocking until the operation completes.
 
@@ -409,10 +709,13 @@ class GCEInstance(object):
         dict.
 
         :param operation: A dict representing a pending GCE operation resource.
+        :param compute: The compute api object to poll with, defaults to the
+            instance's.
 
         :returns dict: A dict representing the concluded GCE operation
             resource.
         """
+        compute = compute or self._compute
         operation_name = operation['name']
         if 'zone' in operation:
             zone_url_parts = operation['zone'].split('/')
@@ -420,7 +723,7 @@ class GCEInstance(object):
             zone = zone_url_parts[-1]
 
             def get_zone_operation():
-                return self._compute.zoneOperations().get(
+                return compute.zoneOperations().get(
                     project=project,
                     zone=zone,
                     operation=operation_name
@@ -430,24 +733,18 @@ class GCEInstance(object):
             project = operation['selfLink'].split('/')[-4]
 
             def get_global_operation():
-                return self._compute.globalOperations().get(
+                return compute.globalOperations().get(
                     project=project,
                     operation=operation_name
                 )
             update = get_global_operation
-        done = False
-        latest_operation = None
-        start = time()
-        timeout = 5*60  # seconds
-        while not done:
-            latest_operation = update().execute()
-            if (latest_operation['status'] == 'DONE' or
-                    time() - start > timeout):
-                done = True
-            else:
-                sleep(10)
-                log_yellow("waiting for operation")
-        return latest_operation
+        try:
+            return wait_for(lambda: update().execute(),
+                            lambda latest: latest['status'] == 'DONE',
+                            'operation {}'.format(operation_name),
+                            timeout=5*60, interval=2, max_interval=10)
+        except WaitTimeout as e:
+            return e.last
 
     def _get_latest_image(self, base_image_project, image_name_prefix):
         """
@@ -495,3 +792,7 @@ class GCEInstance(object):
             'zone': self.state.zone,
         }
         return data
+
+
+#: ``IAsyncCloudInstanceFactory`` provider for GCE instances.
+AsyncGCEInstance = AsyncCloudInstanceFactory(GCEInstance)
@@ -0,0 +1,165 @@
+"""
+Getting baked images everywhere they're needed: copying an image to other
+regions, and building one recipe for several clouds and distributions at
+the same time.
+
+    copies = replicate_image(EC2Instance, config, u'us-west-2', ami,
+                             [u'us-east-1', u'eu-west-1'])
+
+    images = build_all(
+        pipelines_for([(EC2Instance, ec2_config, u'us-west-2'),
+                       (GCEInstance, gce_config, u'us-central1-f')],
+                      list(Distribution), steps))
+    copies = replicate_images(images, {u'ec2': [u'us-east-1']})
+"""
+import multiprocessing
+import traceback
+from Queue import Empty
+
+from concurrent.futures import wait
+
+from bookshelf.api_v2.logging_helpers import log_green, log_red
+from bookshelf.api_v3.async_instance import lifecycle_concurrency, submit
+from bookshelf.api_v3.image_pipeline import ImagePipeline
+
+
+class ImageBuildError(Exception):
+    """
+    Raised by ``build_all`` when some of the builds failed.
+
+    :ivar dict images: the image ids of the builds that succeeded.
+    :ivar dict errors: the formatted tracebacks of the ones that failed.
+    """
+    def __init__(self, images, errors):
+        Exception.__init__(self, images, errors)
+        self.images = images
+        self.errors = errors
+
+    def __str__(self):
+        return '{} image builds failed:\n{}'.format(
+            len(self.errors), '\n'.join(self.errors.values()))
+
+
+def replicate_image(factory, config, region, image_id, regions):
+    """
+    Makes an image available in regions.
+
+    :return dict: region to the identifier of the image in that region.
+    """
+    log_green('replicating {} from {} to {}'.format(
+        image_id, region, ', '.join(regions)))
+    copies = factory.copy_image(config, region, image_id, regions)
+    log_green('replicated {}: {}'.format(image_id, copies))
+    return copies
+
+
+def replicate_images(images, regions):
+    """
+    Replicates the images of several builds at the same time.
+
+    :param dict images: ImagePipeline to the image it built, as returned by
+        ``build_all``.
+    :param dict regions: cloud type to the regions its images should be
+        available in. Images of other clouds are left where they are.
+    :return dict: ImagePipeline to a dict of region to image id.
+    """
+    futures = dict(
+        (pipeline,
+         submit(replicate_image, pipeline.factory, pipeline.config,
+                pipeline.region, image_id,
+                regions[pipeline.factory.cloud_type]))
+        for pipeline, image_id in images.items()
+        if pipeline.factory.cloud_type in regions)
+    wait(futures.values())
+    copies = dict((pipeline, {pipeline.region: image_id})
+                  for pipeline, image_id in images.items())
+    copies.update((pipeline, future.result())
+                  for pipeline, future in futures.items())
+    return copies
+
+
+def pipelines_for(targets, distros, steps, **kwargs):
+    """
+    Returns an ImagePipeline per target and distribution, building the same
+    steps.
+
+    :param list targets: (factory, config, region) tuples.
+    :param list distros: Distribution values.
+    :param steps: list of steps, or a function returning the steps for a
+        distribution, as the helpers often differ.
+    :param kwargs: passed on to ImagePipeline.
+    """
+    return [ImagePipeline(factory, config, distro, region,
+                          steps(distro) if callable(steps) else steps,
+                          **kwargs)
+            for factory, config, region in targets
+            for distro in distros]
+
+
+def _build_in_child(index, pipeline, results):
+    try:
+        results.put((index, True, pipeline.build()))
+    except BaseException:
+        results.put((index, False, traceback.format_exc()))
+
+
+def build_all(pipelines, processes=None):
+    """
+    Runs the builds at the same time, each in a process of its own as
+    fabric's ``env`` can't be shared between threads.
+
+    :param int processes: the most builds to run at once, by default the
+        limit of ``lifecycle_concurrency``.
+    :return dict: each pipeline to the image id it built.
+    :raises ImageBuildError: once all builds are finished, if any failed.
+        Its ``images`` and ``errors`` are keyed by pipeline too.
+    """
+    pipelines = list(pipelines)
+    processes = processes or lifecycle_concurrency.limit
+    pending = range(len(pipelines))
+    running = {}
+    results = multiprocessing.Queue()
+    images = {}
+    errors = {}
+
+    def finished(index, succeeded, result):
+        # joined once its result is read, a child blocks on exit until
+        # what it put in the queue is read
+        running.pop(index).join()
+        pipeline = pipelines[index]
+        if succeeded:
+            images[pipeline] = result
+        else:
+            log_red('building {} {} in {} failed'.format(
+                pipeline.factory.cloud_type, pipeline.distro.value,
+                pipeline.region))
+            errors[pipeline] = result
+
+    while pending or running:
+        while pending and len(running) < processes:
+            index = pending.pop(0)
+            child = multiprocessing.Process(
+                target=_build_in_child,
+                args=(index, pipelines[index], results))
+            child.start()
+            running[index] = child
+
+        try:
+            finished(*results.get(timeout=5))
+        except Empty:
+            exited = [exited_index
+                      for exited_index, exited_child in running.items()
+                      if not exited_child.is_alive()]
+            # what they put in the queue before exiting is there by now
+            try:
+                while True:
+                    finished(*results.get_nowait())
+            except Empty:
+                pass
+            for index in exited:
+                if index in running:
+                    finished(index, False, 'build process exited with '
+                             '{}'.format(running[index].exitcode))
+    if errors:
+        raise ImageBuildError(images, errors)
+    return images
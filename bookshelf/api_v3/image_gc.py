@@ -0,0 +1,125 @@
+"""
+Garbage collection of old images.
+
+Images are grouped into series, whose newest images are the ones still in
+use, and a RetentionPolicy decides which ones go:
+
+    * the images of an incremental build lineage
+    * the images of pipeline builds, per distribution and number of steps
+      run, from their labels
+    * other images by basename, the image name without the timestamp added
+      when it was made (``image_basename-YYYYMMDDHHMMSS``)
+
+    report = collect_garbage(EC2Instance, config, u'us-west-2',
+                             RetentionPolicy(keep_newest=5,
+                                             max_age=timedelta(days=30)))
+    log_green(report)
+"""
+import re
+from datetime import datetime
+
+from pyrsistent import PClass, field
+
+from bookshelf.api_v2.logging_helpers import log_green, log_yellow
+from bookshelf.api_v3.cloud_instance import RECIPE_LABEL
+from bookshelf.api_v3.image_pipeline import (
+    DISTRO_LABEL, LINEAGE_LABEL, STEP_LABEL
+)
+
+_GENERATED_SUFFIX = re.compile(r'-(\d{14}|[0-9a-f]{16})$')
+
+
+def image_basename(name):
+    """ returns the name of an image without its timestamp or key suffix """
+    return _GENERATED_SUFFIX.sub(u'', name)
+
+
+def image_series(image):
+    """ returns what identifies the series an ImageRecord belongs to """
+    labels = image.labels
+    if LINEAGE_LABEL in labels:
+        return (u'lineage', labels.get(DISTRO_LABEL), labels[LINEAGE_LABEL])
+    if RECIPE_LABEL in labels:
+        return (u'pipeline', image_basename(image.name),
+                labels.get(DISTRO_LABEL), labels.get(STEP_LABEL))
+    return (u'name', image_basename(image.name))
+
+
+class RetentionPolicy(PClass):
+    """
+    Which images to keep.
+
+    An image is deleted when it isn't one of the ``keep_newest`` newest of
+    its series and, if ``max_age`` is set, it is older than that.
+
+    :ivar int keep_newest: the number of images to keep per series.
+    :ivar timedelta max_age: only delete images older than this.
+    :ivar unicode prefix: only consider images whose name starts with this.
+    """
+    keep_newest = field(type=int, initial=5)
+    max_age = field(initial=None)
+    prefix = field(type=unicode, initial=u'', factory=unicode)
+
+    def expired(self, images, now=None):
+        """
+        :param list images: ImageRecord objects.
+        :return list: the ImageRecord objects to delete.
+        """
+        now = now or datetime.utcnow()
+        groups = {}
+        for image in images:
+            if image.name.startswith(self.prefix):
+                groups.setdefault(image_series(image), []).append(image)
+        expired = []
+        for group in groups.values():
+            group.sort(key=lambda image: image.created, reverse=True)
+            expired.extend(
+                image for image in group[self.keep_newest:]
+                if self.max_age is None or now - image.created > self.max_age)
+        return expired
+
+
+class GarbageCollectionReport(PClass):
+    """
+    :ivar deleted: the ImageRecord objects of the images deleted, or that
+        would be deleted in a dry run.
+    :ivar int kept: the number of images left.
+    """
+    deleted = field(initial=())
+    kept = field(type=int, initial=0)
+    dry_run = field(type=bool, initial=False)
+
+    @property
+    def reclaimed_bytes(self):
+        return sum(image.size_bytes for image in self.deleted)
+
+    def __str__(self):
+        return '{}{} images deleted, {:.1f} GiB reclaimed, {} kept'.format(
+            'dry run: ' if self.dry_run else '',
+            len(self.deleted), self.reclaimed_bytes / 1024.0 ** 3, self.kept)
+
+
+def collect_garbage(factory, config, region, policy, dry_run=False):
+    """
+    Lists the images of a cloud region once, only those matching the
+    policy's prefix, and deletes the ones expired under policy along with
+    their snapshots.
+
+    :return GarbageCollectionReport: what was deleted.
+    """
+    images = list(factory.iter_images(config, region,
+                                      name_prefix=policy.prefix or None))
+    expired = policy.expired(images)
+    for image in expired:
+        log_yellow('{} {} ({})'.format(
+            'would delete' if dry_run else 'deleting',
+            image.name, image.image_id))
+    if dry_run:
+        deleted = expired
+    else:
+        deleted = factory.delete_images(config, region, expired)
+    report = GarbageCollectionReport(deleted=tuple(deleted),
+                                     kept=len(images) - len(deleted),
+                                     dry_run=dry_run)
+    log_green('{} {}: {}'.format(factory.cloud_type, region, report))
+    return report
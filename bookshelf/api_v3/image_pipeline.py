@@ -0,0 +1,443 @@
+"""
+Layered image builds on top of ``ICloudInstance.create_image``.
+
+An image is described as a list of steps, each one a helper called with
+some arguments on the build instance. Every step gets a key hashing its
+inputs (helper name, arguments, the content of the files it uploads) and
+the key of the step before it, so a key identifies the whole chain of
+steps from the base image.
+
+Images of intermediate steps are kept as checkpoints, and a rebuild
+starts from the image of the deepest step that didn't change, much like
+docker layer caching. Every image is labelled with the key of its step, so
+checkpoints are found in the cloud even if they were built elsewhere, and
+for the exact same recipe the build is skipped altogether:
+
+    pipeline = ImagePipeline(EC2Instance, config, Distribution.CENTOS7,
+                             u'us-west-2', [
+                                 Step(apt_install, packages=['git']),
+                                 Step(upload_template, 'app.conf', '/etc',
+                                      files=['app.conf']),
+                             ])
+    image_id = pipeline.build()
+"""
+import hashlib
+import json
+import os
+from time import time
+from uuid import uuid4
+
+from fabric.api import settings, sudo
+from flufl.enum import EnumValue
+
+from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
+from bookshelf.api_v3.cloud_instance import RECIPE_LABEL
+from bookshelf.api_v3.state_file import locked_json_file
+from bookshelf.api_v3.warm_pool import config_fingerprint
+
+DEFAULT_CACHE_FILE = os.path.expanduser('~/.bookshelf/image-cache.json')
+
+# clouds where create_image doesn't leave the instance running, the build
+# carries on from a new instance booted off the checkpoint
+_IMAGING_DESTROYS_INSTANCE = frozenset([u'gce'])
+
+#: Labels set on the images of incremental builds.
+LINEAGE_LABEL = u'bookshelf-lineage'
+GENERATION_LABEL = u'bookshelf-generation'
+
+#: Labels set on every image of a build, holding the distribution and the
+#: number of steps it went through.
+DISTRO_LABEL = u'bookshelf-distro'
+STEP_LABEL = u'bookshelf-step'
+
+
+def _hash_path(path):
+    """ returns the sha1 of a file, or of all the files in a directory """
+    digest = hashlib.sha1()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                digest.update(os.path.relpath(full_path, path))
+                digest.update(_hash_path(full_path))
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _json_input(value):
+    """
+    json default for the inputs of a step: enum values such as a
+    Distribution are hashed by their value, anything else json can't
+    represent has no stable form to hash.
+    """
+    if isinstance(value, EnumValue):
+        return value.value
+    raise TypeError(
+        '{!r} can not be part of a step key, only values json can '
+        'represent can'.format(value))
+
+
+class Step(object):
+    """
+    One provisioning step: a helper called with arguments on the build
+    instance, e.g. ``Step(install_docker, distro)``.
+
+    :ivar helper: the function to call.
+    :ivar files: paths of the local files or directories the helper
+        uploads, so that changing their content invalidates the step. Passed
+        as the ``files`` keyword argument, it isn't given to the helper.
+    :ivar bool always: run the step in every incremental build, even if it
+        didn't change, e.g. for package upgrades. Passed as the ``always``
+        keyword argument.
+    """
+    def __init__(self, helper, *args, **kwargs):
+        self.helper = helper
+        self.files = list(kwargs.pop('files', []))
+        self.always = kwargs.pop('always', False)
+        self.args = args
+        self.kwargs = kwargs
+
+    @property
+    def name(self):
+        return u'{}.{}'.format(self.helper.__module__, self.helper.__name__)
+
+    def digest(self):
+        """
+        returns the hash of the inputs of this step.
+
+        :raises TypeError: if an argument can't be represented in json.
+        """
+        inputs = {'helper': self.name,
+                  'args': self.args,
+                  'kwargs': self.kwargs,
+                  'files': dict((path, _hash_path(path))
+                                for path in self.files)}
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True,
+                                       default=_json_input)).hexdigest()
+
+    def run(self):
+        return self.helper(*self.args, **self.kwargs)
+
+
+class CheckpointCache(object):
+    """
+    The checkpoint images built so far, kept in a json file of the form:
+
+        {"<step key>": {"image_id": ..., "image_name": ..., "created": ...}}
+
+    plus a ``lineage/<name>`` entry for the last image of every incremental
+    build lineage.
+
+    The file is locked while it is read and updated, so several processes
+    can share it.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        with locked_json_file(self.path) as data:
+            return data.get(key)
+
+    def put(self, key, record):
+        with locked_json_file(self.path) as data:
+            data[key] = record
+
+    def remove(self, key):
+        with locked_json_file(self.path) as data:
+            data.pop(key, None)
+
+
+class ImagePipeline(object):
+    """
+    Builds the image for a list of steps, for one factory, configuration,
+    distro and region.
+
+    :ivar factory: the ICloudInstanceFactory provider.
+    :ivar list steps: the Step objects, in the order they are run.
+    :ivar int checkpoint_every: create a checkpoint image every this many
+        steps. Images take minutes to create, so builds with many quick
+        steps can trade cache granularity for speed. The last step is
+        always imaged.
+    :ivar bool live_imaging: make checkpoints with live images, so the
+        build carries on on the same instance without waiting for it to
+        reboot or be recreated.
+    """
+    def __init__(self, factory, config, distro, region, steps,
+                 checkpoint_every=1, live_imaging=False,
+                 cache_file=DEFAULT_CACHE_FILE):
+        self.factory = factory
+        self.config = config
+        self.distro = distro
+        self.region = region
+        self.steps = list(steps)
+        self.checkpoint_every = checkpoint_every
+        self.live_imaging = live_imaging
+        self._cache = CheckpointCache(cache_file)
+
+    def keys(self):
+        """
+        :return list: the key of every step, each covering the base image
+            and all the steps up to it.
+        """
+        key = hashlib.sha1(u'/'.join([
+            self.factory.cloud_type, self.region, self.distro.value,
+            config_fingerprint(self.config)])).hexdigest()
+        keys = []
+        for step in self.steps:
+            key = hashlib.sha1(key + step.digest()).hexdigest()
+            keys.append(key)
+        return keys
+
+    def fingerprint(self):
+        """ returns the key of the last step, identifying the whole recipe """
+        return self.keys()[-1]
+
+    def find_image(self):
+        """
+        :return: the identifier of the newest image already built for this
+            recipe, or None.
+        """
+        return self.factory.find_image(self.config, self.region,
+                                       {RECIPE_LABEL: self.fingerprint()})
+
+    def _checkpoint_image(self, key):
+        """
+        :return: the record of the checkpoint image of a step key, from the
+            cache or else from the cloud, where another worker may have
+            built it. None if there is none.
+        """
+        record = self._cache.get(key)
+        if record is None:
+            image_id = self.factory.find_image(self.config, self.region,
+                                               {RECIPE_LABEL: key})
+            if image_id is not None:
+                record = {'image_id': image_id,
+                          'image_name': self._image_name(key[:16]),
+                          'created': time()}
+                self._cache.put(key, record)
+        return record
+
+    def _deepest_checkpoint(self, keys):
+        """ returns the number of steps cached and the image to resume from """
+        for depth in range(len(keys), 0, -1):
+            record = self._checkpoint_image(keys[depth - 1])
+            if record is not None:
+                return depth, record
+        return 0, None
+
+    def _launch(self, image):
+        config = self.config
+        if image is not None:
+            config = self.factory.config_for_image(
+                config, image['image_id'], image['image_name'])
+        return self.factory.create_from_config(config, self.distro,
+                                               self.region)
+
+    def _on_builder(self, builder):
+        return settings(host_string=u'{}@{}'.format(builder.username,
+                                                    builder.ip_address),
+                        key_filename=builder.key_filename,
+                        disable_known_hosts=True)
+
+    def _run_step(self, builder, index):
+        step = self.steps[index]
+        log_green('running step {}/{}: {}'.format(
+            index + 1, len(self.steps), step.name))
+        with self._on_builder(builder):
+            step.run()
+
+    def _create_image(self, builder, image_name, labels):
+        if self.live_imaging:
+            with self._on_builder(builder):
+                sudo('sync')
+        image_id = builder.create_image(image_name, labels,
+                                        live=self.live_imaging)
+        # the ec2 provider returns False when the image failed, which
+        # mustn't end up in the cache
+        if not image_id:
+            raise RuntimeError(
+                'could not create image {}'.format(image_name))
+        return image_id
+
+    def _image_name(self, suffix):
+        return u'{}-{}'.format(self.config['image_basename'], suffix)
+
+    def _labels(self, steps, **labels):
+        labels.update({DISTRO_LABEL: self.distro.value,
+                       STEP_LABEL: unicode(steps)})
+        return labels
+
+    def _checkpoint(self, builder, index, key):
+        image_name = self._image_name(key[:16])
+        log_yellow('creating checkpoint image {}'.format(image_name))
+        image_id = self._create_image(
+            builder, image_name,
+            self._labels(index + 1, **{RECIPE_LABEL: key}))
+        record = {'image_id': image_id,
+                  'image_name': image_name,
+                  'created': time()}
+        self._cache.put(key, record)
+        return record
+
+    def build(self):
+        """
+        Runs the steps that changed since the last build and images the
+        result.
+
+        :return: the identifier of the image with all the steps applied.
+        """
+        return self._build()['image_id']
+
+    def _build(self):
+        keys = self.keys()
+        image_id = self.find_image()
+        if image_id is not None:
+            log_green('found image {} for this recipe'.format(image_id))
+            return {'image_id': image_id,
+                    'image_name': self._image_name(keys[-1][:16])}
+
+        while True:
+            depth, image = self._deepest_checkpoint(keys)
+            if depth == len(self.steps):
+                log_green('image {} is up to date'.format(image['image_id']))
+                return image
+            if image is not None:
+                log_green('resuming from checkpoint {} after step {}'.format(
+                    image['image_id'], depth))
+            try:
+                builder = self._launch(image)
+                break
+            except Exception as e:
+                key = keys[depth - 1] if image is not None else None
+                if key is None or self.factory.find_image(
+                        self.config, self.region,
+                        {RECIPE_LABEL: key}) == image['image_id']:
+                    # the image is there, the error has nothing to do with it
+                    raise
+                # the checkpoint image was deleted, forget it and fall back on
+                # the one before
+                log_red('could not use checkpoint {}: {}'.format(
+                    image['image_id'], e))
+                self._cache.remove(key)
+
+        try:
+            for index in range(depth, len(self.steps)):
+                self._run_step(builder, index)
+                last = index == len(self.steps) - 1
+                if last or (index + 1) % self.checkpoint_every == 0:
+                    image = self._checkpoint(builder, index, keys[index])
+                    if (not last and not self.live_imaging and
+                            builder.cloud_type in _IMAGING_DESTROYS_INSTANCE):
+                        builder.destroy()
+                        builder = self._launch(image)
+        finally:
+            builder.destroy()
+        return image
+
+    def build_incremental(self, lineage, full_rebuild_every=7):
+        """
+        Builds on top of the previous image of the lineage instead of the
+        base image, running only the steps that changed since then and the
+        ones marked ``always``. Every ``full_rebuild_every`` generations
+        every step runs again from the base image, without any checkpoint,
+        so that images don't drift too far from what a fresh build would
+        give.
+
+        Incremental images are labelled with the lineage and their
+        generation, but not with a recipe fingerprint as they aren't
+        equivalent to a fresh build of the recipe. The previous generation
+        is looked up in the cloud by those labels, so a lineage carries on
+        from another worker or after the cache was wiped.
+
+        :param unicode lineage: name shared by the successive builds of an
+            image, e.g. u'nightly-centos7'.
+        :return: the identifier of the new image.
+        """
+        previous = self._previous_generation(lineage)
+        digests = [step.digest() for step in self.steps]
+        generation = 0 if previous is None else previous['generation'] + 1
+
+        image = None
+        if generation % full_rebuild_every != 0:
+            changed = [index for index, step in enumerate(self.steps)
+                       if step.always or
+                       index >= len(previous['digests']) or
+                       previous['digests'][index] != digests[index]]
+            if not changed:
+                log_green('image {} is up to date'.format(
+                    previous['image_id']))
+                return previous['image_id']
+            image = self._build_on(previous, changed, lineage, generation)
+        if image is None:
+            log_green('full build of generation {} of {}'.format(
+                generation, lineage))
+            image = self._build_on(None, range(len(self.steps)), lineage,
+                                   generation)
+
+        image.update(generation=generation, digests=digests, created=time())
+        self._cache.put(u'lineage/' + lineage, image)
+        return image['image_id']
+
+    def _previous_generation(self, lineage):
+        """
+        :return: the record of the newest image of the lineage, or None if
+            there is none. Images the cache doesn't know of have no step
+            digests, so every step runs again on top of them.
+        """
+        image_id = self.factory.find_image(self.config, self.region,
+                                           {LINEAGE_LABEL: lineage})
+        if image_id is None:
+            return None
+        record = self._cache.get(u'lineage/' + lineage)
+        if record is not None and record['image_id'] == image_id:
+            return record
+        for image in self.factory.iter_images(
+                self.config, self.region,
+                name_prefix=self._image_name(lineage + u'-')):
+            if image.image_id == image_id:
+                return {'image_id': image_id,
+                        'image_name': image.name,
+                        'generation': int(image.labels[GENERATION_LABEL]),
+                        'digests': []}
+        log_yellow('image {} of {} is not listed, starting over'.format(
+            image_id, lineage))
+        return None
+
+    def _build_on(self, previous, changed, lineage, generation):
+        """
+        Runs the changed steps on top of the previous image of the lineage,
+        or on the base image when there is no previous image.
+
+        :return: the record of the new image, or None when the previous
+            image can't be used.
+        """
+        try:
+            builder = self._launch(previous)
+        except Exception as e:
+            if previous is None:
+                raise
+            log_red('could not use the previous image {} of {}: {}'.format(
+                previous['image_id'], lineage, e))
+            return None
+
+        log_green('generation {} of {}, running {} of {} steps'.format(
+            generation, lineage, len(changed), len(self.steps)))
+        try:
+            for index in changed:
+                self._run_step(builder, index)
+            # workers building the same lineage at once mustn't pick the
+            # same name, nor one that is a prefix of another
+            image_name = self._image_name(u'{}-{}-{}'.format(
+                lineage, generation, uuid4().hex[:16]))
+            image_id = self._create_image(
+                builder, image_name,
+                self._labels(len(self.steps), **{
+                    LINEAGE_LABEL: lineage,
+                    GENERATION_LABEL: unicode(generation)}))
+        finally:
+            builder.destroy()
+        return {'image_id': image_id, 'image_name': image_name}
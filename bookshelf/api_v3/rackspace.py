@@ -1,5 +1,5 @@
 from sys import exit
-from time import sleep
+from threading import Lock
 import uuid
 
 from zope.interface import implementer, provider
@@ -9,7 +9,25 @@ from novaclient.exceptions import NotFound
 
 from bookshelf.api_v1 import wait_for_ssh
 from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
-from cloud_instance import ICloudInstance, ICloudInstanceFactory, Distribution
+from bookshelf.api_v2.metrics import instrument_nova_client
+from bookshelf.api_v2.ratelimit import rate_limit_nova_client
+from bookshelf.api_v2.time_helpers import sleep
+from cloud_instance import (
+    ICloudInstance, ICloudInstanceFactory, Distribution, ImageRecord,
+    parse_timestamp
+)
+from waiter import wait_for, wait_for_all
+from async_instance import (
+    AsyncCloudInstanceFactory, LazyReadinessMixin, completed_results,
+    private_executor
+)
+
+
+# pyrax keeps the identity and default region in module globals, so
+# connecting has to be serialized when instances are driven from threads.
+_pyrax_lock = Lock()
+
+_IMAGE_PAGE_SIZE = 100
 
 
 class RackspaceConfiguration(PClass):
@@ -29,6 +47,44 @@ class RackspaceConfiguration(PClass):
     instance_name = field(factory=unicode, mandatory=True)
 
 
+def _connect_to_rackspace(config, region):
+    """ returns a connection object to Rackspace  """
+    with _pyrax_lock:
+        pyrax.set_setting('identity_type', 'rackspace')
+        pyrax.set_default_region(region)
+        pyrax.set_credentials(config.access_key_id,
+                              config.secret_access_key)
+        nova = pyrax.connect_to_cloudservers(region=region)
+    return rate_limit_nova_client(instrument_nova_client(nova))
+
+
+def _iter_images(nova, region, name_prefix=None, created_after=None,
+                 created_before=None):
+    """
+    Only lists snapshot images, the base images are shared by everyone.
+    This version of the api has no image filters, so they are all applied
+    here, a page at a time.
+    """
+    marker = None
+    while True:
+        page = nova.images.list(limit=_IMAGE_PAGE_SIZE, marker=marker)
+        for image in page:
+            if image.metadata.get('image_type') != 'snapshot':
+                continue
+            record = ImageRecord(
+                image_id=image.id,
+                name=image.name,
+                region=region,
+                created=parse_timestamp(image.created),
+                size_bytes=getattr(image, 'OS-EXT-IMG-SIZE:size', 0),
+                labels=image.metadata)
+            if record.matches(name_prefix, created_after, created_before):
+                yield record
+        if len(page) < _IMAGE_PAGE_SIZE:
+            return
+        marker = page[-1].id
+
+
 class RackspaceState(PClass):
     """
     Information about the rackspace instance that will later be used to
@@ -42,7 +98,7 @@ class RackspaceState(PClass):
 
 @implementer(ICloudInstance)
 @provider(ICloudInstanceFactory)
-class RackspaceInstance(object):
+class RackspaceInstance(LazyReadinessMixin):
 
     cloud_type = 'rackspace'
 
@@ -65,6 +121,7 @@ class RackspaceInstance(object):
 
     @property
     def ip_address(self):
+        self.wait_until_ready()
         return self.state.ip_address
 
     @property
@@ -109,15 +166,42 @@ class RackspaceInstance(object):
                                            keyfile.read())
 
     @classmethod
-    def create_from_saved_state(cls, config, saved_state):
+    def create_from_saved_state(cls, config, saved_state, lazy=True):
+        """
+        Reconnects to the saved instance. Unless lazy is False this returns
+        at once and waiting for ssh happens in the background.
+        """
         state = RackspaceState.create(saved_state)
         instance = cls(config, state)
+        instance._start_in_background(cls._reconnect, config, state)
+        if not lazy:
+            instance.wait_until_ready()
+        return instance
+
+    @classmethod
+    def _reconnect(cls, config, state, on_started=lambda: None):
+        """
+        Runs in the background with its own connection.
+
+        :param on_started: unused, as Rackspace servers are never stopped.
+
+        :return RackspaceState: the state, with the current ip address.
+        """
+        instance = cls(config, state)
         server = instance._nova.servers.find(name=instance.state.instance_name)
         # if we've restarted a terminated server, the ip address
         # might have changed from our saved state, get the
         # networking info and resave the state
         instance._set_instance_networking(server)
-        return instance
+        return instance.state
+
+    def _became_ready(self, state):
+        self.state = state
+
+    @classmethod
+    def config_for_image(cls, config, image_id, image_name):
+        # instances are created from an image looked up by name
+        return dict(config, ami=image_name)
 
     def _create_server(self):
         log_yellow("Creating Rackspace instance...")
@@ -155,27 +239,112 @@ class RackspaceInstance(object):
 
     def _connect_to_rackspace(self):
         """ returns a connection object to Rackspace  """
-        pyrax.set_setting('identity_type', 'rackspace')
-        pyrax.set_default_region(self.state.region)
-        pyrax.set_credentials(self.config.access_key_id,
-                              self.config.secret_access_key)
-        nova = pyrax.connect_to_cloudservers(region=self.state.region)
-        return nova
+        return _connect_to_rackspace(self.config, self.state.region)
 
-    def create_image(self, image_name):
-        server = self._nova.servers.find(name=self.state.instance_name)
-        image_id = self._nova.servers.create_image(server.id,
-                                                   image_name=image_name)
-        image = self._nova.images.get(image_id).status.lower()
+    @classmethod
+    def find_image(cls, config, region, labels):
+        nova = _connect_to_rackspace(RackspaceConfiguration.create(config),
+                                     region)
+        matches = [image for image in nova.images.list()
+                   if image.status == 'ACTIVE' and
+                   all(image.metadata.get(name) == value
+                       for name, value in labels.items())]
+        if not matches:
+            return None
+        return max(matches, key=lambda image: image.created).id
+
+    @classmethod
+    def iter_images(cls, config, region, name_prefix=None,
+                    created_after=None, created_before=None):
+        nova = _connect_to_rackspace(RackspaceConfiguration.create(config),
+                                     region)
+        return _iter_images(nova, region, name_prefix, created_after,
+                            created_before)
+
+    @classmethod
+    def delete_images(cls, config, region, images):
+        nova = _connect_to_rackspace(RackspaceConfiguration.create(config),
+                                     region)
+
+        def delete(record):
+            log_yellow('deleting image {}'.format(record.image_id))
+            nova.images.delete(record.image_id)
+            return record
+
+        images = list(images)
+        with private_executor(len(images)) as executor:
+            return completed_results([executor.submit(delete, record)
+                                      for record in images])
+
+    @classmethod
+    def destroy_all(cls, config, saved_states):
+        """
+        Deletes the servers concurrently, and polls them with one listing
+        per region and round.
+        """
+        parsed_config = RackspaceConfiguration.create(config)
+        regions = {}
+        for saved_state in saved_states:
+            state = RackspaceState.create(saved_state)
+            regions.setdefault(state.region, set()).add(state.instance_name)
+
+        def destroy_region(region, names):
+            nova = _connect_to_rackspace(parsed_config, region)
+            servers = [server for server in nova.servers.list()
+                       if server.name in names]
+            log_yellow('deleting {} rackspace instances ...'.format(
+                len(servers)))
+            with private_executor(len(servers)) as deletes:
+                completed_results([deletes.submit(server.delete)
+                                   for server in servers])
+
+            def probe(pending):
+                statuses = dict((server.id, server.status)
+                                for server in nova.servers.list())
+                return dict((server_id, statuses.get(server_id, 'DELETED'))
+                            for server_id in pending)
+
+            wait_for_all(probe, [server.id for server in servers],
+                         lambda status: status == 'DELETED',
+                         'deletion of {} servers'.format(len(servers)))
+
+        with private_executor(len(regions)) as executor:
+            for future in [executor.submit(destroy_region, region, names)
+                           for region, names in regions.items()]:
+                future.result()
+
+    @classmethod
+    def copy_image(cls, config, region, image_id, regions):
+        """
+        Rackspace can't copy images between regions, so this only succeeds
+        for the region the image is in. Build the image in each region
+        instead.
+        """
+        others = [target for target in regions if target != region]
+        if others:
+            raise NotImplementedError(
+                "rackspace images can't be copied to {}".format(
+                    ', '.join(others)))
+        return dict((target, image_id) for target in regions)
+
+    def create_image(self, image_name, labels=None, live=False):
+        """
+        Rackspace images are always snapshots of the running server. Live
+        images use a connection of their own so that several can be made at
+        once.
+        """
+        self.wait_until_ready()
+        nova = self._connect_to_rackspace() if live else self._nova
+        server = nova.servers.find(name=self.state.instance_name)
+        image_id = nova.servers.create_image(server.id,
+                                             image_name=image_name,
+                                             metadata=labels)
         log_green('creating rackspace image...')
-        sleep_time = 20
-        elapsed = 0
-        while self._nova.images.get(image_id).status.lower() not in ['active',
-                                                                     'error']:
-            log_green('building rackspace image, '
-                      'this could take a bit: elapsed {}s.'.format(elapsed))
-            sleep(20)
-            elapsed += sleep_time
+        image = wait_for(
+            lambda: nova.images.get(image_id).status.lower(),
+            lambda status: status in ['active', 'error'],
+            'rackspace image {}'.format(image_id),
+            interval=10)
         if image == 'error':
             log_red('error creating image')
             exit(1)
@@ -184,11 +353,10 @@ class RackspaceInstance(object):
         return image_id
 
     def list_images(self):
-        images = self._nova.images.list()
         log_yellow("creation time\timage_name\timage_id")
-        for image in sorted(images, key=lambda x: x.created):
+        for image in _iter_images(self._nova, self.state.region):
             log_green("{}\t{:50}\t{}".format(
-                image.created, image.human_id, image.id)
+                image.created, image.name, image.image_id)
             )
 
     def delete_image(self, image_id):
@@ -227,3 +395,7 @@ class RackspaceInstance(object):
             'region': self.state.region,
         }
         return data
+
+
+#: ``IAsyncCloudInstanceFactory`` provider for Rackspace instances.
+AsyncRackspaceInstance = AsyncCloudInstanceFactory(RackspaceInstance)
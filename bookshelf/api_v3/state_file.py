@@ -0,0 +1,38 @@
+"""
+Json files holding state that is shared between processes, such as the
+warm pool members and the image build cache.
+"""
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked_json_file(path):
+    """
+    Loads the json object stored in path (an empty dict if the file doesn't
+    exist yet) and writes it back once the block is done.
+
+    All access goes through an exclusive lock on ``<path>.lock``, so several
+    processes can share the same file. Nothing is written if the block
+    raises.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(path):
+                with open(path) as f:
+                    data = json.load(f)
+            else:
+                data = {}
+            yield data
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,100 @@
+"""
+Polling for the cloud operations that only say they're done when asked,
+with an interval that grows from a few seconds up to a ceiling, so short
+operations return quickly and long ones don't hammer the api:
+
+    image = wait_for(lambda: connection.get_image(ami),
+                     lambda image: image.state == 'available',
+                     'ami {}'.format(ami),
+                     failed=lambda image: image.state == 'failed')
+"""
+from bookshelf.api_v2.logging_helpers import log_yellow
+from bookshelf.api_v2.time_helpers import sleep, time
+
+
+class WaitError(Exception):
+    """
+    Raised when something waited for fails or takes too long.
+
+    :ivar description: what was being waited for.
+    :ivar last: the last value returned by the probe.
+    """
+    def __init__(self, description, last):
+        Exception.__init__(self, description, last)
+        self.description = description
+        self.last = last
+
+
+class WaitTimeout(WaitError):
+    def __str__(self):
+        return 'timed out waiting for {}'.format(self.description)
+
+
+class WaitFailed(WaitError):
+    def __str__(self):
+        return '{} failed: {!r}'.format(self.description, self.last)
+
+
+def wait_for(probe, ready, description, timeout=3600, interval=5,
+             max_interval=60, backoff=1.5, failed=None):
+    """
+    Calls probe until its result is ready.
+
+    :param probe: function returning the current state of the thing waited
+        for.
+    :param ready: predicate on the result of probe.
+    :param unicode description: what is being waited for, for logs and
+        errors.
+    :param timeout: seconds to wait before raising WaitTimeout.
+    :param interval: seconds to sleep after the first probe, multiplied by
+        backoff after each probe, up to max_interval.
+    :param failed: optional predicate on the result of probe, WaitFailed is
+        raised as soon as it is true.
+
+    :return: the last result of probe.
+    """
+    deadline = time() + timeout
+    while True:
+        last = probe()
+        if failed is not None and failed(last):
+            raise WaitFailed(description, last)
+        if ready(last):
+            return last
+        if time() + interval > deadline:
+            raise WaitTimeout(description, last)
+        log_yellow('waiting for {}...'.format(description))
+        sleep(interval)
+        interval = min(interval * backoff, max_interval)
+
+
+def wait_for_all(probe, keys, ready, description, timeout=3600, interval=5,
+                 max_interval=60, backoff=1.5, failed=None):
+    """
+    Like wait_for, for many things at once: probe is called with the keys
+    of everything still pending and returns a dict of key to current state,
+    so a single api call can check a whole batch.
+
+    :return dict: every key to its ready state.
+    """
+    keys = list(keys)
+    done = {}
+    deadline = time() + timeout
+    while True:
+        pending = [key for key in keys if key not in done]
+        states = probe(pending)
+        for key in pending:
+            if key not in states:
+                continue
+            if failed is not None and failed(states[key]):
+                raise WaitFailed(u'{} {}'.format(description, key),
+                                 states[key])
+            if ready(states[key]):
+                done[key] = states[key]
+        if len(done) == len(keys):
+            return done
+        if time() + interval > deadline:
+            raise WaitTimeout(description, states)
+        log_yellow('waiting for {}: {} of {} done...'.format(
+            description, len(done), len(keys)))
+        sleep(interval)
+        interval = min(interval * backoff, max_interval)
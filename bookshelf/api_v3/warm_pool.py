@@ -0,0 +1,225 @@
+"""
+A pool of pre-provisioned instances, so that handing out a fresh instance
+only costs starting a stopped one instead of launching, booting and waiting
+for ssh.
+
+Pools are keyed by (cloud, region, distro, config fingerprint) and their
+members are kept as saved states in a json file, so they are shared by every
+process (e.g. CI jobs) using the same file:
+
+    pool = WarmPool(EC2Instance, config, Distribution.UBUNTU1404,
+                    u'us-west-2', size=3)
+    pool.refill()
+    ...
+    instance = pool.acquire()
+
+Members are stopped after creation unless ``keep_running`` is set (Rackspace
+instances can't be stopped, so they are always kept running).
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+from time import time
+
+from concurrent.futures import wait
+from pyrsistent import thaw
+
+from bookshelf.api_v2.logging_helpers import log_green, log_yellow, log_red
+from bookshelf.api_v3.async_instance import submit
+from bookshelf.api_v3.state_file import locked_json_file
+
+DEFAULT_STATE_FILE = os.path.expanduser('~/.bookshelf/warm-pools.json')
+
+# clouds whose instances can't be stopped, their down() leaves them running
+_ALWAYS_RUNNING = frozenset([u'rackspace'])
+
+
+def config_fingerprint(config):
+    """ returns a stable hash of an instance configuration dictionary """
+    return hashlib.sha1(
+        json.dumps(config, sort_keys=True, default=thaw)).hexdigest()
+
+
+class PoolStore(object):
+    """
+    The members of every pool, kept in a json file of the form:
+
+        {"<pool key>": [{"state": <saved state>, "created": <timestamp>}]}
+
+    The file is locked while it is read and updated, so several processes
+    can share it.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def members(self, key):
+        with locked_json_file(self.path) as data:
+            return list(data.get(key, []))
+
+    def add(self, key, member):
+        with locked_json_file(self.path) as data:
+            data.setdefault(key, []).append(member)
+
+    def pop(self, key, max_age):
+        """ removes and returns the oldest member that isn't stale """
+        now = time()
+        with locked_json_file(self.path) as data:
+            members = data.get(key, [])
+            for member in members:
+                if now - member['created'] < max_age:
+                    members.remove(member)
+                    return member
+        return None
+
+    def remove_stale(self, key, max_age):
+        """ removes and returns the members older than max_age seconds """
+        now = time()
+        with locked_json_file(self.path) as data:
+            members = data.get(key, [])
+            stale = [m for m in members if now - m['created'] >= max_age]
+            data[key] = [m for m in members if m not in stale]
+        return stale
+
+
+class WarmPool(object):
+    """
+    Keeps ``size`` ready-made instances for one factory, configuration,
+    distro and region.
+
+    :ivar factory: the ICloudInstanceFactory provider.
+    :ivar int size: the number of instances to keep in the pool.
+    :ivar int max_age: seconds after which a member is destroyed instead of
+        handed out, so that pools don't serve instances built from a stale
+        base image.
+    """
+    def __init__(self, factory, config, distro, region, size=2,
+                 max_age=24 * 60 * 60, keep_running=False,
+                 state_file=DEFAULT_STATE_FILE):
+        self.factory = factory
+        self.config = config
+        self.distro = distro
+        self.region = region
+        self.size = size
+        self.max_age = max_age
+        self.keep_running = (keep_running or
+                             factory.cloud_type in _ALWAYS_RUNNING)
+        self._store = PoolStore(state_file)
+        self._lock = threading.Lock()
+        self._pending = []
+
+    @property
+    def key(self):
+        return u'/'.join([self.factory.cloud_type, self.region,
+                          self.distro.value, config_fingerprint(self.config)])
+
+    def members(self):
+        return self._store.members(self.key)
+
+    def acquire(self):
+        """
+        Hands out an instance from the pool, starting it if it was stopped,
+        and refills the pool in the background. Falls back to creating an
+        instance when the pool is empty.
+
+        :return: an ICloudInstance provider that is up and reachable.
+        """
+        self.recycle()
+        instance = None
+        while instance is None:
+            member = self._store.pop(self.key, self.max_age)
+            if member is None:
+                log_yellow('warm pool {} is empty, creating an '
+                           'instance'.format(self.key))
+                instance = self.factory.create_from_config(
+                    self.config, self.distro, self.region)
+                break
+            try:
+                instance = self.factory.create_from_saved_state(
+                    self.config, member['state'])
+                instance.wait_until_ready()
+            except Exception as e:
+                # the member may have been deleted behind our back, try the
+                # next one
+                log_red('discarding warm pool member {}: {}'.format(
+                    member['state'], e))
+                self._destroy_member(member)
+                instance = None
+        self.refill()
+        return instance
+
+    def refill(self):
+        """
+        Creates instances in the background until the pool is full.
+
+        :return: a list of futures, one per instance being created.
+        """
+        with self._lock:
+            self._pending = [f for f in self._pending if not f.done()]
+            missing = self.size - len(self.members()) - len(self._pending)
+            futures = [submit(self._add_member) for _ in range(missing)]
+            self._pending.extend(futures)
+        for future in futures:
+            future.add_done_callback(self._log_failure)
+        return futures
+
+    def join(self):
+        """ waits for the instances being added in the background """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    def _add_member(self):
+        instance = self.factory.create_from_config(
+            self.config, self.distro, self.region)
+        try:
+            if not self.keep_running:
+                instance.down()
+            self._store.add(self.key, {'state': instance.get_state(),
+                                       'created': time()})
+        except Exception:
+            # it isn't in the store, so nothing else would destroy it
+            error = sys.exc_info()
+            try:
+                instance.destroy()
+            except Exception as e:
+                log_red('could not destroy an instance of warm pool {}: '
+                        '{}'.format(self.key, e))
+            raise error[0], error[1], error[2]
+        log_green('added an instance to warm pool {}'.format(self.key))
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            log_red('could not add an instance to warm pool {}: {}'.format(
+                self.key, future.exception()))
+
+    def _destroy_member(self, member):
+        # it is no longer in the store, so nothing else would destroy it
+        try:
+            self.factory.destroy_all(self.config, [member['state']])
+        except Exception as e:
+            log_red('could not destroy warm pool member {}: {}'.format(
+                member['state'], e))
+
+    def recycle(self):
+        """
+        Destroys, in the background, the members older than ``max_age``.
+
+        :return: a list of futures, empty if there was nothing to destroy.
+        """
+        return self._destroy(self._store.remove_stale(self.key, self.max_age))
+
+    def drain(self):
+        """
+        Destroys, in the background, every member of the pool.
+
+        :return: a list of futures, empty if there was nothing to destroy.
+        """
+        return self._destroy(self._store.remove_stale(self.key, max_age=0))
+
+    def _destroy(self, members):
+        if not members:
+            return []
+        return [submit(self.factory.destroy_all, self.config,
+                       [member['state'] for member in members])]
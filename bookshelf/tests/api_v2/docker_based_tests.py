@@ -1,15 +1,175 @@
+import atexit
+import hashlib
+import multiprocessing
 import os
+import shutil
+import subprocess
+import tempfile
+import traceback
+from Queue import Empty, Queue
+
+from concurrent.futures import ThreadPoolExecutor, wait
 from fabric.api import local, env
 from fabric.context_managers import settings, quiet, show, hide
 
 
+# spare containers kept running for every image
+SPARE_CONTAINERS = int(os.environ.get('BOOKSHELF_DOCKER_SPARES', 2))
+
+
+class ContainerPool(object):
+    """
+    Warm containers of one docker image, so that tests don't wait for
+    docker run and docker rm.
+
+    Every test still gets a container of its own: the image is the clean
+    snapshot and a test can only change the container's writable layer, so
+    a fresh container resets the filesystem. Spare containers are started
+    ahead of time, and used ones are removed in the background.
+
+    docker is called directly rather than through fabric's local(), as
+    these run on threads and fabric's env isn't thread safe.
+    """
+    def __init__(self, image, privileged=False, spares=SPARE_CONTAINERS):
+        self.image = image
+        self.privileged = privileged
+        self._executor = ThreadPoolExecutor(max_workers=spares + 2)
+        self._spares = Queue()
+        self._removals = []
+        for _ in range(max(spares, 1)):
+            self._start_spare()
+
+    def _start_spare(self):
+        self._spares.put(self._executor.submit(
+            _docker_run_in_background, self.image, self.privileged))
+
+    def get(self):
+        """ returns a running container, starting a spare in its place """
+        container = self._spares.get().result()
+        self._start_spare()
+        return container
+
+    def release(self, container):
+        """ removes a used container in the background """
+        self._removals.append(
+            self._executor.submit(_docker_rm_in_background, container))
+
+    def close(self):
+        """ removes the spare containers and waits for all removals """
+        while not self._spares.empty():
+            future = self._spares.get()
+            if future.exception() is None:
+                self.release(future.result())
+        wait(self._removals)
+        self._executor.shutdown()
+
+
+_pools = {}
+
+
+def container_pool(image, privileged=False):
+    """ returns the ContainerPool of an image, starting it if needed """
+    key = (image, privileged)
+    if key not in _pools:
+        _pools[key] = ContainerPool(image, privileged)
+    return _pools[key]
+
+
+@atexit.register
+def close_container_pools():
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
+
+
+def _docker_run_in_background(image, privileged):
+    command = ['docker', 'run', '-d', '-P', image]
+    if privileged:
+        command.insert(2, '--privileged')
+    return subprocess.check_output(command).strip()
+
+
+def _docker_rm_in_background(container):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['docker', 'rm', '--force', container],
+                        stdout=devnull, stderr=devnull)
+
+
+def _run_test(func, args, kwargs, image, host_string, verbose):
+    # set some fabric settings to either be very verbose
+    # or very quiet.
+    if verbose:
+        fabric_flags = show('debug')
+    else:
+        fabric_flags = hide('everything')
+
+    with settings(fabric_flags, host_string=host_string):
+        print("In method: %s for docker image %s" % (
+            func.func_name, image))
+        func(*args, **kwargs)
+
+
+def _run_test_in_child(results, image, *args):
+    try:
+        _run_test(*args)
+        results.put((image, None, None))
+    except BaseException as e:
+        # only the traceback, as exceptions don't all pickle
+        results.put((image, isinstance(e, AssertionError),
+                     traceback.format_exc()))
+
+
+def _run_tests_in_parallel(func, args, kwargs, host_strings, verbose):
+    """
+    runs the test once per image at the same time, each in a process of
+    its own as fabric's env can't be shared between threads, and raises
+    the failures once they are all done.
+    """
+    results = multiprocessing.Queue()
+    children = {}
+    for image, host_string in host_strings:
+        child = multiprocessing.Process(
+            target=_run_test_in_child,
+            args=(results, image, func, args, kwargs, image, host_string,
+                  verbose))
+        child.start()
+        children[image] = child
+
+    failures = {}
+    pending = set(children)
+    while pending:
+        try:
+            image, assertion, error = results.get(timeout=5)
+        except Empty:
+            for image in list(pending):
+                if not children[image].is_alive():
+                    pending.discard(image)
+                    failures[image] = (False, 'exited with %s' % (
+                        children[image].exitcode))
+            continue
+        pending.discard(image)
+        if error is not None:
+            failures[image] = (assertion, error)
+    for child in children.values():
+        child.join()
+
+    if failures:
+        message = '\n'.join('%s:\n%s' % (image, error)
+                            for image, (_, error) in failures.items())
+        if all(assertion for assertion, _ in failures.values()):
+            raise AssertionError(message)
+        raise RuntimeError(message)
+
+
 def with_ephemeral_container(images=None, verbose=False, privileged=False):
     """
-    A decorator that creates ephemeral docker containers, executes the
-    wrapped function and destroys the docker container.
+    A decorator that runs the wrapped function on ephemeral docker
+    containers.
 
     takes a list of docker images, and executes the wrapped function for each
-    one of those images.
+    one of those images, at the same time when there are several. The
+    containers come from a ContainerPool, so each run gets a clean one
+    without waiting for it to start.
 
     params:
         list images: array containing a list of docker images
@@ -22,39 +182,33 @@ def with_ephemeral_container(images=None, verbose=False, privileged=False):
 
     def decorator(func):
         def wrapper(*args, **kwargs):
-            # iterates and executes the wrapped function/testcase
-            # for each one of the docker images.
             # ex: centos, ubuntu-vivid, ubuntu-trusty
-            for image in images:
-                c1 = docker_run(image=image, privileged=privileged)
-                hs = build_host_string(c1, env.docker_host)
-
-                # set some fabric settings to either be very verbose
-                # or very quiet.
-                if verbose:
-                    fabric_flags = show('debug')
+            containers = [(image,
+                           container_pool(image, privileged).get())
+                          for image in images]
+            try:
+                host_strings = [
+                    (image, build_host_string(container, env.docker_host))
+                    for image, container in containers]
+                if len(host_strings) == 1:
+                    image, host_string = host_strings[0]
+                    _run_test(func, args, kwargs, image, host_string,
+                              verbose)
                 else:
-                    fabric_flags = hide('everything')
-
-                with settings(fabric_flags, host_string=hs):
-                    try:
-                        print("In method: %s for docker image %s" % (
-                            func.func_name, image))
-                        func(*args, **kwargs)
-                        docker_rm(c1)
-                    except:
-                        docker_rm(c1)
-                        raise
+                    _run_tests_in_parallel(func, args, kwargs,
+                                           host_strings, verbose)
+            finally:
+                for image, container in containers:
+                    container_pool(image, privileged).release(container)
         return wrapper
     return decorator
 
 
-def build_docker_image(image, base_image, distribution):
+def dockerfile(base_image, distribution):
     """
-    Builds a docker image that will be used in the different TestCases
+    returns the Dockerfile of the image used in the different TestCases
 
     params:
-        string image: tag of the new docker image to produce
         string base_image: name of the base docker image (centos, ...)
         string distribution: which distribution to build (centos/ubuntu)
     """
@@ -68,28 +222,19 @@ def build_docker_image(image, base_image, distribution):
             'RUN chmod 755 /usr/local/bin/wrapdocker'
         ]
     if 'centos' in distribution:
+        # a single layer for all the packages
         contents = [
             'FROM ' + base_image,
             'RUN echo "nameserver 8.8.8.8 > /etc/resolv.conf"',
             # fix for: https://bugzilla.redhat.com/show_bug.cgi?id=1213602#c13
-            'RUN yum clean all',
-            'RUN touch /var/lib/rpm/*',
-            'RUN yum install --disableplugin=fastestmirror -y yum-utils',
-            'RUN yum install --disableplugin=fastestmirror -y openssh-server',
-            'RUN ssh-keygen -b 1024 -t rsa -f /etc/ssh/ssh_host_key',
-            'RUN ssh-keygen -b 1024 -t rsa -f /etc/ssh/ssh_host_rsa_key',  # noqa
-            'RUN ssh-keygen -b 1024 -t dsa -f /etc/ssh/ssh_host_dsa_key',  # noqa
-            'RUN yum install --disableplugin=fastestmirror -y yum-utils',
-            'RUN yum install --disableplugin=fastestmirror -y sudo',
-            'RUN yum install --disableplugin=fastestmirror -y openssh-server',
-            'RUN yum install --disableplugin=fastestmirror -y rubygems',
-            'RUN yum install --disableplugin=fastestmirror -y python-devel',
-            'RUN yum install --disableplugin=fastestmirror -y curl',
-            'RUN yum install --disableplugin=fastestmirror -y wget',
-            'RUN curl "https://bootstrap.pypa.io/get-pip.py" -o "get-pip.py"',
-            'RUN cd /usr/local/bin && wget -c https://raw.githubusercontent.com/jpetazzo/dind/master/wrapdocker',
-            'RUN chmod 755 /usr/local/bin/wrapdocker',
-            'RUN python get-pip.py'
+            'RUN yum clean all && touch /var/lib/rpm/* && '
+            'yum install --disableplugin=fastestmirror -y '
+            'yum-utils openssh-server sudo rubygems python-devel curl wget',
+            'RUN ssh-keygen -b 1024 -t rsa -f /etc/ssh/ssh_host_key && '
+            'ssh-keygen -b 1024 -t rsa -f /etc/ssh/ssh_host_rsa_key && '
+            'ssh-keygen -b 1024 -t dsa -f /etc/ssh/ssh_host_dsa_key',
+            'RUN curl "https://bootstrap.pypa.io/get-pip.py" -o "get-pip.py" && python get-pip.py',  # noqa
+            'RUN cd /usr/local/bin && wget -c https://raw.githubusercontent.com/jpetazzo/dind/master/wrapdocker && chmod 755 wrapdocker',  # noqa
         ]
 
     contents = contents + [
@@ -103,13 +248,69 @@ def build_docker_image(image, base_image, distribution):
         'EXPOSE 22',
         'CMD ["/usr/sbin/sshd", "-D"]'
     ]
+    return '\n'.join(contents)
+
+
+def content_tag(image, contents):
+    """
+    returns the image name tagged with a hash of its Dockerfile, so that
+    an image is only ever built once for the same Dockerfile
+
+    params:
+        string image: name of the docker image
+        string contents: its Dockerfile
+    """
+    return '%s:%s' % (image, hashlib.sha1(contents).hexdigest()[:12])
 
-    dockerfile = 'Dockerfile.' + distribution
-    with open(dockerfile, 'w') as f:
-        f.write('\n'.join(contents))
 
-    local('docker build -f %s -t %s .' % (dockerfile, image),
-          capture=False)
+def _docker(*args):
+    """ runs a docker command, returns True if it succeeded """
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(('docker',) + args,
+                               stdout=devnull, stderr=devnull) == 0
+
+
+def build_docker_image(image, base_image, distribution, registry=None):
+    """
+    Makes sure the docker image used in the different TestCases is up to
+    date, building it only if no image was built from the same Dockerfile
+    yet, locally or in the registry. The image is also tagged as plain
+    ``image``, which is what the tests run.
+
+    docker is called directly rather than through fabric's local(), as
+    images are built on threads and fabric's env isn't thread safe.
+
+    params:
+        string image: name of the new docker image to produce
+        string base_image: name of the base docker image (centos, ...)
+        string distribution: which distribution to build (centos/ubuntu)
+        string registry: optional registry shared by CI workers,
+            e.g. registry.example.com/bookshelf
+    """
+    contents = dockerfile(base_image, distribution)
+    tag = content_tag(image, contents)
+    remote_tag = registry and '%s/%s' % (registry, tag)
+
+    if _docker('inspect', '--type=image', tag):
+        print('docker image %s is up to date' % tag)
+    elif remote_tag and _docker('pull', remote_tag):
+        print('pulled docker image %s' % remote_tag)
+        _docker('tag', remote_tag, tag)
+    else:
+        print('building docker image %s' % tag)
+        # a directory of its own, for a build context with nothing else
+        build_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(build_dir, 'Dockerfile'), 'w') as f:
+                f.write(contents)
+            subprocess.check_call(['docker', 'build', '-t', tag, build_dir])
+        finally:
+            shutil.rmtree(build_dir)
+        if remote_tag and _docker('tag', tag, remote_tag):
+            if not _docker('push', remote_tag):
+                print('could not push docker image %s' % remote_tag)
+    subprocess.check_call(['docker', 'tag', tag, image])
+    return tag
 
 
 def docker_run(image, privileged=False):
@@ -222,12 +423,14 @@ def prepare_required_docker_images():
     env.password = 'root'
     env.user = 'root'
 
-    # build the docker images we require to run the tests
-    for item in images:
-        if item['image'] not in local('docker images', capture=True):
-            print('building docker image %s' % item['image'])
-            build_docker_image(
-                image=item['image'],
-                base_image=item['base_image'],
-                distribution=item['distribution']
-            )
+    # build the docker images we require to run the tests, at the same time
+    registry = os.environ.get('BOOKSHELF_DOCKER_REGISTRY')
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        builds = [executor.submit(build_docker_image,
+                                  image=item['image'],
+                                  base_image=item['base_image'],
+                                  distribution=item['distribution'],
+                                  registry=registry)
+                  for item in images]
+    for build in builds:
+        build.result()
@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from fabric.api import get, put, run, settings, sudo
+from fabric.operations import _AttributeString
+
+from bookshelf.api_v2.cassette import CassetteMismatch, cassette
+from bookshelf.api_v2.command_hooks import command_hook
+
+OUTPUTS = {'cat /etc/os-release': ('ID=centos', 0),
+           'rpm -q fish': ('package fish is not installed', 1)}
+
+
+def fake_host(run_command, command, options):
+    stdout, return_code = OUTPUTS[command]
+    result = _AttributeString(stdout)
+    result.stderr = _AttributeString('')
+    result.return_code = return_code
+    return result
+
+
+class CassetteTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cassette.json')
+
+    def _record(self):
+        with settings(host_string='root@host'):
+            with cassette(self.path, mode='record'):
+                with command_hook(fake_host):
+                    run('cat /etc/os-release')
+                    sudo('rpm -q fish', warn_only=True)
+
+    def test_replays_recorded_commands_without_a_host(self):
+        self._record()
+
+        with cassette(self.path, mode='replay'):
+            release = run('cat /etc/os-release')
+            query = sudo('rpm -q fish', warn_only=True)
+
+        self.assertEqual(release, 'ID=centos')
+        self.assertEqual(query.return_code, 1)
+        self.assertTrue(query.failed)
+
+    def test_replayed_failures_abort(self):
+        self._record()
+
+        with cassette(self.path, mode='replay'):
+            run('cat /etc/os-release')
+            with self.assertRaises(SystemExit):
+                sudo('rpm -q fish')
+
+    def test_different_commands_do_not_match(self):
+        self._record()
+
+        with cassette(self.path, mode='replay'):
+            with self.assertRaises(CassetteMismatch):
+                run('cat /etc/redhat-release')
+
+    def test_defaults_to_replaying_existing_cassettes(self):
+        self._record()
+
+        with cassette(self.path) as recording:
+            self.assertTrue(recording.replaying)
+
+    def test_replays_file_transfers(self):
+        with open(self.path, 'w') as f:
+            json.dump({'interactions': [
+                {'type': 'sftp', 'method': 'normalize', 'path': '.',
+                 'result': '/root'},
+                {'type': 'sftp', 'method': 'exists', 'path': '/etc/motd',
+                 'result': True},
+                {'type': 'put', 'remote_path': '/etc/motd',
+                 'use_sudo': False, 'text': 'hello', 'result': '/etc/motd'},
+                {'type': 'sftp', 'method': 'normalize', 'path': '.',
+                 'result': '/root'},
+                {'type': 'sftp', 'method': 'isdir', 'path': '/etc/motd',
+                 'result': False},
+                {'type': 'sftp', 'method': 'isdir', 'path': '/etc/motd',
+                 'result': False},
+                {'type': 'get', 'remote_path': '/etc/motd',
+                 'use_sudo': False, 'text': 'hello', 'result': ''},
+            ]}, f)
+        downloaded = StringIO()
+
+        with cassette(self.path, mode='replay'):
+            put(StringIO('hello'), '/etc/motd')
+            get('/etc/motd', downloaded)
+
+        self.assertEqual(downloaded.getvalue(), 'hello')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
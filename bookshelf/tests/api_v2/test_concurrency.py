@@ -0,0 +1,152 @@
+import threading
+import unittest
+
+from fabric.api import env
+from fabric.exceptions import NetworkError
+from novaclient.exceptions import OverLimit
+
+from bookshelf.api_v2.concurrency import (
+    AdaptiveConcurrency,
+    FanOutError,
+    congestion_signal,
+    run_on_hosts
+)
+from bookshelf.api_v2.metrics import MetricsRegistry
+
+
+def controller(**kwargs):
+    registry = MetricsRegistry()
+    kwargs.setdefault('latency_tolerance', None)
+    return AdaptiveConcurrency('test', registry=registry, **kwargs), registry
+
+
+class CongestionSignalTests(unittest.TestCase):
+
+    def test_signals(self):
+        self.assertEqual(congestion_signal(OverLimit(413, retry_after=5)),
+                         'throttle')
+        self.assertEqual(congestion_signal(NetworkError('timed out')), 'ssh')
+        self.assertIsNone(congestion_signal(ValueError()))
+
+
+class AdaptiveConcurrencyTests(unittest.TestCase):
+
+    def test_limit_grows_by_one_per_window(self):
+        concurrency, _ = controller(initial=4)
+
+        for _ in range(4):
+            concurrency.release(concurrency.acquire())
+
+        self.assertEqual(concurrency.limit, 5)
+
+    def test_congestion_halves_the_limit_once(self):
+        concurrency, registry = controller(initial=8)
+        started = [concurrency.acquire() for _ in range(3)]
+
+        for start in started:
+            concurrency.release(start, 'ssh')
+
+        self.assertEqual(concurrency.limit, 4)
+        self.assertEqual(registry.events(kind='concurrency')[0]['reason'],
+                         'ssh')
+        self.assertEqual(registry.gauge('concurrency.test.limit'), 4)
+
+    def test_limit_stays_within_bounds(self):
+        concurrency, _ = controller(initial=2, minimum=2, maximum=3)
+
+        concurrency.release(concurrency.acquire(), 'throttle')
+        self.assertEqual(concurrency.limit, 2)
+
+        for _ in range(20):
+            concurrency.release(concurrency.acquire())
+        self.assertEqual(concurrency.limit, 3)
+
+    def test_unrelated_failures_leave_the_limit_alone(self):
+        concurrency, _ = controller(initial=4)
+
+        concurrency.release(concurrency.acquire(), failed=True)
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_try_acquire_respects_the_limit(self):
+        concurrency, _ = controller(initial=1)
+        concurrency.try_acquire()
+
+        self.assertIsNone(concurrency.try_acquire())
+
+    def test_slow_operations_are_congestion(self):
+        concurrency, _ = controller(initial=8, latency_tolerance=2.0,
+                                    smoothing=1.0)
+        concurrency.release(concurrency.acquire())
+
+        concurrency.release(concurrency.acquire() - 10)
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_slot_sees_throttles_recorded_meanwhile(self):
+        concurrency, registry = controller(initial=8)
+
+        with concurrency.slot():
+            registry.record_event('throttle', 'ec2.RunInstances')
+
+        self.assertEqual(concurrency.limit, 4)
+        self.assertEqual(concurrency.in_flight, 0)
+
+    def test_slot_ignores_throttles_of_other_threads(self):
+        concurrency, registry = controller(initial=8)
+        other = threading.Thread(target=registry.record_event,
+                                 args=('throttle', 'ec2.RunInstances'))
+
+        with concurrency.slot():
+            other.start()
+            other.join()
+
+        self.assertEqual(concurrency.limit, 8)
+
+
+def host_string():
+    return env.host_string
+
+
+def unpicklable():
+    return threading.Lock()
+
+
+def fail_on_b():
+    if env.host_string == 'b':
+        raise ValueError('broken')
+    return env.host_string
+
+
+class RunOnHostsTests(unittest.TestCase):
+
+    def test_runs_task_with_each_host_string(self):
+        concurrency, _ = controller(initial=2)
+
+        results = run_on_hosts(['a', 'b', 'c'], host_string,
+                               controller=concurrency)
+
+        self.assertEqual(results, {'a': 'a', 'b': 'b', 'c': 'c'})
+        self.assertEqual(concurrency.in_flight, 0)
+
+    def test_failures_are_raised_once_all_hosts_are_done(self):
+        concurrency, _ = controller(initial=2)
+
+        with self.assertRaises(FanOutError) as raised:
+            run_on_hosts(['a', 'b', 'c'], fail_on_b, controller=concurrency)
+
+        self.assertEqual(raised.exception.results, {'a': 'a', 'c': 'c'})
+        self.assertIn('broken', raised.exception.errors['b'])
+
+    def test_results_that_never_arrive_are_failures(self):
+        concurrency, _ = controller(initial=2)
+
+        with self.assertRaises(FanOutError) as raised:
+            run_on_hosts(['a'], unpicklable, controller=concurrency)
+
+        self.assertIn('without a result', raised.exception.errors['a'])
+        self.assertEqual(concurrency.in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -0,0 +1,93 @@
+import os
+import unittest
+from StringIO import StringIO
+
+from fabric.api import cd, get, put, run, sudo
+from fabric.contrib.files import append, contains, exists
+
+from bookshelf.api_v2.fake_host import fake_host
+from bookshelf.api_v2.file import insert_line_in_file_after_regex
+from bookshelf.api_v2.os_helpers import dir_ensure, dir_exists, systemd
+from bookshelf.api_v2.pkg import (is_deb_package_installed,
+                                  is_rpm_package_installed)
+
+
+class FakeHostTests(unittest.TestCase):
+
+    def setUp(self):
+        manager = fake_host()
+        self.host = manager.__enter__()
+        self.addCleanup(manager.__exit__, None, None, None)
+
+    def test_commands_run_in_the_sandbox(self):
+        sudo('echo hello > /etc/motd')
+
+        with open(self.host.path('/etc/motd')) as f:
+            self.assertEqual(f.read(), 'hello\n')
+        self.assertEqual(run('cat /etc/motd'), 'hello')
+
+    def test_failures_abort(self):
+        with self.assertRaises(SystemExit):
+            run('cat /etc/missing')
+
+    def test_honors_cd(self):
+        run('mkdir -p /opt/app')
+
+        with cd('/opt/app'):
+            run('touch marker')
+
+        self.assertTrue(os.path.exists(self.host.path('/opt/app/marker')))
+
+    def test_transfers_files(self):
+        downloaded = StringIO()
+
+        put(StringIO('hello'), '/etc/motd', use_sudo=True)
+        get('/etc/motd', downloaded, use_sudo=True)
+
+        self.assertEqual(downloaded.getvalue(), 'hello')
+
+    def test_contrib_files(self):
+        append('/etc/sudoers', 'Defaults !requiretty', use_sudo=True)
+
+        self.assertTrue(exists('/etc/sudoers'))
+        self.assertTrue(contains('/etc/sudoers', 'requiretty'))
+
+    def test_insert_line_in_file_after_regex(self):
+        put(StringIO('[main]\nkeepcache=0\n'), '/etc/yum.conf')
+
+        changed = insert_line_in_file_after_regex(
+            '/etc/yum.conf', 'proxy=http://proxy:3128', r'\[main\]',
+            use_sudo=True)
+
+        self.assertTrue(changed)
+        self.assertEqual(run('sed -n 2p /etc/yum.conf'),
+                         'proxy=http://proxy:3128')
+
+    def test_dir_ensure(self):
+        dir_ensure('/opt/app/logs', recursive=True, mode='750',
+                   owner='app', use_sudo=True)
+
+        self.assertTrue(dir_exists('/opt/app/logs'))
+        self.assertEqual(
+            oct(os.stat(self.host.path('/opt/app/logs')).st_mode & 0777),
+            '0750')
+
+    def test_packages(self):
+        self.host.install('fish')
+        sudo('/usr/bin/apt-get install -y git')
+
+        self.assertTrue(is_rpm_package_installed('fish'))
+        self.assertFalse(is_rpm_package_installed('zsh'))
+        self.assertTrue(is_deb_package_installed('git'))
+        self.assertFalse(is_deb_package_installed('zsh'))
+
+    def test_systemctl(self):
+        systemd('docker', start=True, enabled=False)
+
+        self.assertEqual(self.host.unit_state('docker'), (True, False))
+        self.assertEqual(
+            sudo('systemctl is-active docker', warn_only=True), 'active')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
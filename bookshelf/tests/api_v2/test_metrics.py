@@ -0,0 +1,184 @@
+import json
+import os
+import tempfile
+import unittest
+
+import httplib2
+from boto.exception import EC2ResponseError
+from googleapiclient.errors import HttpError
+from novaclient.exceptions import OverLimit
+
+from bookshelf.api_v2 import metrics as metrics_module
+from bookshelf.api_v2.metrics import (
+    Histogram,
+    MetricsRegistry,
+    instrument_ec2_connection,
+    is_throttling_error,
+    record_retry
+)
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_observe_puts_values_in_the_right_buckets(self):
+        histogram = Histogram(buckets=(1, 10, float('inf')))
+        for value in [0.5, 1, 5, 100]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.min, 0.5)
+        self.assertEqual(histogram.max, 100)
+        self.assertEqual(histogram.to_dict()['buckets']['+Inf'], 1)
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def test_timed_counts_calls_and_errors(self):
+        registry = MetricsRegistry()
+        with registry.timed('ec2.DescribeVolumes'):
+            pass
+        with self.assertRaises(ValueError):
+            with registry.timed('ec2.DescribeVolumes'):
+                raise ValueError()
+
+        stats = registry.snapshot()['operations']['ec2.DescribeVolumes']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['latency']['count'], 2)
+
+    def test_timed_records_throttling_errors(self):
+        registry = MetricsRegistry()
+        with self.assertRaises(OverLimit):
+            with registry.timed('rackspace.GET /servers'):
+                raise OverLimit(413, retry_after=5)
+
+        self.assertEqual(len(registry.events(kind='throttle')), 1)
+        self.assertEqual(
+            registry.snapshot()['operations']
+            ['rackspace.GET /servers']['throttles'], 1)
+
+    def test_record_retry_counts_retries(self):
+        registry = MetricsRegistry()
+        record_retry('ec2.DeleteVolume', registry=registry, volume_id='v-1')
+        record_retry('ec2.DeleteVolume', registry=registry, volume_id='v-1')
+
+        self.assertEqual(
+            registry.snapshot()['operations']['ec2.DeleteVolume']['retries'],
+            2)
+        self.assertEqual(registry.events()[0]['volume_id'], 'v-1')
+
+    def test_dump_writes_json(self):
+        registry = MetricsRegistry()
+        with registry.timed('gce.compute.instances.get'):
+            pass
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+
+        registry.dump(path)
+
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(
+            data['operations']['gce.compute.instances.get']['calls'], 1)
+
+
+class IsThrottlingErrorTests(unittest.TestCase):
+
+    def test_ec2_request_limit_exceeded_is_throttling(self):
+        error = EC2ResponseError(
+            503, 'Service Unavailable',
+            '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+            '<Message>Request limit exceeded.</Message></Error></Errors>'
+            '</Response>')
+        self.assertTrue(is_throttling_error(error))
+
+    def test_gce_rate_limit_is_throttling(self):
+        error = HttpError(httplib2.Response({'status': 403}),
+                          b'{"error": {"errors": '
+                          b'[{"reason": "rateLimitExceeded"}]}}')
+        self.assertTrue(is_throttling_error(error))
+
+    def test_gce_not_found_is_not_throttling(self):
+        error = HttpError(httplib2.Response({'status': 404}), b'not found')
+        self.assertFalse(is_throttling_error(error))
+
+    def test_other_exceptions_are_not_throttling(self):
+        self.assertFalse(is_throttling_error(Exception('boom')))
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeEC2Connection(object):
+    """
+    Stands in for a boto connection, which routes every api call through
+    make_request.
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        return self.response
+
+    def get_all_volumes(self):
+        return self.make_request('DescribeVolumes')
+
+
+class InstrumentEc2ConnectionTests(unittest.TestCase):
+
+    def test_instrument_ec2_connection_counts_api_calls(self):
+        registry = MetricsRegistry()
+        conn = instrument_ec2_connection(
+            FakeEC2Connection(FakeResponse(200)), registry=registry)
+
+        conn.get_all_volumes()
+        conn.get_all_volumes()
+
+        self.assertEqual(registry.call_count('ec2.DescribeVolumes'), 2)
+        self.assertTrue(isinstance(conn, FakeEC2Connection))
+
+    def test_instrument_ec2_connection_only_wraps_once(self):
+        registry = MetricsRegistry()
+        conn = FakeEC2Connection(FakeResponse(200))
+        instrument_ec2_connection(conn, registry=registry)
+        instrument_ec2_connection(conn, registry=registry)
+
+        conn.get_all_volumes()
+
+        self.assertEqual(registry.call_count('ec2.DescribeVolumes'), 1)
+
+    def test_instrument_ec2_connection_records_throttling(self):
+        registry = MetricsRegistry()
+        conn = instrument_ec2_connection(
+            FakeEC2Connection(
+                FakeResponse(503, '<Code>RequestLimitExceeded</Code>')),
+            registry=registry)
+
+        conn.get_all_volumes()
+
+        self.assertEqual(len(registry.events(kind='throttle')), 1)
+
+
+class RackspaceOperationTests(unittest.TestCase):
+
+    def test_rackspace_operation_drops_ids(self):
+        self.assertEqual(
+            metrics_module._rackspace_operation(
+                'https://dfw.servers.api.rackspacecloud.com/v2/123456/'
+                'servers/0b5a4d9e-4c6f-4d7c-8a8f-1f2e3d4c5b6a/action',
+                'POST'),
+            'rackspace.POST /servers/action')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -0,0 +1,304 @@
+import threading
+import unittest
+from time import time
+
+import httplib2
+from boto.exception import BotoServerError, EC2ResponseError
+from googleapiclient.errors import HttpError
+from novaclient.exceptions import OverLimit
+
+from bookshelf.api_v2.metrics import metrics
+from bookshelf.api_v2.time_helpers import VirtualClock, use_clock
+from bookshelf.api_v2.ratelimit import (
+    RateLimiter,
+    TokenBucket,
+    decorrelated_jitter,
+    execute_batch,
+    rate_limit_ec2_connection
+)
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_burst_is_available_at_once(self):
+        bucket = TokenBucket(rate=1, burst=5)
+        start = time()
+
+        for _ in range(5):
+            bucket.acquire()
+
+        self.assertLess(time() - start, 0.5)
+
+    def test_acquire_waits_for_a_refill(self):
+        bucket = TokenBucket(rate=20, burst=1)
+        bucket.acquire()
+        start = time()
+
+        bucket.acquire()
+
+        self.assertGreaterEqual(time() - start, 0.04)
+
+    def test_threads_share_the_rate(self):
+        bucket = TokenBucket(rate=50, burst=1)
+        start = time()
+        threads = [threading.Thread(target=bucket.acquire)
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertGreaterEqual(time() - start, 0.09)
+
+
+class DecorrelatedJitterTests(unittest.TestCase):
+
+    def test_delays_stay_within_bounds(self):
+        delays = decorrelated_jitter(0.5, 4)
+        values = [next(delays) for _ in range(100)]
+
+        self.assertTrue(all(0.5 <= value <= 4 for value in values))
+        self.assertEqual(max(values), 4)
+
+
+def limiter():
+    return RateLimiter(rates={'rackspace': (1000, 1000),
+                              'ec2': (1000, 1000)},
+                       max_attempts=3, base_delay=0.001, max_delay=0.002)
+
+
+class RateLimiterTests(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_throttled_calls_are_retried(self):
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OverLimit(413, retry_after=5)
+            return 'done'
+
+        result = limiter().call('rackspace', 'DFW', 'rackspace.GET', call)
+
+        self.assertEqual(result, 'done')
+        self.assertEqual(len(metrics.events(kind='retry')), 2)
+
+    def test_gives_up_after_max_attempts(self):
+        def call():
+            raise OverLimit(413, retry_after=5)
+
+        self.assertRaises(OverLimit, limiter().call,
+                          'rackspace', 'DFW', 'rackspace.GET', call)
+
+    def test_rate_limit_details_count_as_throttling(self):
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise OverLimit(413, 'This request was rate-limited.')
+            return 'done'
+
+        self.assertEqual(
+            limiter().call('rackspace', 'DFW', 'rackspace.GET', call), 'done')
+
+    def test_absolute_quotas_are_not_retried(self):
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            raise OverLimit(413, 'Quota exceeded for instances: Requested '
+                                 '1, but already used 100 of 100 instances')
+
+        self.assertRaises(OverLimit, limiter().call,
+                          'rackspace', 'DFW', 'rackspace.GET', call)
+        self.assertEqual(len(attempts), 1)
+
+    def test_other_errors_are_not_retried(self):
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            raise ValueError()
+
+        self.assertRaises(ValueError, limiter().call,
+                          'rackspace', 'DFW', 'rackspace.GET', call)
+        self.assertEqual(len(attempts), 1)
+
+    def test_buckets_are_per_cloud_and_region(self):
+        rate_limiter = limiter()
+
+        self.assertIs(rate_limiter.bucket('ec2', 'us-west-2'),
+                      rate_limiter.bucket('ec2', 'us-west-2'))
+        self.assertIsNot(rate_limiter.bucket('ec2', 'us-west-2'),
+                         rate_limiter.bucket('ec2', 'us-east-1'))
+
+
+THROTTLED = ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+             '<Message>Request limit exceeded.</Message></Error></Errors>'
+             '</Response>')
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, body=''):
+        self.status = status
+        self.reason = 'reason'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeEC2Connection(object):
+    """ a boto connection, whose _mexe retries 5xx responses as boto's """
+    ResponseError = EC2ResponseError
+    num_retries = 2
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def _mexe(self, request, sender=None, override_num_retries=None,
+              retry_handler=None):
+        for attempt in range(self.num_retries + 1):
+            response = self.responses.pop(0)
+            if retry_handler is not None:
+                retry_handler(response, attempt, 0)
+            if response.status < 500:
+                return response
+        raise BotoServerError(response.status, response.reason,
+                              response.body)
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        return self._mexe(action)
+
+
+class RateLimitEc2ConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_throttled_responses_are_retried(self):
+        ok = FakeResponse(200)
+        conn = rate_limit_ec2_connection(
+            FakeEC2Connection([FakeResponse(503, THROTTLED), ok]),
+            limiter=limiter())
+
+        self.assertIs(conn.make_request('DescribeVolumes'), ok)
+        self.assertEqual(len(metrics.events('retry')), 1)
+
+    def test_boto_leaves_throttled_responses_to_the_limiter(self):
+        ok = FakeResponse(200)
+        throttled = rate_limit_ec2_connection(
+            FakeEC2Connection([FakeResponse(503, THROTTLED)] * 3 + [ok]),
+            limiter=limiter())
+
+        with self.assertRaises(EC2ResponseError) as e:
+            throttled.make_request('DescribeVolumes')
+
+        self.assertEqual(e.exception.error_code, 'RequestLimitExceeded')
+        self.assertEqual(throttled.responses, [ok])
+
+    def test_other_server_errors_are_retried_by_boto(self):
+        ok = FakeResponse(200)
+        conn = rate_limit_ec2_connection(
+            FakeEC2Connection([FakeResponse(500), ok]), limiter=limiter())
+
+        self.assertIs(conn.make_request('DescribeVolumes'), ok)
+        self.assertEqual(metrics.events('retry'), [])
+
+    def test_errors_are_not_retried(self):
+        error = FakeResponse(400, '<Code>InvalidVolume.NotFound</Code>')
+        conn = rate_limit_ec2_connection(
+            FakeEC2Connection([error, FakeResponse(200)]), limiter=limiter())
+
+        self.assertIs(conn.make_request('DeleteVolume'), error)
+
+
+def http_error(status, reason):
+    return HttpError(httplib2.Response({'status': status}), reason)
+
+
+class FakeBatch(object):
+    """
+    a googleapiclient batch request, answering each request with the next
+    of its outcomes: a response or an exception
+    """
+    def __init__(self, outcomes, callback, batches):
+        self._outcomes = outcomes
+        self._callback = callback
+        self.request_ids = []
+        batches.append(self)
+
+    def add(self, request, request_id):
+        self.request_ids.append(request_id)
+
+    def execute(self):
+        for request_id in self.request_ids:
+            outcome = self._outcomes[request_id].pop(0)
+            if isinstance(outcome, Exception):
+                self._callback(request_id, None, outcome)
+            else:
+                self._callback(request_id, outcome, None)
+
+
+class ExecuteBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.batches = []
+        self.results = {}
+
+    def _execute(self, outcomes):
+        def callback(request_id, response, exception):
+            self.results[request_id] = exception or response
+
+        execute_batch(
+            lambda callback: FakeBatch(outcomes, callback, self.batches),
+            [(key, object()) for key in sorted(outcomes)], callback,
+            limiter=limiter())
+
+    def test_throttled_requests_are_retried_on_their_own(self):
+        self._execute({
+            'a': ['done'],
+            'b': [http_error(403, b'rateLimitExceeded'), 'done'],
+        })
+
+        self.assertEqual(self.results, {'a': 'done', 'b': 'done'})
+        self.assertEqual([b.request_ids for b in self.batches],
+                         [['a', 'b'], ['b']])
+        self.assertEqual(len(metrics.events('throttle')), 1)
+        self.assertEqual(len(metrics.events('retry')), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        throttled = http_error(429, b'rateLimitExceeded')
+        self._execute({'a': [throttled] * 3})
+
+        self.assertIs(self.results['a'], throttled)
+        self.assertEqual(len(self.batches), 3)
+
+    def test_other_errors_are_not_retried(self):
+        missing = http_error(404, b'not found')
+        self._execute({'a': [missing]})
+
+        self.assertIs(self.results['a'], missing)
+        self.assertEqual(len(self.batches), 1)
+
+    def test_takes_a_token_per_request(self):
+        with use_clock(VirtualClock()) as virtual:
+            execute_batch(
+                lambda callback: FakeBatch(
+                    dict((key, ['done']) for key in range(40)), callback,
+                    self.batches),
+                [(key, object()) for key in range(40)],
+                lambda request_id, response, exception: None,
+                limiter=RateLimiter(rates={'gce': (10, 20)}))
+
+        self.assertAlmostEqual(virtual.time(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
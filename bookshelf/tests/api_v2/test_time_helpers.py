@@ -0,0 +1,78 @@
+import socket
+import threading
+import unittest
+from time import time as wall_time
+
+from bookshelf.api_v2.cloud import wait_for_ssh
+from bookshelf.api_v2.ratelimit import TokenBucket
+from bookshelf.api_v2.time_helpers import (
+    Clock, VirtualClock, clock, sleep_for_one_minute, use_clock, wait
+)
+from bookshelf.api_v3.waiter import WaitTimeout, wait_for
+
+
+def closed_port():
+    """ returns a local port nothing listens on """
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class VirtualClockTests(unittest.TestCase):
+
+    def setUp(self):
+        self.started = wall_time()
+
+    def tearDown(self):
+        self.assertLess(wall_time() - self.started, 5)
+
+    def test_sleeping_advances_the_clock(self):
+        with use_clock(VirtualClock(start=100)) as virtual:
+            sleep_for_one_minute()
+
+        self.assertEqual(virtual.time(), 160)
+        self.assertEqual(virtual.sleeps, [60])
+
+    def test_restores_the_wall_clock(self):
+        with use_clock(VirtualClock()):
+            pass
+
+        self.assertIsInstance(clock(), Clock)
+
+    def test_waiting_on_an_event(self):
+        event = threading.Event()
+        with use_clock(VirtualClock()) as virtual:
+            self.assertFalse(wait(event, 30))
+            event.set()
+            self.assertTrue(wait(event, 30))
+
+        self.assertEqual(virtual.time(), 30)
+
+    def test_wait_for_times_out_in_virtual_time(self):
+        with use_clock(VirtualClock()) as virtual:
+            with self.assertRaises(WaitTimeout):
+                wait_for(lambda: 'pending', lambda s: False, 'image',
+                         timeout=3600)
+
+        self.assertLessEqual(virtual.time(), 3600)
+        self.assertGreater(virtual.time(), 3000)
+
+    def test_wait_for_ssh(self):
+        with use_clock(VirtualClock()) as virtual:
+            wait_for_ssh('127.0.0.1', closed_port(), timeout=600)
+
+        self.assertEqual(virtual.time(), 599)
+
+    def test_token_bucket_refills_in_virtual_time(self):
+        with use_clock(VirtualClock()) as virtual:
+            bucket = TokenBucket(rate=1, burst=2)
+            for _ in range(4):
+                bucket.acquire()
+
+        self.assertAlmostEqual(virtual.time(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+
+from fabric.api import run, settings
+from fabric.operations import _AttributeString
+
+from bookshelf.api_v2.command_hooks import command_hook
+from bookshelf.api_v2.tracing import tracer, traced, Tracer
+
+
+def fake_remote(run_command, command, options):
+    """ command hook that answers every command without a remote host """
+    result = _AttributeString('output of %s' % command)
+    result.return_code = 0
+    result.stderr = ''
+    return result
+
+
+@traced
+def example_helper():
+    run('uname -a')
+    run('uptime')
+
+
+class TracerTests(unittest.TestCase):
+
+    def test_span_records_parent(self):
+        t = Tracer()
+        with t.span('outer') as outer:
+            with t.span('inner') as inner:
+                pass
+
+        self.assertEqual(inner.parent_id, outer.span_id)
+        self.assertEqual(outer.parent_id, None)
+        self.assertEqual([s.name for s in t.spans()], ['outer', 'inner'])
+
+    def test_keeps_only_the_newest_spans(self):
+        t = Tracer(max_spans=2)
+        for name in ['first', 'second', 'third']:
+            with t.span(name):
+                pass
+
+        self.assertEqual([s.name for s in t.spans()], ['second', 'third'])
+
+    def test_span_records_errors(self):
+        t = Tracer()
+        with self.assertRaises(ValueError):
+            with t.span('failing'):
+                raise ValueError('boom')
+
+        self.assertIn('boom', t.spans()[0].attributes['error'])
+
+    def test_to_chrome_trace_has_one_process_per_host(self):
+        t = Tracer()
+        with t.span('a', host='root@host1'):
+            pass
+        with t.span('b', host='root@host2'):
+            pass
+
+        events = t.to_chrome_trace()['traceEvents']
+        metadata = [e for e in events if e['ph'] == 'M']
+        complete = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(sorted(e['args']['name'] for e in metadata),
+                         ['root@host1', 'root@host2'])
+        self.assertEqual(len(complete), 2)
+        self.assertNotEqual(complete[0]['pid'], complete[1]['pid'])
+
+    def test_export_chrome_trace_writes_json(self):
+        t = Tracer()
+        with t.span('a'):
+            pass
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+
+        t.export_chrome_trace(path)
+
+        with open(path) as f:
+            self.assertIn('traceEvents', json.load(f))
+
+
+class TracedHelperTests(unittest.TestCase):
+
+    def setUp(self):
+        tracer.reset()
+
+    def test_remote_commands_are_children_of_the_helper(self):
+        with settings(host_string='root@example.com'), \
+                command_hook(fake_remote):
+            example_helper()
+
+        helper, first, second = tracer.spans()
+        self.assertTrue(helper.name.endswith('.example_helper'))
+        self.assertEqual(helper.attributes['host'], 'root@example.com')
+        self.assertEqual(first.parent_id, helper.span_id)
+        self.assertEqual(second.parent_id, helper.span_id)
+        self.assertEqual(first.attributes['command'], 'uname -a')
+        self.assertEqual(first.attributes['exit_code'], 0)
+        self.assertEqual(first.attributes['output_bytes'],
+                         len('output of uname -a'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
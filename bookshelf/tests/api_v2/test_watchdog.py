@@ -0,0 +1,221 @@
+import os
+import re
+import subprocess
+import sys
+import threading
+import unittest
+from time import time as wall_time
+
+from fabric.api import cd, env, hide, prefix, run, settings
+from fabric.state import connections
+
+from bookshelf.api_v2.command_hooks import command_hook, command_result
+from bookshelf.api_v2.fake_host import fake_host
+from bookshelf.api_v2.metrics import metrics
+from bookshelf.api_v2.time_helpers import VirtualClock, use_clock
+from bookshelf.api_v2.watchdog import (
+    RemoteCommandTimeout, _kill, command_timeout
+)
+
+HOST = 'root@watched-host'
+
+_TIMEOUT = re.compile(r'timeout --foreground --kill-after=\d+ (\d+) ')
+
+
+class SteppedClock(VirtualClock):
+    """
+    a virtual clock that only the commands move forward: waiting on it
+    blocks until they did, so the watchdog sees each step of a command
+    """
+    def __init__(self):
+        VirtualClock.__init__(self)
+        self._moved = threading.Condition()
+
+    def advance(self, seconds):
+        with self._moved:
+            VirtualClock.advance(self, seconds)
+            self._moved.notify_all()
+
+    def wait(self, event, seconds):
+        deadline = self.time() + seconds
+        with self._moved:
+            while not event.is_set() and self.time() < deadline:
+                self._moved.wait(0.01)
+        return event.is_set()
+
+
+class ScriptedHost(object):
+    """
+    a host printing a line a second, on the clock, then hanging if told to
+    until killed or timed out as coreutils' timeout would
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.killed = threading.Event()
+        self.lines = []
+        self.hangs = False
+        self.return_code = 0
+
+    def hook(self, run_command, command, options):
+        seconds = int(_TIMEOUT.search(command).group(1))
+        started = self.clock.time()
+        stream = options['stdout'] or sys.stdout
+        for line in self.lines:
+            self.clock.advance(1)
+            stream.write(line + '\n')
+        return_code = self.return_code
+        for _ in range(1000):
+            if not self.hangs:
+                break
+            if self.killed.wait(0.01):
+                return_code = 143
+                break
+            if seconds and self.clock.time() - started >= seconds:
+                return_code = 124
+                break
+            self.clock.advance(1)
+        return command_result(command, options, '\n'.join(self.lines), '',
+                              return_code)
+
+
+class _Channel(object):
+    def __init__(self, process):
+        self._process = process
+
+    def recv_exit_status(self):
+        return self._process.wait()
+
+
+class _Stdout(object):
+    def __init__(self, process):
+        self.channel = _Channel(process)
+
+
+class LocalConnection(object):
+    """ the exec_command of a paramiko client, running locally """
+
+    def exec_command(self, command, timeout=None):
+        process = subprocess.Popen(['/bin/bash', '-c', command])
+        return None, _Stdout(process), None
+
+
+class KillingConnection(object):
+    """ the exec_command of a paramiko client, killing a ScriptedHost """
+
+    def __init__(self, host):
+        self._host = host
+        self.commands = []
+
+    def exec_command(self, command, timeout=None):
+        self.commands.append(command)
+        self._host.killed.set()
+        return None, _Stdout(subprocess.Popen(['true'])), None
+
+
+class WatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.started = wall_time()
+        manager = settings(host_string=HOST)
+        manager.__enter__()
+        self.addCleanup(manager.__exit__, None, None, None)
+        clock = use_clock(SteppedClock())
+        self.clock = clock.__enter__()
+        self.addCleanup(clock.__exit__, None, None, None)
+        self.host = ScriptedHost(self.clock)
+        hook = command_hook(self.host.hook, innermost=True)
+        hook.__enter__()
+        self.addCleanup(hook.__exit__, None, None, None)
+        self.connection = KillingConnection(self.host)
+        connections[HOST] = self.connection
+        self.addCleanup(connections.__delitem__, HOST)
+
+    def tearDown(self):
+        self.assertLess(wall_time() - self.started, 5)
+
+    def test_kills_commands_running_too_long(self):
+        self.host.hangs = True
+        with command_timeout(seconds=10):
+            with self.assertRaises(RemoteCommandTimeout) as e:
+                run('sleep 3600', warn_only=True)
+
+        self.assertEqual(e.exception.reason, 'timeout')
+        self.assertEqual(self.clock.time(), 10)
+        self.assertEqual(metrics.events('timeout')[-1]['reason'], 'timeout')
+
+    def test_kills_inactive_commands(self):
+        self.host.lines = ['started']
+        self.host.hangs = True
+        with command_timeout(inactivity=10):
+            with self.assertRaises(RemoteCommandTimeout) as e:
+                run('echo started; sleep 3600')
+
+        self.assertEqual(e.exception.reason, 'inactivity')
+        self.assertEqual(e.exception.output, 'started')
+        self.assertLess(self.clock.time(), 3600)
+        self.assertIn('pkill -TERM -g', self.connection.commands[0])
+
+    def test_hidden_output_counts_as_activity(self):
+        self.host.lines = [str(i) for i in range(10)]
+        with command_timeout(inactivity=2), hide('everything'):
+            out = run('for i in $(seq 0 9); do echo $i; sleep 1; done')
+
+        self.assertEqual(out.splitlines(), self.host.lines)
+        self.assertEqual(self.connection.commands, [])
+
+    def test_keeps_failure_semantics(self):
+        self.host.return_code = 3
+        with command_timeout(seconds=10, inactivity=10):
+            self.assertEqual(run('exit 3', warn_only=True).return_code, 3)
+            with self.assertRaises(SystemExit):
+                run('exit 3')
+
+
+class FakeHostWatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.started = wall_time()
+
+    def tearDown(self):
+        self.assertLess(wall_time() - self.started, 15)
+
+    def test_commands_without_timeouts_are_left_alone(self):
+        with settings(host_string=env.host_string), fake_host():
+            self.assertEqual(run('echo hello'), 'hello')
+
+    def test_timeouts_kill_the_whole_process_group(self):
+        # the fake host waits for the output of the background sleep too
+        with settings(host_string=env.host_string), fake_host():
+            with command_timeout(seconds=1):
+                self.assertEqual(run('echo hello'), 'hello')
+                with self.assertRaises(RemoteCommandTimeout):
+                    run('sleep 30 & sleep 30')
+
+    def test_commands_see_the_prefixes(self):
+        with settings(host_string=env.host_string), fake_host() as host:
+            with command_timeout(seconds=10), cd('/tmp'), \
+                    prefix('greet() { echo hello from $(pwd); }'):
+                self.assertEqual(run('greet'),
+                                 'hello from ' + host.path('/tmp'))
+
+    def test_kill_takes_the_process_group(self):
+        marker = 'bookshelf-watchdog-test'
+        process = subprocess.Popen(
+            ['/bin/bash', '-c', 'sleep 30 & sleep 30; wait', marker],
+            stdout=subprocess.PIPE, preexec_fn=os.setsid)
+        connections[HOST] = LocalConnection()
+        self.addCleanup(connections.__delitem__, HOST)
+        # until bash started the sleeps
+        while subprocess.call(['pgrep', '-g', str(process.pid), 'sleep'],
+                              stdout=open(os.devnull, 'w')):
+            pass
+
+        _kill(HOST, marker, use_sudo=False)
+
+        # the background sleep keeps the pipe open until it is killed too
+        self.assertEqual(process.stdout.read(), '')
+        self.assertEqual(process.wait(), -15)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
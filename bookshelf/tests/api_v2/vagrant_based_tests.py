@@ -1,15 +1,81 @@
+import atexit
 import re
+import shutil
+import sys
+import tempfile
 from fabric.api import local
-from fabric.context_managers import settings, show, hide, quiet
+from fabric.context_managers import settings, show, hide, quiet, lcd
+
+
+SNAPSHOT = 'bookshelf-clean'
+
+
+class VagrantBox(object):
+    """
+    A vagrant box booted once for the session, in a directory of its own.
+
+    A snapshot is taken right after it boots, and restored before each test
+    that follows one that used the box, which is much quicker than booting
+    a new box. The ssh config doesn't change on restore, so it is only read
+    once.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.directory = tempfile.mkdtemp(prefix='bookshelf-vagrant-')
+        self._used = False
+        try:
+            with lcd(self.directory):
+                vagrant_up(image=image)
+                with settings(hide('stdout')):
+                    local('vagrant snapshot save %s' % SNAPSHOT)
+                self.ssh_config = vagrant_ssh_config()
+        except BaseException:
+            # fabric aborts with SystemExit, and the box isn't in _boxes
+            # yet for destroy_vagrant_boxes() to clean it up
+            error = sys.exc_info()
+            self.destroy()
+            raise error[0], error[1], error[2]
+
+    def checkout(self):
+        """ returns (user, ip, port, pkey) of the box in its clean state """
+        if self._used:
+            with lcd(self.directory), settings(hide('stdout')):
+                local('vagrant snapshot restore --no-provision %s' %
+                      SNAPSHOT)
+        self._used = True
+        return self.ssh_config
+
+    def destroy(self):
+        with lcd(self.directory), quiet():
+            vagrant_destroy()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+_boxes = {}
+
+
+def vagrant_box(image):
+    """ returns the VagrantBox of an image, booting it if needed """
+    if image not in _boxes:
+        _boxes[image] = VagrantBox(image)
+    return _boxes[image]
+
+
+@atexit.register
+def destroy_vagrant_boxes():
+    for box in _boxes.values():
+        box.destroy()
+    _boxes.clear()
 
 
 def with_ephemeral_vagrant_box(images=None, verbose=False):
     """
-    A decorator that creates ephemeral vagrant instances, executes the
-    wrapped function and destroys the vagrant instance.
+    A decorator that executes the wrapped function on a vagrant instance
+    in a clean state.
 
     takes a list of vagrants images, and executes the wrapped function for each
-    one of those images.
+    one of those images. The box of an image is booted by the first test
+    using it, and restored from a snapshot for the following ones.
 
     params:
         list images: array containing a list of vagrant images
@@ -25,8 +91,7 @@ def with_ephemeral_vagrant_box(images=None, verbose=False):
             # for each one of the vagrant images.
             # ex: centos, ubuntu-vivid, ubuntu-trusty
             for image in images:
-                vagrant_up(image=image)
-                user, ip, port, pkey = vagrant_ssh_config()
+                user, ip, port, pkey = vagrant_box(image).checkout()
 
                 hs = build_host_string(user, ip, port)
 
@@ -41,14 +106,9 @@ def with_ephemeral_vagrant_box(images=None, verbose=False):
                               host_string=hs,
                               key_filename=pkey,
                               disable_known_hosts=True):
-                    try:
-                        print("In method: %s for vagrant image %s" % (
-                            func.func_name, image))
-                        func(*args, **kwargs)
-                        vagrant_destroy()
-                    except:
-                        vagrant_destroy()
-                        raise
+                    print("In method: %s for vagrant image %s" % (
+                        func.func_name, image))
+                    func(*args, **kwargs)
         return wrapper
     return decorator
 
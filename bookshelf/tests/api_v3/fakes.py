@@ -0,0 +1,189 @@
+"""
+In-memory stand-ins for the ICloudInstanceFactory/ICloudInstance providers,
+for testing the code built on top of them without touching a real cloud.
+"""
+import itertools
+import threading
+from datetime import datetime
+
+from zope.interface import implementer, provider
+
+from bookshelf.api_v3.cloud_instance import (
+    Distribution, ICloudInstance, ICloudInstanceFactory, ImageRecord
+)
+
+
+class FakeCloud(object):
+    """
+    Records the instances and images of a pretend cloud.
+
+    :ivar instances: dict of instance id to a dict with the 'status'
+        ('running', 'stopped' or 'terminated'), 'distro', 'region' and
+        'config' of the instance.
+    :ivar images: dict of image id to a dict with the 'name', 'labels',
+        'created' time, 'size' and 'instance_id' the image was made from.
+    :ivar calls: list of (operation, id) tuples, in the order they happened.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.instances = {}
+        self.images = {}
+        self.calls = []
+
+    def _record(self, operation, resource_id):
+        with self._lock:
+            self.calls.append((operation, resource_id))
+
+    def calls_to(self, operation):
+        return [i for (o, i) in self.calls if o == operation]
+
+    def launch(self, config, distro, region):
+        if 'image' in config and config['image'] not in self.images:
+            raise KeyError('image %s does not exist' % config['image'])
+        instance_id = u'i-%d' % next(self._ids)
+        self.instances[instance_id] = {'status': 'running',
+                                       'distro': distro,
+                                       'region': region,
+                                       'config': config}
+        self._record('launch', instance_id)
+        return instance_id
+
+    def set_status(self, instance_id, status):
+        if instance_id not in self.instances:
+            raise KeyError('instance %s does not exist' % instance_id)
+        self.instances[instance_id]['status'] = status
+        self._record(status, instance_id)
+
+    def create_image(self, instance_id, name, labels=None):
+        image_id = u'img-%d' % next(self._ids)
+        self.images[image_id] = {'name': name, 'instance_id': instance_id,
+                                 'labels': labels or {},
+                                 'created': datetime.utcnow(),
+                                 'size': 1024 ** 3}
+        self._record('create_image', image_id)
+        return image_id
+
+    def copy_image(self, image_id, region):
+        copy_id = u'img-%d' % next(self._ids)
+        self.images[copy_id] = dict(self.images[image_id], region=region)
+        self._record('copy_image', copy_id)
+        return copy_id
+
+    def find_image(self, labels):
+        matches = [image_id for image_id, image in self.images.items()
+                   if all(image['labels'].get(name) == value
+                          for name, value in labels.items())]
+        if not matches:
+            return None
+        return max(matches, key=lambda image_id: int(image_id.split('-')[1]))
+
+    def delete_image(self, image_id):
+        del self.images[image_id]
+        self._record('delete_image', image_id)
+
+    def factory(self):
+        """ returns an ICloudInstanceFactory provider for this cloud """
+        return type('FakeInstanceFor%d' % id(self), (FakeInstance,),
+                    {'cloud': self})
+
+
+@implementer(ICloudInstance)
+@provider(ICloudInstanceFactory)
+class FakeInstance(object):
+    """
+    An ICloudInstance backed by a FakeCloud, use ``FakeCloud.factory()`` to
+    get a factory.
+
+    :ivar release: operations that take time block until this is set.
+    """
+    cloud = None
+    cloud_type = u'fake'
+    username = u'root'
+    key_filename = u'/dev/null'
+    image_basename = u'fake-image'
+
+    def __init__(self, instance_id, distro, region):
+        self.instance_id = instance_id
+        self.distro = distro
+        self.region = region
+        self.release = threading.Event()
+        self.release.set()
+
+    @property
+    def ip_address(self):
+        return u'10.0.0.%s' % self.instance_id.split('-')[1]
+
+    @classmethod
+    def create_from_config(cls, config, distro, region):
+        return cls(cls.cloud.launch(config, distro, region), distro, region)
+
+    @classmethod
+    def create_from_saved_state(cls, config, saved_state, lazy=True):
+        cls.cloud.set_status(saved_state['instance_id'], 'running')
+        return cls(saved_state['instance_id'],
+                   Distribution(saved_state['distro']),
+                   saved_state['region'])
+
+    @classmethod
+    def config_for_image(cls, config, image_id, image_name):
+        return dict(config, image=image_id)
+
+    @classmethod
+    def copy_image(cls, config, region, image_id, regions):
+        return dict((target, image_id if target == region else
+                     cls.cloud.copy_image(image_id, target))
+                    for target in regions)
+
+    @classmethod
+    def destroy_all(cls, config, saved_states):
+        for saved_state in saved_states:
+            cls.cloud.set_status(saved_state['instance_id'], 'terminated')
+
+    @classmethod
+    def iter_images(cls, config, region, name_prefix=None,
+                    created_after=None, created_before=None):
+        for image_id, image in cls.cloud.images.items():
+            record = ImageRecord(image_id=image_id,
+                                 name=image['name'],
+                                 region=region,
+                                 created=image['created'],
+                                 size_bytes=image['size'],
+                                 labels=image['labels'])
+            if record.matches(name_prefix, created_after, created_before):
+                yield record
+
+    @classmethod
+    def delete_images(cls, config, region, images):
+        for record in images:
+            cls.cloud.delete_image(record.image_id)
+        return list(images)
+
+    @classmethod
+    def find_image(cls, config, region, labels):
+        return cls.cloud.find_image(labels)
+
+    def create_image(self, image_name, labels=None, live=False):
+        self.release.wait()
+        # as AMI and GCE image names, they must be unique
+        if any(image['name'] == image_name
+               for image in self.cloud.images.values()):
+            raise ValueError('image name %s is taken' % image_name)
+        return self.cloud.create_image(self.instance_id, image_name, labels)
+
+    def delete_image(self, image_id):
+        self.cloud.delete_image(image_id)
+
+    def destroy(self):
+        self.cloud.set_status(self.instance_id, 'terminated')
+
+    def down(self):
+        self.cloud.set_status(self.instance_id, 'stopped')
+
+    def wait_until_ready(self):
+        pass
+
+    def get_state(self):
+        return {'instance_id': self.instance_id,
+                'distro': self.distro.value,
+                'region': self.region}
@@ -0,0 +1,192 @@
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bookshelf.api_v3.async_instance import (
+    AsyncCloudInstanceFactory, LazyReadinessMixin
+)
+from bookshelf.api_v3.cloud_instance import Distribution
+from bookshelf.tests.api_v3.fakes import FakeCloud
+
+
+class AsyncCloudInstanceFactoryTests(unittest.TestCase):
+
+    def test_create_from_config_returns_future_for_async_instance(self):
+        factory = AsyncCloudInstanceFactory(FakeCloud().factory())
+
+        instance = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-1').result(timeout=10)
+
+        self.assertEqual(instance.region, u'region-1')
+        self.assertEqual(instance.distro, Distribution.CENTOS7)
+        self.assertEqual(instance.get_state()['region'], u'region-1')
+
+    def test_create_from_saved_state_returns_future_for_async_instance(self):
+        cloud = FakeCloud()
+        instance_id = cloud.launch({}, Distribution.UBUNTU1404, u'region-2')
+        factory = AsyncCloudInstanceFactory(cloud.factory())
+
+        instance = factory.create_from_saved_state(
+            {}, {'instance_id': instance_id,
+                 'distro': u'ubuntu1404',
+                 'region': u'region-2'}
+        ).result(timeout=10)
+
+        self.assertEqual(instance.distro, Distribution.UBUNTU1404)
+
+
+class AsyncCloudInstanceTests(unittest.TestCase):
+
+    def test_operations_run_in_the_order_they_were_requested(self):
+        cloud = FakeCloud()
+        factory = AsyncCloudInstanceFactory(cloud.factory())
+        instance = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-1').result(timeout=10)
+        instance.instance.release.clear()
+
+        image = instance.create_image(u'image-1')
+        destroyed = instance.destroy()
+        instance.instance.release.set()
+
+        image_id = image.result(timeout=10)
+        destroyed.result(timeout=10)
+        self.assertEqual(cloud.calls[1:],
+                         [('create_image', image_id),
+                          ('terminated', instance.instance.instance_id)])
+
+    def test_live_images_overlap_but_not_later_operations(self):
+        cloud = FakeCloud()
+        factory = AsyncCloudInstanceFactory(cloud.factory())
+        instance = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-1').result(timeout=10)
+        started = []
+        both_started = threading.Event()
+        create_image = instance.instance.create_image
+
+        def slow_create_image(image_name, labels=None, live=False):
+            started.append(image_name)
+            if len(started) == 2:
+                both_started.set()
+            both_started.wait(10)
+            return create_image(image_name, labels, live)
+        instance.instance.create_image = slow_create_image
+
+        images = [instance.create_image(u'image-1', live=True),
+                  instance.create_image(u'image-2', live=True)]
+        destroyed = instance.destroy()
+
+        self.assertTrue(both_started.wait(10))
+        destroyed.result(timeout=10)
+        self.assertTrue(all(image.done() for image in images))
+        self.assertEqual(cloud.calls[-1],
+                         ('terminated', instance.instance.instance_id))
+
+    def test_operations_on_different_instances_overlap(self):
+        factory = AsyncCloudInstanceFactory(FakeCloud().factory())
+        first = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-1').result(timeout=10)
+        second = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-2').result(timeout=10)
+        first.instance.release.clear()
+
+        blocked = first.create_image(u'image-1')
+        second.destroy().result(timeout=10)
+
+        self.assertFalse(blocked.done())
+        first.instance.release.set()
+        blocked.result(timeout=10)
+
+
+    def test_waiting_operations_leave_the_workers_free(self):
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        factory = AsyncCloudInstanceFactory(FakeCloud().factory(),
+                                            executor=executor)
+        blocked = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-1').result(timeout=10)
+        blocked.instance.release.clear()
+
+        images = [blocked.create_image(u'image-%d' % i) for i in range(4)]
+        other = factory.create_from_config(
+            {}, Distribution.CENTOS7, u'region-2').result(timeout=10)
+        other.destroy().result(timeout=10)
+
+        self.assertFalse(any(image.done() for image in images))
+        blocked.instance.release.set()
+        for image in images:
+            image.result(timeout=10)
+
+
+class LazyInstance(LazyReadinessMixin):
+
+    def __init__(self, started):
+        self.ip_address = None
+        self.became_ready = 0
+        self._start_in_background(self._boot, started)
+
+    @staticmethod
+    def _boot(started, on_started):
+        on_started()
+        started.wait()
+        return u'10.0.0.1'
+
+    def _became_ready(self, ip_address):
+        self.became_ready += 1
+        self.ip_address = ip_address
+
+
+class FailingInstance(LazyReadinessMixin):
+
+    def __init__(self):
+        self._start_in_background(self._boot)
+
+    @staticmethod
+    def _boot(on_started):
+        raise RuntimeError('instance does not exist')
+
+
+class LazyReadinessMixinTests(unittest.TestCase):
+
+    def test_returns_before_the_instance_is_ready(self):
+        started = threading.Event()
+        instance = LazyInstance(started)
+
+        self.assertEqual(instance.ip_address, None)
+        started.set()
+        instance.wait_until_ready()
+        self.assertEqual(instance.ip_address, u'10.0.0.1')
+
+    def test_became_ready_is_only_called_once(self):
+        started = threading.Event()
+        started.set()
+        instance = LazyInstance(started)
+
+        instance.wait_until_ready()
+        instance.wait_until_ready()
+
+        self.assertEqual(instance.became_ready, 1)
+
+    def test_start_up_errors_are_raised_by_wait_until_ready(self):
+        instance = FailingInstance()
+
+        self.assertRaises(RuntimeError, instance.wait_until_ready)
+        self.assertRaises(RuntimeError, instance.wait_until_ready)
+
+    def test_started_before_the_instance_is_ready(self):
+        started = threading.Event()
+        instance = LazyInstance(started)
+
+        instance.wait_until_started()
+        self.assertEqual(instance.ip_address, None)
+        started.set()
+
+    def test_started_after_a_failed_start_up(self):
+        instance = FailingInstance()
+
+        instance.wait_until_started()
+        self.assertRaises(RuntimeError, instance.wait_until_ready)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -1,3 +1,4 @@
+import sys
 import unittest
 
 from subprocess import check_output
@@ -11,19 +12,21 @@ from bookshelf.api_v3.rackspace import (
 )
 from bookshelf.api_v3.gce import GCEInstance, GCEConfiguration
 from bookshelf.api_v3.ec2 import EC2Instance, EC2Configuration, EC2Credentials
+from bookshelf.tests import runner
 from zope.interface.verify import verifyObject
 
 
-class CloudInstanceTestMixin(object):
+class CloudInstanceChecksMixin(object):
     """
-    Mixin test structure for tests that verify a cloud instance is functional.
+    Checks that a cloud instance is functional.
 
-    Assumes the following members are initialized in setUp():
+    Assumes the following members are initialized by the classmethod
+    configure():
 
-    self.instance_factory: An ICloudInstanceFactory provider.
-    self.config: A valid configuration for the ICloudInstanceFactory provider.
-    self.distribution: The distribution that the config launches.
-    self.region: A valid region for the ICloudInstanceFactory provider.
+    instance_factory: An ICloudInstanceFactory provider.
+    config: A valid configuration for the ICloudInstanceFactory provider.
+    distribution: The distribution that the config launches.
+    region: A valid region for the ICloudInstanceFactory provider.
     """
 
     def _make_instance(self):
@@ -83,25 +86,30 @@ class CloudInstanceTestMixin(object):
         if verify_ips:
             self.assertEquals(instance1.ip_address, instance2.ip_address)
 
+
+class CloudInstanceTestMixin(CloudInstanceChecksMixin):
+    """
+    Verifies the lifecycle of an instance: down, up again from its saved
+    state and imaging.
+    """
+
+    def setUp(self):
+        super(CloudInstanceTestMixin, self).setUp()
+        self.configure()
+
     def test_instance_factory_and_instance(self):
         """
-        This is one large test that verifies all of the functionality of a
-        specific implementation of an instance factory and the instances that
-        it creates.
+        This is one large test that verifies the lifecycle of the instances
+        created by a specific implementation of an instance factory.
 
         Done as one large test rather than many little ones because it takes a
         lot of time to setup the initial instance. The bad part about this is
-        it might be a bit time consuming to debug and reproduce failures.
+        it might be a bit time consuming to debug and reproduce failures. The
+        checks that leave the instance alone are in SharedInstanceTestMixin.
         """
         instance = self._make_instance()
         self._instance_sanity_check(instance)
 
-        up_state = instance.get_state()
-
-        restored_instance = self._restore_from_state(up_state)
-        self._instance_sanity_check(restored_instance)
-        self._assert_instances_are_same(instance, restored_instance)
-
         instance.down()
         down_state = instance.get_state()
 
@@ -118,6 +126,37 @@ class CloudInstanceTestMixin(object):
         revived_instance.delete_image(unique_id)
 
 
+class SharedInstanceTestMixin(CloudInstanceChecksMixin):
+    """
+    Read-only checks, all run against one instance created for the class.
+
+    Run by ``runner``, the tests of a class with a setUpClass all go to the
+    same worker process, so each provider has one shared instance for the
+    session while the lifecycle tests of every provider run concurrently.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.configure()
+        cls.instance = cls.instance_factory.create_from_config(
+            cls.config, cls.distribution, cls.region)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.instance.destroy()
+
+    def test_instance(self):
+        self._instance_sanity_check(self.instance)
+
+    def test_restore_from_state(self):
+        restored_instance = self._restore_from_state(self.instance.get_state())
+        self._instance_sanity_check(restored_instance)
+        self._assert_instances_are_same(self.instance, restored_instance)
+
+    def test_list_images(self):
+        self.instance.list_images()
+
+
 class MissingConfigError(Exception):
     """
     Error that is raised to indicate that some required configuration key was
@@ -236,14 +275,13 @@ def _get_yaml_config(substructure, config=None):
         raise unittest.SkipTest()
 
 
-class RackspaceTests(unittest.TestCase, CloudInstanceTestMixin):
+class RackspaceProvider(object):
     """
-    Tests for rackspace.
+    Configuration of the rackspace tests.
     """
 
-    def setUp(self):
-        super(RackspaceTests, self).setUp()
-
+    @classmethod
+    def configure(cls):
         credentials = _get_yaml_config(
             {
                 'rackspace': {
@@ -262,7 +300,7 @@ class RackspaceTests(unittest.TestCase, CloudInstanceTestMixin):
         )
 
         ssh_keys = credentials["ssh_keys"]["rackspace"]
-        self.config = RackspaceConfiguration(
+        cls.config = RackspaceConfiguration(
             username='root',
             instance_type='1GB Standard Instance',
             key_pair=credentials["rackspace"]["keyname"],
@@ -275,18 +313,32 @@ class RackspaceTests(unittest.TestCase, CloudInstanceTestMixin):
             image_basename='rackspace-test-image',
             instance_name='rackspace-test-instance'
         ).serialize()
-        self.distribution = Distribution.CENTOS7
-        self.region = credentials["rackspace"]["region"].upper()
-        self.instance_factory = RackspaceInstance
+        cls.distribution = Distribution.CENTOS7
+        cls.region = credentials["rackspace"]["region"].upper()
+        cls.instance_factory = RackspaceInstance
 
 
-class GCETests(unittest.TestCase, CloudInstanceTestMixin):
+class RackspaceTests(CloudInstanceTestMixin, RackspaceProvider,
+                     unittest.TestCase):
     """
-    Tests for GCE.
+    Tests for rackspace.
     """
 
-    def setUp(self):
-        super(GCETests, self).setUp()
+
+class RackspaceSharedInstanceTests(SharedInstanceTestMixin,
+                                   RackspaceProvider, unittest.TestCase):
+    """
+    Read-only tests for rackspace.
+    """
+
+
+class GCEProvider(object):
+    """
+    Configuration of the GCE tests.
+    """
+
+    @classmethod
+    def configure(cls):
         credentials = _get_yaml_config(
             {
                 'gce': {
@@ -317,7 +369,7 @@ class GCETests(unittest.TestCase, CloudInstanceTestMixin):
         # Preferred authentication method is to run `gcloud auth login` prior
         # to running this test.
         service_account_creds = credentials["gce"]["gce_credentials"]
-        self.config = GCEConfiguration(
+        cls.config = GCEConfiguration(
             credentials_private_key=(
                 service_account_creds.get('private_key', '')),
             credentials_email=service_account_creds.get('client_email', ''),
@@ -332,9 +384,23 @@ class GCETests(unittest.TestCase, CloudInstanceTestMixin):
             base_image_prefix='ubuntu-1404',
             base_image_project='ubuntu-os-cloud'
         ).serialize()
-        self.distribution = Distribution.UBUNTU1404
-        self.region = credentials["gce"]["zone"]
-        self.instance_factory = GCEInstance
+        cls.distribution = Distribution.UBUNTU1404
+        cls.region = credentials["gce"]["zone"]
+        cls.instance_factory = GCEInstance
+
+
+class GCETests(CloudInstanceTestMixin, GCEProvider, unittest.TestCase):
+    """
+    Tests for GCE.
+    """
+
+
+class GCESharedInstanceTests(SharedInstanceTestMixin, GCEProvider,
+                             unittest.TestCase):
+    """
+    Read-only tests for GCE.
+    """
+
 
 # Specify a different AMI for the different regions.
 _UBUNTU_AMIS = {
@@ -350,14 +416,13 @@ _UBUNTU_AMIS = {
 }
 
 
-class EC2Tests(unittest.TestCase, CloudInstanceTestMixin):
+class EC2Provider(object):
     """
-    Tests for EC2.
+    Configuration of the EC2 tests.
     """
 
-    def setUp(self):
-        super(EC2Tests, self).setUp()
-
+    @classmethod
+    def configure(cls):
         credentials = _get_yaml_config(
             {
                 'aws': {
@@ -376,8 +441,8 @@ class EC2Tests(unittest.TestCase, CloudInstanceTestMixin):
             }
         )
 
-        self.region = credentials["aws"]["region"]
-        self.config = EC2Configuration(
+        cls.region = credentials["aws"]["region"]
+        cls.config = EC2Configuration(
             credentials=EC2Credentials(
                 access_key_id=credentials["aws"]["access_key"],
                 secret_access_key=credentials["aws"]["secret_access_token"]
@@ -389,14 +454,30 @@ class EC2Tests(unittest.TestCase, CloudInstanceTestMixin):
             tags={'name': 'test-instance-with-tags'},
             image_description='ec2-test-description',
             image_basename='ec2-image-basename',
-            ami=_UBUNTU_AMIS[self.region],
+            ami=_UBUNTU_AMIS[cls.region],
             key_filename=credentials["ssh_keys"]["aws"]["private_key_file"],
             key_pair=credentials["aws"]["keyname"],
             instance_type=credentials["aws"]["instance_type"],
             security_groups=['ssh']
         ).serialize()
-        self.distribution = Distribution.UBUNTU1404
-        self.instance_factory = EC2Instance
+        cls.distribution = Distribution.UBUNTU1404
+        cls.instance_factory = EC2Instance
+
+
+class EC2Tests(CloudInstanceTestMixin, EC2Provider, unittest.TestCase):
+    """
+    Tests for EC2.
+    """
+
+
+class EC2SharedInstanceTests(SharedInstanceTestMixin, EC2Provider,
+                             unittest.TestCase):
+    """
+    Read-only tests for EC2.
+    """
+
 
 if __name__ == '__main__':
-    unittest.main()
+    # a worker for each of the six test classes, so that all the providers
+    # are tested at once, each class in a process of its own
+    sys.exit(runner.main(['--workers', '6', __file__] + sys.argv[1:]))
@@ -0,0 +1,136 @@
+import threading
+import unittest
+from datetime import datetime
+
+from bookshelf.api_v2.time_helpers import VirtualClock, use_clock
+from bookshelf.api_v3 import ec2
+from bookshelf.api_v3.async_instance import _DEFAULT_MAX_WORKERS, submit
+from bookshelf.api_v3.cloud_instance import ImageRecord
+from bookshelf.tests.api_v3.test_ec2_hibernate import CONFIG, error
+
+
+class FakeVolume(object):
+
+    def __init__(self, volume_id):
+        self.id = volume_id
+
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, state):
+        self.id = instance_id
+        self.state = state
+
+
+class FakeEC2Connection(object):
+    """ records the calls made to tear down instances """
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.calls = []
+        self.detaching = set(['vol-busy'])
+
+    def get_all_volumes(self, filters=None):
+        return [FakeVolume(volume_id) for volume_id in self.volumes]
+
+    def stop_instances(self, instance_ids):
+        self.calls.append(('stop', instance_ids))
+
+    def terminate_instances(self, instance_ids):
+        self.calls.append(('terminate', instance_ids))
+
+    def get_only_instances(self, instance_ids):
+        return [FakeInstance(instance_id, 'terminated')
+                for instance_id in instance_ids]
+
+    def delete_volume(self, volume_id):
+        self.calls.append(('delete_volume', volume_id))
+        if volume_id == 'vol-gone':
+            raise error('InvalidVolume.NotFound')
+        if volume_id in self.detaching:
+            self.detaching.remove(volume_id)
+            raise error('VolumeInUse')
+
+    def deregister_image(self, image_id):
+        self.calls.append(('deregister_image', image_id))
+
+    def delete_snapshot(self, snapshot_id):
+        self.calls.append(('delete_snapshot', snapshot_id))
+
+
+class EC2DestroyInstancesTests(unittest.TestCase):
+
+    def test_terminates_all_instances_in_one_call_without_stopping(self):
+        connection = FakeEC2Connection(volumes=[])
+
+        ec2._destroy_instances(connection, ['i-1', 'i-2', 'i-3'])
+
+        self.assertEqual(connection.calls,
+                         [('terminate', ['i-1', 'i-2', 'i-3'])])
+
+    def test_deletes_attached_volumes(self):
+        connection = FakeEC2Connection(volumes=['vol-1', 'vol-gone'])
+
+        ec2._destroy_instances(connection, ['i-1'])
+
+        self.assertEqual(
+            sorted(c[1] for c in connection.calls if c[0] == 'delete_volume'),
+            ['vol-1', 'vol-gone'])
+
+    def test_retries_volumes_still_being_detached(self):
+        connection = FakeEC2Connection(volumes=['vol-1', 'vol-busy'])
+
+        with use_clock(VirtualClock()):
+            ec2._destroy_instances(connection, ['i-1'])
+
+        self.assertEqual(
+            [c[1] for c in connection.calls if c[0] == 'delete_volume'],
+            ['vol-1', 'vol-busy', 'vol-busy'])
+
+
+class EC2DestroyAllTests(unittest.TestCase):
+
+    def setUp(self):
+        connect = ec2._connect_to_ec2
+        ec2._connect_to_ec2 = lambda region, credentials: FakeEC2Connection(
+            volumes=['vol-1', 'vol-2'])
+        self.addCleanup(setattr, ec2, '_connect_to_ec2', connect)
+
+    def test_more_destroys_than_pool_workers(self):
+        saved_states = [{'instance_id': u'i-1', 'region': u'region-1',
+                         'distro': u'centos7'},
+                        {'instance_id': u'i-2', 'region': u'region-2',
+                         'distro': u'centos7'}]
+
+        destroys = [submit(ec2.EC2Instance.destroy_all, CONFIG, saved_states)
+                    for _ in range(_DEFAULT_MAX_WORKERS + 8)]
+
+        for destroy in destroys:
+            destroy.result(timeout=30)
+
+    def test_more_image_deletes_than_pool_workers(self):
+        images = [ImageRecord(image_id=u'ami-{}'.format(i), name=u'image',
+                              region=u'region-1', created=datetime.utcnow(),
+                              snapshot_ids=[u'snap-{}'.format(i)])
+                  for i in range(2)]
+
+        # every worker is taken by a delete_images before any fans out
+        queued = threading.Event()
+        connect = ec2._connect_to_ec2
+
+        def connect_when_queued(region, credentials):
+            queued.wait()
+            return connect(region, credentials)
+        ec2._connect_to_ec2 = connect_when_queued
+
+        deletes = [submit(ec2.EC2Instance.delete_images, CONFIG,
+                          u'region-1', iter(images))
+                   for _ in range(_DEFAULT_MAX_WORKERS + 8)]
+        queued.set()
+
+        for delete in deletes:
+            self.assertEqual(delete.result(timeout=30), images)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -0,0 +1,165 @@
+import threading
+import unittest
+
+from boto.exception import EC2ResponseError
+
+from bookshelf.api_v3 import ec2
+from bookshelf.api_v3.cloud_instance import Distribution
+
+
+def error(code):
+    return EC2ResponseError(400, 'Bad Request', body=(
+        '<Response><Errors><Error><Code>{}</Code>'
+        '</Error></Errors></Response>'.format(code)))
+
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, state):
+        self.id = instance_id
+        self.state = state
+
+
+class FakeRequest(object):
+
+    def __init__(self, params):
+        self.params = params
+
+
+class FakeEC2Connection(object):
+    """ records the requests boto would make to stop instances """
+    APIVersion = '2014-10-01'
+    host = 'ec2.us-west-2.amazonaws.com'
+
+    def __init__(self, hibernation_error=None):
+        self.hibernation_error = hibernation_error
+        self.requests = []
+        # as _connect_to_ec2 does
+        ec2._accept_extra_params(self)
+
+    def build_base_http_request(self, verb, path, auth_path, params,
+                                headers, data, host):
+        return FakeRequest(dict(params or {}))
+
+    def _mexe(self, request):
+        params = dict(request.params)
+        action = params.pop('Action')
+        self.requests.append((action, params, params.pop('Version')))
+        if params.get('Hibernate') and self.hibernation_error:
+            raise error(self.hibernation_error)
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        request = self.build_base_http_request(verb, path, None, params, {},
+                                               '', self.host)
+        request.params['Action'] = action
+        request.params['Version'] = self.APIVersion
+        return self._mexe(request)
+
+    def stop_instances(self, instance_ids):
+        self.make_request('StopInstances', {'InstanceId.1': instance_ids[0]})
+
+    def get_only_instances(self, instance_ids):
+        return [FakeInstance(instance_id, 'stopped')
+                for instance_id in instance_ids]
+
+
+CONFIG = {
+    'credentials': {'access_key_id': u'key', 'secret_access_key': u'secret'},
+    'username': u'centos', 'instance_name': u'test', 'tags': {},
+    'image_description': u'test', 'image_basename': u'test', 'ami': u'ami-1',
+    'key_filename': u'key.pem', 'key_pair': u'key',
+    'instance_type': u'm5.large',
+    'disk_name': u'/dev/sda1', 'disk_size': 48, 'security_groups': [],
+}
+
+
+class StopInstanceTests(unittest.TestCase):
+
+    def test_hibernates_with_a_recent_api_version(self):
+        connection = FakeEC2Connection()
+
+        mode = ec2._stop_instance(connection, 'i-1', hibernate=True)
+
+        self.assertEqual(mode, u'hibernate')
+        self.assertEqual(connection.requests, [
+            ('StopInstances', {'InstanceId.1': 'i-1', 'Hibernate': 'true'},
+             ec2._EC2_API_VERSION)])
+        self.assertEqual(connection.APIVersion, '2014-10-01')
+
+    def test_falls_back_to_stopping(self):
+        connection = FakeEC2Connection(
+            hibernation_error='UnsupportedHibernationConfiguration')
+
+        mode = ec2._stop_instance(connection, 'i-1', hibernate=True)
+
+        self.assertEqual(mode, u'stop')
+        self.assertEqual(connection.requests[-1],
+                         ('StopInstances', {'InstanceId.1': 'i-1'},
+                          '2014-10-01'))
+
+    def test_other_errors_are_raised(self):
+        connection = FakeEC2Connection(hibernation_error='AuthFailure')
+
+        self.assertRaises(EC2ResponseError, ec2._stop_instance,
+                          connection, 'i-1', hibernate=True)
+
+    def test_other_threads_requests_are_left_alone(self):
+        connection = FakeEC2Connection()
+        other = threading.Thread(target=connection.stop_instances,
+                                 args=(['i-2'],))
+
+        with ec2._extra_params('StopInstances', {'Hibernate': 'true'}):
+            other.start()
+            other.join()
+            connection.stop_instances(['i-1'])
+
+        self.assertEqual(connection.requests, [
+            ('StopInstances', {'InstanceId.1': 'i-2'}, '2014-10-01'),
+            ('StopInstances', {'InstanceId.1': 'i-1', 'Hibernate': 'true'},
+             ec2._EC2_API_VERSION)])
+
+    def test_stops_unless_asked_to_hibernate(self):
+        connection = FakeEC2Connection()
+
+        self.assertEqual(ec2._stop_instance(connection, 'i-1'), u'stop')
+        self.assertEqual(len(connection.requests), 1)
+
+
+class DownTests(unittest.TestCase):
+
+    def _instance(self, connection, **config):
+        return ec2.EC2Instance(
+            instance=None, connection=connection,
+            config=ec2.EC2Configuration.create(dict(CONFIG, **config)),
+            state=ec2.EC2State(instance_id=u'i-1', region=u'us-west-2',
+                               distro=Distribution.CENTOS7))
+
+    def test_records_how_the_instance_was_stopped(self):
+        instance = self._instance(FakeEC2Connection(), hibernate=True)
+
+        instance.down()
+
+        state = instance.get_state()
+        self.assertEqual(state['stop_mode'], u'hibernate')
+        self.assertIsInstance(state['stop_seconds'], float)
+
+    def test_resume_is_recorded_after_hibernation(self):
+        instance = self._instance(FakeEC2Connection(), hibernate=True)
+        instance.down()
+
+        instance._became_ready((FakeInstance('i-1', 'running'), 12.0))
+
+        self.assertEqual(instance.state.start_mode, u'resume')
+        self.assertEqual(instance.state.start_seconds, 12.0)
+
+    def test_saved_state_without_timings_still_loads(self):
+        state = ec2.EC2State.create({'instance_id': u'i-1',
+                                     'region': u'us-west-2',
+                                     'distro': u'centos7'})
+
+        self.assertEqual(state.stop_mode, u'')
+        self.assertIsNone(state.start_seconds)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
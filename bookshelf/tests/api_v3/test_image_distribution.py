@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bookshelf.api_v3.async_instance import submit
+from bookshelf.api_v3.cloud_instance import Distribution
+from bookshelf.api_v3.image_distribution import (
+    ImageBuildError, build_all, pipelines_for, replicate_image,
+    replicate_images
+)
+from bookshelf.api_v3.image_pipeline import Step
+from bookshelf.tests.api_v3.fakes import FakeCloud
+
+CONFIG = {'image_basename': u'test'}
+
+
+def install(package):
+    pass
+
+
+def broken():
+    raise RuntimeError('broken step')
+
+
+def on_the_pool(distro):
+    submit(install, distro).result(timeout=10)
+
+
+class ReplicateImageTests(unittest.TestCase):
+
+    def test_copies_to_every_other_region(self):
+        cloud = FakeCloud()
+        image_id = cloud.create_image(u'i-0', u'image')
+
+        copies = replicate_image(cloud.factory(), CONFIG, u'region-1',
+                                 image_id, [u'region-1', u'region-2',
+                                            u'region-3'])
+
+        self.assertEqual(copies[u'region-1'], image_id)
+        self.assertEqual(sorted(cloud.calls_to('copy_image')),
+                         sorted([copies[u'region-2'], copies[u'region-3']]))
+
+
+class BuildAllTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_file = os.path.join(directory, 'cache.json')
+
+    def test_builds_every_cloud_and_distro(self):
+        targets = [(FakeCloud().factory(), CONFIG, u'region-1'),
+                   (FakeCloud().factory(), CONFIG, u'region-2')]
+        pipelines = pipelines_for(targets, list(Distribution),
+                                  lambda distro: [Step(install, distro)],
+                                  cache_file=self.cache_file)
+
+        images = build_all(pipelines)
+
+        self.assertEqual(len(pipelines), 2 * len(list(Distribution)))
+        self.assertEqual(sorted(images), sorted(pipelines))
+        self.assertTrue(all(i.startswith(u'img-') for i in images.values()))
+
+    def test_reports_failed_builds_after_the_others(self):
+        targets = [(FakeCloud().factory(), CONFIG, u'region-1')]
+        good, bad = pipelines_for(
+            targets, [Distribution.CENTOS7, Distribution.UBUNTU1404],
+            lambda distro: [Step(broken) if distro == Distribution.UBUNTU1404
+                            else Step(install, distro)],
+            cache_file=self.cache_file)
+
+        with self.assertRaises(ImageBuildError) as e:
+            build_all([good, bad])
+
+        self.assertEqual(list(e.exception.images), [good])
+        self.assertIn('broken step', e.exception.errors[bad])
+
+    def test_runs_at_most_processes_builds_at_once(self):
+        targets = [(FakeCloud().factory(), CONFIG, u'region-1')]
+        pipelines = pipelines_for(targets, list(Distribution),
+                                  lambda distro: [Step(install, distro)],
+                                  cache_file=self.cache_file)
+
+        images = build_all(pipelines, processes=1)
+
+        self.assertEqual(sorted(images), sorted(pipelines))
+
+    def test_builds_can_use_the_pool_the_parent_used(self):
+        submit(install, None).result(timeout=10)
+        targets = [(FakeCloud().factory(), CONFIG, u'region-1')]
+        pipelines = pipelines_for(targets, [Distribution.CENTOS7],
+                                  lambda distro: [Step(on_the_pool, distro)],
+                                  cache_file=self.cache_file)
+
+        images = build_all(pipelines)
+
+        self.assertEqual(list(images), pipelines)
+
+    def test_replicate_images_of_several_builds(self):
+        cloud = FakeCloud()
+        image_id = cloud.create_image(u'i-0', u'image')
+        pipeline, = pipelines_for([(cloud.factory(), CONFIG, u'region-1')],
+                                  [Distribution.CENTOS7], [])
+
+        copies = replicate_images({pipeline: image_id},
+                                  {u'fake': [u'region-1', u'region-2']})
+
+        self.assertEqual(sorted(copies[pipeline]), [u'region-1', u'region-2'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
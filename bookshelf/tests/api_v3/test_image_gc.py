@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from bookshelf.api_v3.cloud_instance import Distribution, ImageRecord
+from bookshelf.api_v3.image_distribution import pipelines_for
+from bookshelf.api_v3.image_gc import (
+    RetentionPolicy, collect_garbage, image_basename
+)
+from bookshelf.api_v3.image_pipeline import ImagePipeline, Step
+from bookshelf.tests.api_v3.fakes import FakeCloud
+
+NOW = datetime(2016, 6, 1)
+
+
+def image(name, days_old):
+    return ImageRecord(image_id=name, name=name, region=u'region-1',
+                       created=NOW - timedelta(days=days_old))
+
+
+def install(package):
+    pass
+
+
+class ImageBasenameTests(unittest.TestCase):
+
+    def test_strips_timestamps_and_step_keys(self):
+        self.assertEqual(image_basename(u'centos7-20160501120000'),
+                         u'centos7')
+        self.assertEqual(image_basename(u'centos7-0123456789abcdef'),
+                         u'centos7')
+        self.assertEqual(image_basename(u'centos7-nightly-3'),
+                         u'centos7-nightly-3')
+
+
+class RetentionPolicyTests(unittest.TestCase):
+
+    def test_keeps_newest_per_basename(self):
+        images = [image(u'a-2016050%d000000' % day, 10 - day)
+                  for day in range(1, 5)]
+        images.append(image(u'b-20160501000000', 40))
+
+        expired = RetentionPolicy(keep_newest=2).expired(images, NOW)
+
+        self.assertEqual(sorted(i.name for i in expired),
+                         [u'a-20160501000000', u'a-20160502000000'])
+
+    def test_max_age_spares_recent_images(self):
+        images = [image(u'a-20160501000000', 40),
+                  image(u'a-20160502000000', 5),
+                  image(u'a-20160503000000', 1)]
+
+        expired = RetentionPolicy(
+            keep_newest=1, max_age=timedelta(days=30)).expired(images, NOW)
+
+        self.assertEqual([i.name for i in expired], [u'a-20160501000000'])
+
+    def test_prefix(self):
+        images = [image(u'a-20160501000000', 2), image(u'b-20160501000000', 2)]
+
+        expired = RetentionPolicy(keep_newest=0, prefix=u'a').expired(
+            images, NOW)
+
+        self.assertEqual([i.name for i in expired], [u'a-20160501000000'])
+
+
+class CollectGarbageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = FakeCloud()
+        for _ in range(3):
+            self.cloud.create_image(u'i-0', u'test-20160501000000')
+
+    def test_deletes_expired_images_and_reports_space(self):
+        report = collect_garbage(self.cloud.factory(), {}, u'region-1',
+                                 RetentionPolicy(keep_newest=1))
+
+        self.assertEqual(len(self.cloud.images), 1)
+        self.assertEqual(len(report.deleted), 2)
+        self.assertEqual(report.kept, 1)
+        self.assertEqual(report.reclaimed_bytes, 2 * 1024 ** 3)
+
+    def test_dry_run_deletes_nothing(self):
+        report = collect_garbage(self.cloud.factory(), {}, u'region-1',
+                                 RetentionPolicy(keep_newest=1), dry_run=True)
+
+        self.assertEqual(len(self.cloud.images), 3)
+        self.assertEqual(len(report.deleted), 2)
+
+
+class PipelineImagesTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_file = os.path.join(directory, 'cache.json')
+        self.cloud = FakeCloud()
+
+    def _build(self, package):
+        images = {}
+        for pipeline in pipelines_for(
+                [(self.cloud.factory(), {'image_basename': u'test'},
+                  u'region-1')],
+                [Distribution.CENTOS7, Distribution.UBUNTU1404],
+                [Step(install, 'git'), Step(install, package)],
+                cache_file=self.cache_file):
+            images[pipeline.distro] = pipeline.build()
+        return images
+
+    def _build_nightly(self):
+        return ImagePipeline(
+            self.cloud.factory(), {'image_basename': u'nightly'},
+            Distribution.CENTOS7, u'region-1',
+            [Step(install, 'updates', always=True)],
+            cache_file=self.cache_file).build_incremental(u'nightly')
+
+    def test_keeps_the_images_in_use_of_every_distro_and_lineage(self):
+        old = self._build('vim')
+        nightly = [self._build_nightly() for _ in range(3)]
+        current = self._build('emacs')
+        in_use = set(self.cloud.images) - set(old.values() + nightly[:2])
+
+        collect_garbage(self.cloud.factory(), {}, u'region-1',
+                        RetentionPolicy(keep_newest=1))
+
+        self.assertEqual(set(self.cloud.images), in_use)
+        self.assertTrue(set(current.values()) <= in_use)
+        self.assertIn(nightly[-1], in_use)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
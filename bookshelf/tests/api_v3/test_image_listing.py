@@ -0,0 +1,156 @@
+import unittest
+from datetime import datetime
+
+from bookshelf.api_v3 import ec2, gce, rackspace
+
+
+class FakeRequest(object):
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeGCEImages(object):
+    """ returns the pages of images().list, recording the calls """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        return FakeRequest(self.pages[len(self.calls) - 1])
+
+
+class FakeGCECompute(object):
+
+    def __init__(self, pages):
+        self._images = FakeGCEImages(pages)
+
+    def images(self):
+        return self._images
+
+
+def gce_image(name, created):
+    return {'name': name, 'creationTimestamp': created}
+
+
+class GCEImageListingTests(unittest.TestCase):
+
+    def test_follows_page_tokens_lazily(self):
+        compute = FakeGCECompute([
+            {'items': [gce_image('a', '2016-05-01T00:00:00.000-07:00')],
+             'nextPageToken': 'page-2'},
+            {'items': [gce_image('b', '2016-05-02T00:00:00.000-07:00')]},
+        ])
+
+        images = gce._iter_images(compute, 'project', 'zone')
+        first = next(images)
+
+        self.assertEqual(first.name, 'a')
+        self.assertEqual(len(compute.images().calls), 1)
+        self.assertEqual([i.name for i in images], ['b'])
+        self.assertEqual(compute.images().calls[1]['pageToken'], 'page-2')
+
+    def test_name_prefix_is_filtered_by_the_server(self):
+        compute = FakeGCECompute([{'items': []}])
+
+        list(gce._iter_images(compute, 'project', 'zone', name_prefix='ci-'))
+
+        self.assertEqual(compute.images().calls[0]['filter'], 'name eq ci-.*')
+
+    def test_dates_are_filtered_locally(self):
+        compute = FakeGCECompute([{'items': [
+            gce_image('old', '2016-04-01T00:00:00.000Z'),
+            gce_image('new', '2016-05-02T00:00:00.000Z'),
+        ]}])
+
+        images = gce._iter_images(compute, 'project', 'zone',
+                                  created_after=datetime(2016, 5, 1))
+
+        self.assertEqual([i.name for i in images], ['new'])
+
+
+class FakeEC2Image(object):
+
+    def __init__(self, image_id, name, created):
+        self.id = image_id
+        self.name = name
+        self.creationDate = created
+        self.block_device_mapping = {}
+        self.tags = {}
+
+
+class FakeEC2Connection(object):
+
+    def __init__(self, images):
+        self.images = images
+        self.filters = None
+
+    def get_all_images(self, owners=None, filters=None):
+        self.filters = filters
+        return self.images
+
+
+class EC2ImageListingTests(unittest.TestCase):
+
+    def test_name_prefix_is_filtered_by_the_server(self):
+        connection = FakeEC2Connection(
+            [FakeEC2Image('ami-1', 'ci-1', '2016-05-01T00:00:00.000Z')])
+
+        images = list(ec2._iter_images(connection, 'us-west-2',
+                                       name_prefix='ci-'))
+
+        self.assertEqual(connection.filters, {'name': 'ci-*'})
+        self.assertEqual([i.image_id for i in images], ['ami-1'])
+
+
+class FakeNovaImage(object):
+
+    def __init__(self, image_id, image_type='snapshot'):
+        self.id = image_id
+        self.name = image_id
+        self.created = '2016-05-01T00:00:00Z'
+        self.metadata = {'image_type': image_type}
+
+
+class FakeNovaImages(object):
+
+    def __init__(self, images):
+        self.all = images
+        self.markers = []
+
+    def list(self, limit, marker=None):
+        self.markers.append(marker)
+        start = 0
+        if marker is not None:
+            start = [i.id for i in self.all].index(marker) + 1
+        return self.all[start:start + limit]
+
+
+class FakeNova(object):
+
+    def __init__(self, images):
+        self.images = FakeNovaImages(images)
+
+
+class RackspaceImageListingTests(unittest.TestCase):
+
+    def test_pages_with_markers_and_skips_base_images(self):
+        images = [FakeNovaImage(u'img-%d' % i)
+                  for i in range(rackspace._IMAGE_PAGE_SIZE)]
+        images.append(FakeNovaImage(u'base', image_type='base'))
+        nova = FakeNova(images)
+
+        records = list(rackspace._iter_images(nova, u'DFW'))
+
+        self.assertEqual(len(records), rackspace._IMAGE_PAGE_SIZE)
+        self.assertEqual(nova.images.markers,
+                         [None, images[rackspace._IMAGE_PAGE_SIZE - 1].id])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
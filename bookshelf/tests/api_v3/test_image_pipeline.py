@@ -0,0 +1,312 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric.operations import _AttributeString
+
+from bookshelf.api_v2.command_hooks import command_hook
+from bookshelf.api_v3.cloud_instance import Distribution, RECIPE_LABEL
+from bookshelf.api_v3.image_pipeline import (
+    DISTRO_LABEL, GENERATION_LABEL, LINEAGE_LABEL, STEP_LABEL,
+    ImagePipeline, Step
+)
+from bookshelf.tests.api_v3.fakes import FakeCloud
+
+calls = []
+
+
+def install(package):
+    calls.append(('install', package))
+
+
+def upload(path):
+    calls.append(('upload', path))
+
+
+class StepTests(unittest.TestCase):
+
+    def test_digest_depends_on_arguments(self):
+        self.assertEqual(Step(install, 'git').digest(),
+                         Step(install, 'git').digest())
+        self.assertNotEqual(Step(install, 'git').digest(),
+                            Step(install, 'vim').digest())
+
+    def test_digest_depends_on_file_content(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with open(path, 'w') as f:
+            f.write('one')
+        before = Step(upload, path, files=[path]).digest()
+
+        with open(path, 'w') as f:
+            f.write('two')
+
+        self.assertNotEqual(Step(upload, path, files=[path]).digest(), before)
+
+    def test_digest_of_a_distribution_is_its_value(self):
+        self.assertEqual(Step(install, Distribution.CENTOS7).digest(),
+                         Step(install, u'centos7').digest())
+
+    def test_digest_refuses_arguments_json_can_not_represent(self):
+        self.assertRaises(TypeError, Step(install, object()).digest)
+
+
+class ImagePipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_file = os.path.join(directory, 'cache.json')
+        self.cloud = FakeCloud()
+        del calls[:]
+
+    def _pipeline(self, steps, **kwargs):
+        return ImagePipeline(self.cloud.factory(),
+                             {'ami': 'ami-1', 'image_basename': u'test'},
+                             Distribution.CENTOS7, u'region-1', steps,
+                             cache_file=self.cache_file, **kwargs)
+
+    def test_build_runs_every_step_and_checkpoints_them(self):
+        image_id = self._pipeline([Step(install, 'git'),
+                                   Step(install, 'vim')]).build()
+
+        self.assertEqual(calls, [('install', 'git'), ('install', 'vim')])
+        self.assertEqual(len(self.cloud.images), 2)
+        self.assertIn(image_id, self.cloud.images)
+        self.assertEqual(self.cloud.calls_to('terminated'),
+                         self.cloud.calls_to('launch'))
+
+    def test_unchanged_build_reuses_the_image(self):
+        steps = [Step(install, 'git'), Step(install, 'vim')]
+        first = self._pipeline(steps).build()
+        del calls[:]
+
+        second = self._pipeline(steps).build()
+
+        self.assertEqual(second, first)
+        self.assertEqual(calls, [])
+        self.assertEqual(len(self.cloud.calls_to('launch')), 1)
+
+    def test_image_built_elsewhere_is_reused(self):
+        steps = [Step(install, 'git')]
+        first = self._pipeline(steps).build()
+        os.unlink(self.cache_file)
+        del calls[:]
+
+        second = self._pipeline(steps).build()
+
+        self.assertEqual(second, first)
+        self.assertEqual(calls, [])
+
+    def test_images_are_labelled_with_their_step_key(self):
+        pipeline = self._pipeline([Step(install, 'git')])
+
+        image_id = pipeline.build()
+
+        self.assertEqual(self.cloud.images[image_id]['labels'],
+                         {RECIPE_LABEL: pipeline.fingerprint(),
+                          DISTRO_LABEL: u'centos7',
+                          STEP_LABEL: u'1'})
+
+    def test_changed_step_resumes_from_the_previous_checkpoint(self):
+        self._pipeline([Step(install, 'git'), Step(install, 'vim')]).build()
+        git_image = self.cloud.calls_to('create_image')[0]
+        del calls[:]
+
+        self._pipeline([Step(install, 'git'), Step(install, 'emacs')]).build()
+
+        self.assertEqual(calls, [('install', 'emacs')])
+        builder = self.cloud.calls_to('launch')[-1]
+        self.assertEqual(self.cloud.instances[builder]['config']['image'],
+                         git_image)
+
+    def test_live_imaging_keeps_the_builder(self):
+        commands = []
+
+        def fake_remote(run_command, command, options):
+            commands.append(command)
+            result = _AttributeString('')
+            result.return_code = 0
+            return result
+
+        with command_hook(fake_remote):
+            self._pipeline([Step(install, 'git'), Step(install, 'vim')],
+                           live_imaging=True).build()
+
+        self.assertEqual(len(self.cloud.calls_to('launch')), 1)
+        self.assertEqual(len(self.cloud.images), 2)
+        self.assertEqual(len(commands), 2)
+
+    def test_failed_images_are_not_cached(self):
+        factory = self.cloud.factory()
+        factory.create_image = lambda self, name, labels, live: False
+        pipeline = ImagePipeline(factory,
+                                 {'ami': 'ami-1', 'image_basename': u'test'},
+                                 Distribution.CENTOS7, u'region-1',
+                                 [Step(install, 'git')],
+                                 cache_file=self.cache_file)
+
+        self.assertRaises(RuntimeError, pipeline.build)
+        self.assertEqual(pipeline._deepest_checkpoint(pipeline.keys()),
+                         (0, None))
+        self.assertEqual(self.cloud.calls_to('terminated'),
+                         self.cloud.calls_to('launch'))
+
+    def test_checkpoint_every(self):
+        self._pipeline([Step(install, 'a'), Step(install, 'b'),
+                        Step(install, 'c')], checkpoint_every=2).build()
+
+        self.assertEqual(len(self.cloud.images), 2)
+
+    def test_missing_checkpoint_falls_back_to_an_earlier_one(self):
+        steps = [Step(install, 'git'), Step(install, 'vim')]
+        self._pipeline(steps).build()
+        git_image, vim_image = self.cloud.calls_to('create_image')
+        self.cloud.delete_image(vim_image)
+        del calls[:]
+
+        self._pipeline(steps + [Step(install, 'emacs')]).build()
+
+        self.assertEqual(calls, [('install', 'vim'), ('install', 'emacs')])
+
+    def test_checkpoints_built_elsewhere_are_reused(self):
+        self._pipeline([Step(install, 'git'), Step(install, 'vim')]).build()
+        git_image = self.cloud.calls_to('create_image')[0]
+        os.unlink(self.cache_file)
+        del calls[:]
+
+        self._pipeline([Step(install, 'git'), Step(install, 'emacs')]).build()
+
+        self.assertEqual(calls, [('install', 'emacs')])
+        builder = self.cloud.calls_to('launch')[-1]
+        self.assertEqual(self.cloud.instances[builder]['config']['image'],
+                         git_image)
+
+    def test_checkpoints_are_kept_on_other_launch_errors(self):
+        steps = [Step(install, 'git'), Step(install, 'vim')]
+        self._pipeline(steps).build()
+        factory = self.cloud.factory()
+
+        def create_from_config(cls, config, distro, region):
+            raise IOError('connection reset')
+        factory.create_from_config = classmethod(create_from_config)
+        pipeline = ImagePipeline(factory,
+                                 {'ami': 'ami-1', 'image_basename': u'test'},
+                                 Distribution.CENTOS7, u'region-1',
+                                 steps + [Step(install, 'emacs')],
+                                 cache_file=self.cache_file)
+
+        self.assertRaises(IOError, pipeline.build)
+        self.assertEqual(pipeline._deepest_checkpoint(pipeline.keys())[0], 2)
+
+
+class IncrementalBuildTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_file = os.path.join(directory, 'cache.json')
+        self.cloud = FakeCloud()
+        del calls[:]
+
+    def _build(self, steps, full_rebuild_every=3):
+        pipeline = ImagePipeline(self.cloud.factory(),
+                                 {'ami': 'ami-1', 'image_basename': u'test'},
+                                 Distribution.CENTOS7, u'region-1', steps,
+                                 cache_file=self.cache_file)
+        return pipeline.build_incremental(
+            u'nightly', full_rebuild_every=full_rebuild_every)
+
+    def test_first_build_is_a_full_build(self):
+        self._build([Step(install, 'git'), Step(install, 'vim')])
+
+        self.assertEqual(calls, [('install', 'git'), ('install', 'vim')])
+        builder = self.cloud.calls_to('launch')[0]
+        self.assertNotIn('image', self.cloud.instances[builder]['config'])
+
+    def test_next_build_runs_changed_steps_on_the_previous_image(self):
+        previous = self._build([Step(install, 'git'), Step(install, 'vim')])
+        del calls[:]
+
+        image_id = self._build([Step(install, 'git'), Step(install, 'emacs')])
+
+        self.assertEqual(calls, [('install', 'emacs')])
+        builder = self.cloud.calls_to('launch')[-1]
+        self.assertEqual(self.cloud.instances[builder]['config']['image'],
+                         previous)
+        self.assertEqual(self.cloud.images[image_id]['labels'],
+                         {LINEAGE_LABEL: u'nightly', GENERATION_LABEL: u'1',
+                          DISTRO_LABEL: u'centos7', STEP_LABEL: u'2'})
+
+    def test_always_steps_run_in_every_build(self):
+        self._build([Step(install, 'updates', always=True),
+                     Step(install, 'git')])
+        del calls[:]
+
+        self._build([Step(install, 'updates', always=True),
+                     Step(install, 'git')])
+
+        self.assertEqual(calls, [('install', 'updates')])
+
+    def test_unchanged_build_reuses_the_previous_image(self):
+        steps = [Step(install, 'git')]
+        previous = self._build(steps)
+
+        self.assertEqual(self._build(steps), previous)
+        self.assertEqual(len(self.cloud.calls_to('launch')), 1)
+
+    def test_full_rebuild_every_n_generations(self):
+        for package in ['a', 'b', 'c', 'd']:
+            self._build([Step(install, package, always=True)],
+                        full_rebuild_every=3)
+        launches = self.cloud.calls_to('launch')
+
+        configs = [self.cloud.instances[i]['config'] for i in launches]
+        self.assertEqual(['image' in config for config in configs],
+                         [False, True, True, False])
+
+    def test_full_rebuild_runs_every_step_of_an_unchanged_recipe(self):
+        steps = [Step(install, 'updates', always=True), Step(install, 'git')]
+        for _ in range(4):
+            self._build(steps, full_rebuild_every=3)
+        launches = self.cloud.calls_to('launch')
+
+        builder = launches[-1]
+        self.assertNotIn('image', self.cloud.instances[builder]['config'])
+        self.assertEqual(calls[-2:], [('install', 'updates'),
+                                      ('install', 'git')])
+        self.assertEqual(len(launches), 4)
+
+    def test_lineage_carries_on_after_the_cache_is_wiped(self):
+        steps = [Step(install, 'updates', always=True)]
+        self._build(steps)
+        os.unlink(self.cache_file)
+        del calls[:]
+
+        image_id = self._build(steps)
+
+        self.assertEqual(calls, [('install', 'updates')])
+        self.assertEqual(
+            self.cloud.images[image_id]['labels'][GENERATION_LABEL], u'1')
+        builder = self.cloud.calls_to('launch')[-1]
+        self.assertIn('image', self.cloud.instances[builder]['config'])
+
+    def test_image_names_are_unique_across_workers(self):
+        steps = [Step(install, 'git')]
+        first = self._build(steps)
+        os.unlink(self.cache_file)
+        # another worker, not seeing the first image yet
+        self.cloud.images[first]['labels'] = {}
+
+        second = self._build(steps)
+
+        names = [self.cloud.images[image_id]['name']
+                 for image_id in [first, second]]
+        self.assertNotEqual(names[0], names[1])
+        self.assertFalse(names[1].startswith(names[0]))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -3,10 +3,15 @@ import unittest
 
 from zope.interface.verify import verifyObject, verifyClass
 
-from bookshelf.api_v3.gce import GCEInstance
-from bookshelf.api_v3.ec2 import EC2Instance
-from bookshelf.api_v3.rackspace import RackspaceInstance
+from bookshelf.api_v3.gce import GCEInstance, AsyncGCEInstance
+from bookshelf.api_v3.ec2 import EC2Instance, AsyncEC2Instance
+from bookshelf.api_v3.rackspace import (
+    RackspaceInstance, AsyncRackspaceInstance
+)
+from bookshelf.api_v3.async_instance import AsyncCloudInstance
 from bookshelf.api_v3.cloud_instance import (
+    IAsyncCloudInstanceFactory,
+    IAsyncCloudInstance,
     ICloudInstanceFactory,
     ICloudInstance
 )
@@ -20,6 +25,9 @@ class TestGCEInterfaces(unittest.TestCase):
     def test_gce_implements_cloud_instance(self):
         verifyClass(ICloudInstance, GCEInstance)
 
+    def test_gce_provides_async_cloud_instance_factory(self):
+        verifyObject(IAsyncCloudInstanceFactory, AsyncGCEInstance)
+
 
 class TestEC2Interfaces(unittest.TestCase):
 
@@ -29,6 +37,9 @@ class TestEC2Interfaces(unittest.TestCase):
     def test_ec2_implements_cloud_instance(self):
         verifyClass(ICloudInstance, EC2Instance)
 
+    def test_ec2_provides_async_cloud_instance_factory(self):
+        verifyObject(IAsyncCloudInstanceFactory, AsyncEC2Instance)
+
 
 class TestRackspaceInterfaces(unittest.TestCase):
 
@@ -38,6 +49,15 @@ class TestRackspaceInterfaces(unittest.TestCase):
     def test_rackspaceee_implements_cloud_instance(self):
         verifyClass(ICloudInstance, RackspaceInstance)
 
+    def test_rackspace_provides_async_cloud_instance_factory(self):
+        verifyObject(IAsyncCloudInstanceFactory, AsyncRackspaceInstance)
+
+
+class TestAsyncInterfaces(unittest.TestCase):
+
+    def test_async_cloud_instance_implements_async_cloud_instance(self):
+        verifyClass(IAsyncCloudInstance, AsyncCloudInstance)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=4, failfast=True)
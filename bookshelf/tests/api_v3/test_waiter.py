@@ -0,0 +1,56 @@
+import unittest
+
+from bookshelf.api_v3.waiter import (
+    WaitFailed, WaitTimeout, wait_for, wait_for_all
+)
+
+
+class WaitForTests(unittest.TestCase):
+
+    def test_returns_the_ready_value(self):
+        states = iter(['pending', 'pending', 'available'])
+
+        result = wait_for(lambda: next(states), lambda s: s == 'available',
+                          'image', interval=0)
+
+        self.assertEqual(result, 'available')
+
+    def test_raises_when_failed(self):
+        states = iter(['pending', 'failed'])
+
+        with self.assertRaises(WaitFailed) as e:
+            wait_for(lambda: next(states), lambda s: s == 'available',
+                     'image', interval=0, failed=lambda s: s == 'failed')
+        self.assertEqual(e.exception.last, 'failed')
+
+    def test_raises_on_timeout(self):
+        with self.assertRaises(WaitTimeout):
+            wait_for(lambda: 'pending', lambda s: False, 'image',
+                     timeout=0, interval=1)
+
+
+class WaitForAllTests(unittest.TestCase):
+
+    def test_probes_only_pending_keys(self):
+        probes = []
+        rounds = {'a': iter(['ready']), 'b': iter(['pending', 'ready'])}
+
+        def probe(pending):
+            probes.append(sorted(pending))
+            return dict((key, next(rounds[key])) for key in pending)
+
+        result = wait_for_all(probe, ['a', 'b'], lambda s: s == 'ready',
+                              'copies', interval=0)
+
+        self.assertEqual(result, {'a': 'ready', 'b': 'ready'})
+        self.assertEqual(probes, [['a', 'b'], ['b']])
+
+    def test_raises_when_one_fails(self):
+        with self.assertRaises(WaitFailed):
+            wait_for_all(lambda pending: {'a': 'ready', 'b': 'failed'},
+                         ['a', 'b'], lambda s: s == 'ready', 'copies',
+                         interval=0, failed=lambda s: s == 'failed')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from concurrent.futures import wait
+
+from bookshelf.api_v3.cloud_instance import Distribution
+from bookshelf.api_v3.warm_pool import (
+    PoolStore, WarmPool, config_fingerprint
+)
+from bookshelf.tests.api_v3.fakes import FakeCloud
+
+
+class ConfigFingerprintTests(unittest.TestCase):
+
+    def test_config_fingerprint_ignores_key_order(self):
+        self.assertEqual(config_fingerprint({'a': 1, 'b': {'c': 2}}),
+                         config_fingerprint({'b': {'c': 2}, 'a': 1}))
+
+    def test_config_fingerprint_changes_with_config(self):
+        self.assertNotEqual(config_fingerprint({'ami': 'ami-1'}),
+                            config_fingerprint({'ami': 'ami-2'}))
+
+
+class WarmPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state_file = os.path.join(directory, 'pools.json')
+        self.cloud = FakeCloud()
+
+    def _pool(self, **kwargs):
+        pool = WarmPool(self.cloud.factory(), {'ami': 'ami-1'},
+                        Distribution.CENTOS7, u'region-1',
+                        state_file=self.state_file, **kwargs)
+        self.addCleanup(pool.join)
+        return pool
+
+    def test_refill_creates_stopped_members(self):
+        pool = self._pool(size=2)
+
+        wait(pool.refill())
+
+        self.assertEqual(len(pool.members()), 2)
+        self.assertEqual(
+            [i['status'] for i in self.cloud.instances.values()],
+            ['stopped', 'stopped'])
+
+    def test_refill_does_not_overfill(self):
+        pool = self._pool(size=2)
+        wait(pool.refill())
+
+        self.assertEqual(pool.refill(), [])
+
+    def test_acquire_hands_out_a_pool_member(self):
+        pool = self._pool(size=1)
+        wait(pool.refill())
+        member = pool.members()[0]
+
+        instance = pool.acquire()
+
+        self.assertEqual(instance.instance_id, member['state']['instance_id'])
+        self.assertEqual(
+            self.cloud.instances[instance.instance_id]['status'], 'running')
+
+    def test_acquire_refills_the_pool(self):
+        pool = self._pool(size=1)
+        wait(pool.refill())
+
+        instance = pool.acquire()
+        pool.join()
+
+        self.assertEqual(len(pool.members()), 1)
+        self.assertNotEqual(pool.members()[0]['state']['instance_id'],
+                            instance.instance_id)
+
+    def test_acquire_creates_an_instance_when_the_pool_is_empty(self):
+        instance = self._pool(size=0).acquire()
+
+        self.assertEqual(self.cloud.calls_to('launch'),
+                         [instance.instance_id])
+
+    def test_acquire_skips_members_that_no_longer_exist(self):
+        pool = self._pool(size=2)
+        wait(pool.refill())
+        gone, kept = [m['state']['instance_id'] for m in pool.members()]
+        del self.cloud.instances[gone]
+
+        instance = pool.acquire()
+
+        self.assertEqual(instance.instance_id, kept)
+
+    def test_acquire_destroys_members_that_fail_to_start(self):
+        pool = self._pool(size=2)
+        wait(pool.refill())
+        broken, kept = [m['state']['instance_id'] for m in pool.members()]
+        factory = pool.factory
+
+        def wait_until_ready(instance):
+            if instance.instance_id == broken:
+                raise RuntimeError('ssh never came up')
+        factory.wait_until_ready = wait_until_ready
+
+        instance = pool.acquire()
+
+        self.assertEqual(instance.instance_id, kept)
+        self.assertEqual(self.cloud.instances[broken]['status'],
+                         'terminated')
+
+    def test_refill_destroys_members_that_fail_to_stop(self):
+        pool = self._pool(size=1)
+
+        def down(instance):
+            raise RuntimeError('could not stop')
+        pool.factory.down = down
+
+        futures = pool.refill()
+        wait(futures)
+
+        self.assertIsInstance(futures[0].exception(), RuntimeError)
+        self.assertEqual(pool.members(), [])
+        self.assertEqual(
+            [i['status'] for i in self.cloud.instances.values()],
+            ['terminated'])
+
+    def test_recycle_destroys_stale_members(self):
+        pool = self._pool(size=1, max_age=0)
+        wait(pool.refill())
+        member = pool.members()[0]
+
+        wait(pool.recycle())
+
+        self.assertEqual(pool.members(), [])
+        self.assertEqual(
+            self.cloud.instances[member['state']['instance_id']]['status'],
+            'terminated')
+
+    def test_pools_with_different_configs_do_not_share_members(self):
+        pool = self._pool(size=1)
+        wait(pool.refill())
+        other = WarmPool(self.cloud.factory(), {'ami': 'ami-2'},
+                         Distribution.CENTOS7, u'region-1',
+                         state_file=self.state_file)
+
+        self.assertEqual(other.members(), [])
+
+
+class PoolStoreTests(unittest.TestCase):
+
+    def test_pop_returns_none_when_empty(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        store = PoolStore(os.path.join(directory, 'pools.json'))
+
+        self.assertEqual(store.pop(u'key', max_age=60), None)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
@@ -0,0 +1,315 @@
+"""
+Runs test suites sharded across worker processes:
+
+    export PYTHONPATH=`pwd`
+    python bookshelf/tests/runner.py --workers 4 \
+        bookshelf/tests/api_v2/test_os.py bookshelf/tests/api_v2/test_pkg.py
+
+Each worker is a process of its own, so it has its own fabric env and
+container pool, and it runs in a directory of its own, so that vagrant
+based tests each get their own Vagrantfile and box.
+
+Shards are balanced using the durations of previous runs, kept in a json
+file shared with later runs (``--history``). Tests without a history count
+as the median duration. The tests of a class with a setUpClass fixture all
+go to the same worker, so the fixture is only set up once. The results of
+all the workers are merged into a single report, optionally written as
+JUnit XML for CI.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+from Queue import Empty
+from time import time
+from xml.etree import ElementTree
+
+from bookshelf.api_v3.state_file import locked_json_file
+
+DEFAULT_HISTORY_FILE = os.path.expanduser('~/.bookshelf/test-durations.json')
+
+_DOCKER_MODULE = 'bookshelf.tests.api_v2.docker_based_tests'
+_VAGRANT_MODULE = 'bookshelf.tests.api_v2.vagrant_based_tests'
+
+
+def _module_name(name):
+    """ returns the dotted name of a test module given as a path or name """
+    if not name.endswith('.py'):
+        return name
+    path = os.path.splitext(os.path.abspath(name))[0]
+    parts = [os.path.basename(path)]
+    directory = os.path.dirname(path)
+    # up to the directory the outermost package is in, whatever the
+    # current directory is
+    while os.path.exists(os.path.join(directory, '__init__.py')):
+        parts.insert(0, os.path.basename(directory))
+        directory = os.path.dirname(directory)
+    return '.'.join(parts)
+
+
+def _flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for inner in _flatten(test):
+                yield inner
+        else:
+            yield test
+
+
+def load_tests(names):
+    """ returns the test cases of the modules, in the order they are in """
+    loader = unittest.TestLoader()
+    return list(_flatten(loader.loadTestsFromNames(
+        [_module_name(name) for name in names])))
+
+
+def shard(durations, workers):
+    """
+    Splits tests into shards of about the same total duration, longest
+    tests first, each to the shard with the least work so far.
+
+    :param list durations: the expected duration of each test.
+    :return list: for each shard, the indices of its tests in order.
+    """
+    shards = [[] for _ in range(min(workers, len(durations)) or 1)]
+    totals = [0.0] * len(shards)
+    for index in sorted(range(len(durations)),
+                        key=lambda index: -durations[index]):
+        emptiest = totals.index(min(totals))
+        shards[emptiest].append(index)
+        totals[emptiest] += durations[index]
+    return [sorted(indices) for indices in shards]
+
+
+def fixture_groups(tests):
+    """
+    Groups the tests that have to run in the same worker: those of a class
+    with a setUpClass, which is typically an expensive shared fixture such
+    as a cloud instance. Other tests are groups of their own.
+
+    :return list: for each group, the indices of its tests.
+    """
+    groups = []
+    classes = {}
+    for index, test in enumerate(tests):
+        cls = type(test)
+        if getattr(cls.setUpClass, '__func__', None) is \
+                unittest.TestCase.setUpClass.__func__:
+            groups.append([index])
+        elif cls in classes:
+            classes[cls].append(index)
+        else:
+            classes[cls] = [index]
+            groups.append(classes[cls])
+    return groups
+
+
+def expected_durations(tests, history):
+    """ returns the duration of the last run of each test, or the median """
+    known = sorted(history.values())
+    default = known[len(known) // 2] if known else 1.0
+    return [history.get(test.id(), default) for test in tests]
+
+
+class RecordingResult(unittest.TestResult):
+    """ a TestResult keeping the outcome and duration of every test """
+    def __init__(self):
+        unittest.TestResult.__init__(self)
+        self.records = []
+        self._started = time()
+
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self._started = time()
+
+    def _record(self, test, outcome, details=None):
+        self.records.append({'id': test.id(),
+                             'outcome': outcome,
+                             'duration': time() - self._started,
+                             'details': details})
+
+    def addSuccess(self, test):
+        unittest.TestResult.addSuccess(self, test)
+        self._record(test, 'success')
+
+    def addFailure(self, test, err):
+        unittest.TestResult.addFailure(self, test, err)
+        self._record(test, 'failure', self.failures[-1][1])
+
+    def addError(self, test, err):
+        unittest.TestResult.addError(self, test, err)
+        self._record(test, 'error', self.errors[-1][1])
+
+    def addSkip(self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self._record(test, 'skip', reason)
+
+    def addExpectedFailure(self, test, err):
+        unittest.TestResult.addExpectedFailure(self, test, err)
+        self._record(test, 'success')
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TestResult.addUnexpectedSuccess(self, test)
+        self._record(test, 'failure', 'unexpected success')
+
+
+def _run_shard(worker, tests, results):
+    directory = tempfile.mkdtemp(prefix='bookshelf-worker-%d-' % worker)
+    os.chdir(directory)
+    result = RecordingResult()
+    try:
+        unittest.TestSuite(tests).run(result)
+        # atexit handlers don't run in multiprocessing children
+        if _DOCKER_MODULE in sys.modules:
+            sys.modules[_DOCKER_MODULE].close_container_pools()
+        if _VAGRANT_MODULE in sys.modules:
+            sys.modules[_VAGRANT_MODULE].destroy_vagrant_boxes()
+    except BaseException:
+        result.records.append({'id': 'worker-%d' % worker,
+                               'outcome': 'error',
+                               'duration': 0.0,
+                               'details': traceback.format_exc()})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        results.put((worker, result.records))
+
+
+def run_sharded(tests, workers, history):
+    """
+    Runs the tests on workers processes.
+
+    :return list: the records of every test, dicts with the test ``id``,
+        its ``outcome`` (success, failure, error or skip), ``duration`` and
+        the failure ``details``.
+    """
+    durations = expected_durations(tests, history)
+    groups = fixture_groups(tests)
+    # in the order they were loaded, which keeps the tests of a class next
+    # to each other so that unittest only sets up their fixture once
+    shards = [sorted(index for group in indices for index in groups[group])
+              for indices in shard([sum(durations[index] for index in group)
+                                    for group in groups], workers)]
+    results = multiprocessing.Queue()
+    children = {}
+    for worker, indices in enumerate(shards):
+        child = multiprocessing.Process(
+            target=_run_shard,
+            args=(worker, [tests[index] for index in indices], results))
+        child.start()
+        children[worker] = child
+
+    records = []
+    pending = set(children)
+    while pending:
+        try:
+            worker, worker_records = results.get(timeout=5)
+        except Empty:
+            for worker in list(pending):
+                if not children[worker].is_alive():
+                    pending.discard(worker)
+                    records.extend(
+                        {'id': tests[index].id(), 'outcome': 'error',
+                         'duration': 0.0,
+                         'details': 'worker %d exited with %s' % (
+                             worker, children[worker].exitcode)}
+                        for index in shards[worker])
+            continue
+        pending.discard(worker)
+        records.extend(worker_records)
+    for child in children.values():
+        child.join()
+    return records
+
+
+def write_junit_xml(records, duration, path):
+    """ writes the records as a JUnit XML report, as read by CI servers """
+    counts = _counts(records)
+    suite = ElementTree.Element('testsuite', {
+        'name': 'bookshelf',
+        'tests': str(len(records)),
+        'failures': str(counts['failure']),
+        'errors': str(counts['error']),
+        'skipped': str(counts['skip']),
+        'time': '%.3f' % duration,
+    })
+    for record in records:
+        classname, _, name = record['id'].rpartition('.')
+        case = ElementTree.SubElement(suite, 'testcase', {
+            'classname': classname,
+            'name': name,
+            'time': '%.3f' % record['duration'],
+        })
+        if record['outcome'] in ('failure', 'error', 'skip'):
+            tag = 'skipped' if record['outcome'] == 'skip' else \
+                record['outcome']
+            ElementTree.SubElement(case, tag).text = record['details']
+    ElementTree.ElementTree(suite).write(path, encoding='utf-8')
+
+
+def _counts(records):
+    counts = dict.fromkeys(['success', 'failure', 'error', 'skip'], 0)
+    for record in records:
+        counts[record['outcome']] += 1
+    return counts
+
+
+def print_report(records, duration, workers):
+    """ prints the failures and a summary, in the style of unittest """
+    for record in records:
+        if record['outcome'] in ('failure', 'error'):
+            print('=' * 70)
+            print('%s: %s' % (record['outcome'].upper(), record['id']))
+            print('-' * 70)
+            print(record['details'])
+    counts = _counts(records)
+    print('-' * 70)
+    print('Ran %d tests in %.3fs on %d workers' % (
+        len(records), duration, workers))
+    print('')
+    if counts['failure'] or counts['error']:
+        print('FAILED (failures=%d, errors=%d, skipped=%d)' % (
+            counts['failure'], counts['error'], counts['skip']))
+    else:
+        print('OK (skipped=%d)' % counts['skip'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Runs test suites sharded across worker processes.')
+    parser.add_argument('suites', nargs='+',
+                        help='test module paths or dotted names')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--history', default=DEFAULT_HISTORY_FILE,
+                        help='json file of the durations of previous runs')
+    parser.add_argument('--junit-xml', help='writes a JUnit XML report')
+    options = parser.parse_args(argv)
+
+    tests = load_tests(options.suites)
+    if _DOCKER_MODULE in sys.modules:
+        sys.modules[_DOCKER_MODULE].prepare_required_docker_images()
+
+    with locked_json_file(options.history) as history:
+        history = dict(history)
+    start = time()
+    records = run_sharded(tests, options.workers, history)
+    duration = time() - start
+    with locked_json_file(options.history) as history:
+        history.update((record['id'], record['duration'])
+                       for record in records
+                       if record['outcome'] != 'skip')
+
+    workers = min(options.workers, len(tests))
+    print_report(records, duration, workers)
+    if options.junit_xml:
+        write_junit_xml(records, duration, options.junit_xml)
+    return 0 if all(record['outcome'] in ('success', 'skip')
+                    for record in records) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+from bookshelf.tests.runner import (
+    _module_name, expected_durations, fixture_groups, run_sharded, shard,
+    write_junit_xml
+)
+
+
+def sample_tests():
+    """ returns the tests run by the sharded runner in these tests """
+    class Sample(unittest.TestCase):
+
+        def test_passes(self):
+            pass
+
+        def test_fails(self):
+            self.fail('expected')
+
+        def test_skips(self):
+            self.skipTest('skipped')
+
+        def test_checks_cwd(self):
+            self.assertIn('bookshelf-worker-', os.getcwd())
+
+    return list(unittest.TestLoader().loadTestsFromTestCase(Sample))
+
+
+def sample_fixture_tests(setups=os.devnull):
+    """ returns tests sharing a class fixture, which logs to setups """
+    class SampleWithFixture(unittest.TestCase):
+
+        @classmethod
+        def setUpClass(cls):
+            with open(setups, 'a') as f:
+                f.write('%d\n' % os.getpid())
+
+        def test_first(self):
+            pass
+
+        def test_second(self):
+            pass
+
+    return list(unittest.TestLoader().loadTestsFromTestCase(
+        SampleWithFixture))
+
+
+class ModuleNameTests(unittest.TestCase):
+
+    def test_paths_are_resolved_from_the_package(self):
+        path = os.path.abspath(__file__)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempfile.gettempdir())
+
+        self.assertEqual(_module_name(path), 'bookshelf.tests.test_runner')
+
+    def test_dotted_names_are_left_alone(self):
+        self.assertEqual(_module_name('bookshelf.tests.test_runner'),
+                         'bookshelf.tests.test_runner')
+
+
+class ShardTests(unittest.TestCase):
+
+    def test_balances_by_duration(self):
+        shards = shard([10, 1, 1, 5, 4, 1], 2)
+
+        totals = [sum([10, 1, 1, 5, 4, 1][i] for i in s) for s in shards]
+        self.assertEqual(sorted(totals), [11, 11])
+
+    def test_keeps_test_order_within_a_shard(self):
+        for indices in shard([1, 3, 2, 5, 4], 2):
+            self.assertEqual(indices, sorted(indices))
+
+    def test_no_more_shards_than_tests(self):
+        self.assertEqual(len(shard([1], 4)), 1)
+
+    def test_unknown_tests_count_as_the_median(self):
+        tests = sample_tests()
+        history = {tests[0].id(): 1.0, tests[1].id(): 3.0,
+                   tests[2].id(): 5.0}
+
+        self.assertEqual(expected_durations(tests, history)[3], 3.0)
+
+    def test_groups_tests_sharing_a_class_fixture(self):
+        tests = sample_tests() + sample_fixture_tests()
+
+        self.assertEqual(fixture_groups(tests), [[0], [1], [2], [3], [4, 5]])
+
+
+class RunShardedTests(unittest.TestCase):
+
+    def test_merges_the_results_of_all_workers(self):
+        tests = sample_tests()
+
+        records = run_sharded(tests, 3, {})
+
+        outcomes = dict((r['id'].rsplit('.', 1)[1], r['outcome'])
+                        for r in records)
+        self.assertEqual(outcomes, {'test_passes': 'success',
+                                    'test_fails': 'failure',
+                                    'test_skips': 'skip',
+                                    'test_checks_cwd': 'success'})
+
+    def test_runs_class_fixtures_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        setups = os.path.join(directory, 'setups')
+
+        records = run_sharded(sample_fixture_tests(setups), 2, {})
+
+        self.assertEqual([r['outcome'] for r in records],
+                         ['success', 'success'])
+        with open(setups) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_writes_junit_xml(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'report.xml')
+
+        write_junit_xml(run_sharded(sample_tests(), 2, {}), 1.0, path)
+
+        suite = ElementTree.parse(path).getroot()
+        self.assertEqual(suite.get('tests'), '4')
+        self.assertEqual(suite.get('failures'), '1')
+        self.assertEqual(len(suite.findall('testcase/skipped')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4, failfast=True)
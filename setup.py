@@ -16,6 +16,7 @@ setup(
               'bookshelf.tests.api_v3', ],
     install_requires=['cuisine', 'fabric', 'pyrax', 'boto',
                       'google-api-python-client==1.4.2', 'oauth2client==1.5.2',
-                      'zope.interface', 'flufl.enum', 'pyrsistent'],
+                      'zope.interface', 'flufl.enum', 'pyrsistent',
+                      'futures'],
     license='Apache License, Version 2.0',
 )